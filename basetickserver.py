@@ -27,14 +27,40 @@ A server that should be overridden to provide a server with its own internal loo
 
 import time
 
-from settings import CLIENT_UPDATE_FREQ, CLIENT_NETWORK_FPS
+try:
+    # Python 3.3+
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        # Not monotonic, but the best we can do without it.
+        monotonic = time.time
+
+from settings import CLIENT_UPDATE_FREQ, MSPERSEC
 
 class BaseTickServer(object):
     '''This is a class that should be subclassed and tick() defined to do something
-    every "tick".'''
+    every "tick".
+
+    start() calls tick() every tick_length seconds of real time, sleeping in
+    between. If a tick runs long, the ones that were missed are run back to
+    back to catch up, but no more than max_frameskip of them. Any more
+    than that are dropped, counted in skipped.'''
+
+    max_frameskip = 5
 
     def __init__(self):
         self.tick_freq_multiplier = 1
+        self.tick_length = CLIENT_UPDATE_FREQ / MSPERSEC / self.tick_freq_multiplier
+        self.running = False
+        self.current_tick = 0
+
+        # Stubbed out by tests so they don't have to wait.
+        self.clock = monotonic
+        self.sleep = time.sleep
+
+        self.reset_stats()
 
     def tick(self):
         '''Do things every tick. Should be overridden.'''
@@ -42,20 +68,63 @@ class BaseTickServer(object):
 
     def start(self):
         self.current_tick = 0
-        skip_ticks = CLIENT_UPDATE_FREQ
-        max_frameskip = 5
-
-        next_tick = 0
         self.running = True
+        next_tick = self.clock()
 
         while self.running:
+            now = self.clock()
             loops = 0
-            self.current_tick += 1
-            while (self.current_tick > next_tick) and (loops < max_frameskip):
-                # dt = ((current_tick + skip_ticks) - next_tick) / skip_ticks
-                self.tick()
-                next_tick += skip_ticks
+            while now >= next_tick and loops < self.max_frameskip and self.running:
+                self.run_tick(lateness=now - next_tick)
+                next_tick += self.tick_length
                 loops += 1
+                now = self.clock()
+
+            if now >= next_tick:
+                # Still behind after max_frameskip ticks, so drop the ones we
+                # missed and carry on from now rather than falling further behind.
+                self.skipped += int((now - next_tick) / self.tick_length)
+                next_tick = now
+            elif self.running:
+                self.sleep(next_tick - now)
+
+    def stop(self):
+        '''Stop after the current tick.'''
+        self.running = False
+
+    def run_tick(self, lateness=0):
+        '''Call tick() and keep track of how long it took.'''
+        start = self.clock()
+        self.tick()
+        duration = self.clock() - start
+
+        self.current_tick += 1
+        self.ticks += 1
+        self.tick_seconds += duration
+        self.worst_tick = max(self.worst_tick, duration)
+        self.worst_lateness = max(self.worst_lateness, lateness)
+        if duration > self.tick_length:
+            self.overruns += 1
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.tick_seconds = 0.0
+        self.worst_tick = 0.0
+        self.worst_lateness = 0.0
+
+    def stats(self):
+        '''How the ticks have been going: how many ran, how many ran longer
+        than tick_length (overruns) or were dropped (skipped), how long they
+        took, and the furthest behind schedule one started (worst_lateness).'''
+        return {'ticks': self.ticks,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'seconds': self.tick_seconds,
+                'mean_tick': self.tick_seconds / self.ticks if self.ticks else 0.0,
+                'worst_tick': self.worst_tick,
+                'worst_lateness': self.worst_lateness}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''Query plan benchmark
+Shows SQLite's plan and the time taken for the Object queries the servers
+actually make, first without Object's secondary indexes and then with them.
+
+Run it from the top of the repository:
+    python benchmarks/query_plans.py --objects=50000
+'''
+
+import os
+import sys
+import time
+import datetime
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado.options import define, options, parse_command_line
+import elixir_models
+from elixir_models import Object, ObjectState
+
+define("objects", default=20000, help="How many objects to put in the zone.", type=int)
+define("repeat", default=50, help="How many times to run each query.", type=int)
+
+
+def query_shapes():
+    '''(description, query) for each kind of query the servers make.'''
+    an_hour_ago = datetime.datetime.now() - datetime.timedelta(hours=1)
+    newest = Object.select().order_by(Object.last_modified.desc())
+    in_order = Object.select().order_by(Object.change_seq)
+    return (
+        ("basezone.is_loaded / scriptserver startup",
+         newest.where(Object.name == "Loading Complete.")),
+        ("CharacterController.get_character",
+         newest.where(Object.id << Object.in_state('player'))
+               .where(Object.name == "Character 7").limit(1)),
+        ("get_objects(states=['hidden'])",
+         newest.where(Object.id << Object.in_state('hidden'))),
+        ("/objects?since=",
+         newest.where(Object.last_modified >= an_hour_ago)),
+        ("HEAD /objects",
+         newest.limit(1)),
+        ("/objects?after=",
+         in_order.where(Object.change_seq > Object.max_change_seq() - 10)),
+    )
+
+
+def populate(count):
+    '''Fill the zone with count objects, most of them last modified
+    long ago, like the scenery a zone starts with.'''
+    long_ago = datetime.datetime.now() - datetime.timedelta(days=30)
+    with elixir_models.db.atomic():
+        # The rows below are numbered 1 to count.
+        Object.next_change_seq(count)
+        for i in xrange(0, count, 500):
+            rows = [{'id': n + 1,
+                     'name': "Character %d" % n if n % 100 == 7 else "Object %d" % n,
+                     'states': ['player'] if n % 100 == 7 else ['hidden'] if n % 1000 == 3 else [],
+                     'scripts': [],
+                     'change_seq': n + 1,
+                     'last_modified': datetime.datetime.now() if n > count - 100 else long_ago}
+                    for n in xrange(i, min(i + 500, count))]
+            Object.insert_many(rows).execute()
+            states = [{'obj': row['id'], 'state': state} for row in rows for state in row['states']]
+            if states:
+                ObjectState.insert_many(states).execute()
+    Object.create(name="Loading Complete.")
+
+
+def plan(query):
+    sql, params = query.sql()
+    rows = elixir_models.db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    return '; '.join(row[-1] for row in rows)
+
+
+def report(title):
+    print title
+    for description, query in query_shapes():
+        start = time.time()
+        for i in xrange(options.repeat):
+            list(query.clone())
+        elapsed = (time.time() - start) / options.repeat
+        print "  %-42s %8.3fms  %s" % (description, elapsed * 1000, plan(query))
+    print
+
+
+def main():
+    parse_command_line()
+
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        elixir_models.setup(db_uri=path)
+        populate(options.objects)
+
+        indexes = ['_'.join(('object',) + tuple(columns)) for columns, unique in Object._meta.indexes]
+        for name in indexes:
+            elixir_models.db.execute_sql('DROP INDEX %s' % name)
+        elixir_models.db.execute_sql('ANALYZE')
+        report("Without %s (%d objects):" % (', '.join(indexes), options.objects))
+
+        # Put them back the way a migration would.
+        elixir_models.db.execute_sql('PRAGMA user_version = 2')
+        elixir_models.migrate_schema()
+        elixir_models.db.execute_sql('ANALYZE')
+        report("With them:")
+    finally:
+        elixir_models.db.close()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''SQLite profile benchmark
+Compares SQLite's defaults with settings.SQLITE_PRAGMAS for what the zone
+does all day: autocommit saves, a batched flush, and somebody else reading
+the zone while that happens (like the ScriptServer and ZoneServer do).
+
+Run it from the top of the repository:
+    python benchmarks/sqlite_profile.py --saves=500
+'''
+
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado.options import define, options, parse_command_line
+
+import elixir_models
+from elixir_models import Object, zone_state
+from settings import SQLITE_PRAGMAS
+
+define("saves", default=500, help="How many objects to save.", type=int)
+
+PROFILES = (
+    ("SQLite defaults", (('journal_mode', 'delete'), ('synchronous', 'full'))),
+    ("settings.SQLITE_PRAGMAS", SQLITE_PRAGMAS),
+)
+
+
+class Reader(threading.Thread):
+    '''Keeps reading the zone from its own connection, timing each read.'''
+
+    def __init__(self, path):
+        super(Reader, self).__init__()
+        self.path = path
+        self.running = True
+        self.latencies = []
+        self.locked = 0
+
+    def run(self):
+        conn = sqlite3.connect(self.path, timeout=0)
+        while self.running:
+            start = time.time()
+            try:
+                conn.execute('SELECT count(*), max(change_seq) FROM object').fetchone()
+            except sqlite3.OperationalError:
+                self.locked += 1
+            self.latencies.append(time.time() - start)
+            time.sleep(0.001)
+        conn.close()
+
+
+def run(description, pragmas):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        elixir_models.setup(db_uri=path, pragmas=pragmas)
+        reader = Reader(path)
+        reader.start()
+
+        start = time.time()
+        objects = [Object.create(name="Object %d" % i) for i in xrange(options.saves)]
+        saves = time.time() - start
+
+        zone_state.load()
+        for o in zone_state.objects.values():
+            o.loc_x += 1
+            o.set_modified()
+        start = time.time()
+        zone_state.flush()
+        flush = time.time() - start
+        zone_state.unload()
+
+        reader.running = False
+        reader.join()
+
+        latencies = sorted(reader.latencies)
+        print description
+        print "  %d autocommit saves:  %7.3fs (%.2fms each)" % (len(objects), saves, saves / len(objects) * 1000)
+        print "  flush of %d objects:  %7.3fs" % (len(objects), flush)
+        print "  concurrent reads:     %d, %d refused as locked, worst %.2fms, median %.2fms" % (
+            len(latencies), reader.locked, latencies[-1] * 1000, latencies[len(latencies) // 2] * 1000)
+        print
+    finally:
+        elixir_models.db.close()
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def main():
+    parse_command_line()
+    for description, pragmas in PROFILES:
+        run(description, pragmas)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''Zone population benchmark
+Times a zone's first boot: putting count objects in with a save() each,
+the way zones used to, and then with Object.bulk_create like
+BaseZone.randobj does now.
+
+Run it from the top of the repository:
+    python benchmarks/zone_population.py --objects=100000
+'''
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado.options import define, options, parse_command_line
+
+import elixir_models
+from elixir_models import Object, object_grid
+from games.zones.basezone import BaseZone, randloc, randrot, randscale
+
+define("objects", default=100000, help="How many objects to put in the zone.", type=int)
+
+
+def save_each(count):
+    '''What BaseZone.randobj used to do.'''
+    for i in xrange(count):
+        obj = Object()
+        obj.name = "Barrel #%d" % i
+        obj.resource = 'barrel'
+        obj.loc_x, obj.loc_y, obj.loc_z = randloc(), randloc(), randloc()
+        obj.rot_x, obj.rot_y, obj.rot_z = randrot(), randrot(), randrot()
+        obj.scale_x, obj.scale_y, obj.scale_z = randscale(), randscale(), randscale()
+        obj.states.extend(['closed', 'whole', 'clickable'])
+        obj.save()
+
+def bulk(count):
+    BaseZone.randobj(name="Barrel #%d", resource='barrel', states=['closed', 'whole', 'clickable'], count=count)
+
+
+def run(description, populate):
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        elixir_models.setup(db_uri=path)
+        object_grid.clear()
+
+        start = time.time()
+        populate(options.objects)
+        elapsed = time.time() - start
+
+        count = Object.select().count()
+        print "  %-12s %8.2fs  (%d objects, %.0f a second)" % (description, elapsed, count, count / elapsed)
+    finally:
+        elixir_models.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def main():
+    parse_command_line()
+    print "First boot with %d objects:" % options.objects
+    run("save() each", save_each)
+    run("bulk_create", bulk)
+
+
+if __name__ == "__main__":
+    main()
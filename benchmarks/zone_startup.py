@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''Zone startup benchmark
+Times starting a new instance of a zone the way MasterZoneServer.launch_zone
+does: start a ZoneServer on an empty database and wait for it to answer.
+First with the zone running its insert_objects, then with a snapshot of it
+built by zonesnapshot.py. Then, since the zones in games/zones are small,
+just the loading part for a zone of --objects barrels.
+
+Run it from the top of the repository:
+    python benchmarks/zone_startup.py --zonename=defaultzone --repeat=5 --objects=100000
+'''
+
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import requests
+from tornado.options import define, options, parse_command_line
+
+import zonesnapshot
+import elixir_models
+from elixir_models import Object, load_snapshot
+from games.zones.basezone import BaseZone
+from settings import ZONE_SNAPSHOT_FILE, ZONESTARTUPTIME
+
+define("zonename", default='defaultzone', help="Which zone to start.", type=str)
+define("repeat", default=5, help="How many times to start it each way.", type=int)
+define("objects", default=20000, help="How many barrels the in-process zone has.", type=int)
+
+
+class BarrelZone(BaseZone):
+    def insert_objects(self):
+        self.randobj(name="Barrel #%d", resource='barrel', states=['closed', 'whole', 'clickable'],
+                     count=options.objects)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_zone(directory):
+    '''Start a ZoneServer on a new database in directory, and return how
+    long it took to answer.'''
+    dburi = tempfile.mktemp(suffix='.sqlite', dir=directory)
+    port = free_port()
+    url = 'http://localhost:%d' % port
+    start = time.time()
+    zone = subprocess.Popen([sys.executable, 'zoneserver.py', '--port=%d' % port, '--dburi=%s' % dburi,
+                             '--zonename=%s' % options.zonename, '--owner=Benchmark'],
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    try:
+        while True:
+            try:
+                if requests.get(url).status_code == 200:
+                    return time.time() - start
+            except requests.ConnectionError:
+                pass
+            if zone.poll() is not None or time.time() > start + ZONESTARTUPTIME:
+                raise RuntimeError("ZoneServer never came up on %s." % url)
+            time.sleep(.01)
+    finally:
+        if zone.poll() is None:
+            zone.terminate()
+            zone.wait()
+
+def report(description, times):
+    times = sorted(times)
+    print "  %-24s median %6.3fs, best %6.3fs, worst %6.3fs" % (
+        description, times[len(times) // 2], times[0], times[-1])
+
+def load_zone(directory):
+    '''Load BarrelZone into a new database, then copy that into another
+    one as a snapshot. Returns how long each took.'''
+    snapshot = os.path.join(directory, 'barrels.sqlite')
+    elixir_models.setup(db_uri=snapshot)
+    start = time.time()
+    BarrelZone()
+    inserted = time.time() - start
+    elixir_models.db.close()
+
+    elixir_models.setup(db_uri=os.path.join(directory, 'copy.sqlite'))
+    start = time.time()
+    load_snapshot(snapshot)
+    copied = time.time() - start
+    assert Object.select().count() == options.objects + 1
+    elixir_models.db.close()
+    return inserted, copied
+
+def main():
+    parse_command_line()
+
+    directory = tempfile.mkdtemp()
+    # The ZoneServers use the real snapshot, so put any there is aside.
+    path = ZONE_SNAPSHOT_FILE % options.zonename
+    kept = os.path.join(directory, 'kept.sqlite')
+    if os.path.exists(path):
+        shutil.move(path, kept)
+    try:
+        print "Starting %s %d times each way:" % (options.zonename, options.repeat)
+        report("insert_objects", [start_zone(directory) for i in xrange(options.repeat)])
+
+        start = time.time()
+        count = zonesnapshot.build(options.zonename, path)
+        print "  (built a snapshot of %d objects in %.3fs)" % (count, time.time() - start)
+        report("snapshot", [start_zone(directory) for i in xrange(options.repeat)])
+
+        inserted, copied = load_zone(directory)
+        print "Loading a zone of %d barrels:" % options.objects
+        print "  %-24s %7.3fs" % ("insert_objects", inserted)
+        print "  %-24s %7.3fs" % ("snapshot", copied)
+    finally:
+        if os.path.exists(kept):
+            shutil.move(kept, path)
+        elif os.path.exists(path):
+            os.remove(path)
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -65,6 +65,7 @@ import logging
 logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.ERROR)
 
 import settings
+from wireformat import PACKED_CONTENT_TYPE, MAGIC, unpack_objects, unpack_messages
 
 
 class ClientError(Exception):
@@ -105,12 +106,53 @@ def json_or_exception(response, message='Got an unexpected response.'):
         raise UnexpectedHTTPStatus(message, response.status_code, response.content)
 
 
+class ZoneStream(object):
+    '''A WebSocket connection to a zone server's /stream.
+    Movement goes up it, and the zone pushes object changes down it every
+    tick, so there's no need to poll /objects.
+    Reads block, so it fits in with the rest of this synchronous client.'''
+
+    def __init__(self, zone, cookies=None, timeout=settings.CLIENT_TIMEOUT):
+        from tornado.ioloop import IOLoop
+        from tornado.httpclient import HTTPRequest
+        from tornado.websocket import websocket_connect
+
+        url = zone.replace('http', 'ws', 1) + '/stream'
+        cookie = '; '.join('%s=%s' % (k, v) for k, v in (cookies or {}).items())
+        request = HTTPRequest(url, headers={'Cookie': cookie}, request_timeout=timeout)
+
+        # A loop of our own, so we can run it just long enough to get a message.
+        self.ioloop = IOLoop()
+        try:
+            self.connection = self.ioloop.run_sync(lambda: websocket_connect(request), timeout=timeout)
+        except Exception, exc:
+            raise ConnectionError("Could not open a stream to %s: %s" % (url, exc))
+
+    def send(self, **command):
+        self.connection.write_message(json.dumps(command))
+
+    def receive(self, timeout=None):
+        '''Wait for the next message from the zone and return it decoded.'''
+        message = self.ioloop.run_sync(self.connection.read_message, timeout=timeout)
+        if message is None:
+            raise ConnectionError("The zone closed the stream.")
+        if message[:len(MAGIC)] == MAGIC:
+            return unpack_objects(message)
+        return json.loads(message)
+
+    def close(self):
+        self.connection.close()
+        self.ioloop.close()
+
+
 class Character(object):
     _online_states = {'online': True, 'offline': False}
 
     def __init__(self, name):
         self.name = name
         self.zone = None
+        # The last movement step sent to the zone in a batch.
+        self.movement_seq = 0
 
         self._online = False
 
@@ -129,19 +171,22 @@ class Character(object):
 
 
 class Client(object):
-    def __init__(self, username=None, password=None):
+    def __init__(self, username=None, password=None, packed=False):
         self.init_logging()
 
+        # Ask zones for objects in the compact binary format instead of JSON.
+        self.packed = packed
+
         self.characters = {}
         self.last_character = None
 
         self.last_zone = None
         self.zones = {}
 
-        self.last_object_update = datetime.datetime(2010, 1, 1)
+        self.last_object_seq = 0
         self.objects = {}
 
-        self.last_message_update = datetime.datetime(2010, 1, 1)
+        self.last_message_seq = 0
         self.messages = {}
 
         self.last_user = None
@@ -305,7 +350,10 @@ class Client(object):
         else:
             raise UnexpectedHTTPStatus("MasterZoneServer", r.status_code, r.content)
 
-    def get_objects(self, zone=None):
+    def get_objects(self, zone=None, character=None):
+        '''Get the objects that changed since our last update.
+        If character is given, only objects near that character are sent,
+        and objects that wander out of its view are dropped.'''
         if zone is None:
             zone = self.get_zone_url()
 
@@ -314,20 +362,71 @@ class Client(object):
             zone = self.zones.get(zone)
 
 
-        data = {"since": self.last_object_update.strftime(settings.DATETIME_FORMAT)}
-        r = self.get(zone, '/objects', cookies=self.cookies, params=data)
+        data = {"after": self.last_object_seq}
+        if character is not None:
+            data['character'] = character
+        headers = {'Accept': PACKED_CONTENT_TYPE} if self.packed else {}
+        r = self.get(zone, '/objects', cookies=self.cookies, params=data, headers=headers)
 
         if r.status_code == 200:
-            objects = json.loads(r.content)
+            if r.headers.get('Content-Type') == PACKED_CONTENT_TYPE:
+                result = unpack_objects(r.content)
+            else:
+                result = json.loads(r.content)
+            for objid in result.get('left', []):
+                self.objects.pop(objid, None)
+            objects = result['objects']
             self.info("Got %d objects."%len(objects))
             for obj in objects:
                 self.objects[obj['id']] = obj
         else:
             raise UnexpectedHTTPStatus("ZoneServer %s" % zone, r.status_code, r.content)
 
-        self.last_object_update = datetime.datetime.now()
+        # Next time, only ask for what changed after what we just got.
+        self.last_object_seq = result['seq']
         return objects
 
+    def open_stream(self, zone=None):
+        '''Open a WebSocket to the zone and subscribe to its object changes.
+        Feed it to update_from_stream() to keep self.objects current.'''
+        if zone is None:
+            zone = self.get_zone_url()
+
+        if "http://" not in zone:
+            # zone is probably a zoneid
+            zone = self.zones.get(zone)
+
+        stream = ZoneStream(zone, cookies=self.cookies)
+        if self.packed:
+            stream.send(command='sub', format='packed')
+        else:
+            stream.send(command='sub')
+        return stream
+
+    def update_from_stream(self, stream, timeout=None):
+        '''Apply the next batch of object changes pushed by the zone.
+        Returns the objects that changed.'''
+        result = stream.receive(timeout=timeout)
+        while 'objects' not in result:
+            # Skip replies to our own commands, like movement.
+            result = stream.receive(timeout=timeout)
+
+        objects = result['objects']
+        for obj in objects:
+            self.objects[obj['id']] = obj
+        self.last_object_seq = result['seq']
+        return objects
+
+    def stream_movement(self, stream, character=None, xmod=0, ymod=0, zmod=0):
+        '''Send a movement command over a stream instead of POSTing it.
+        The result shows up in the object changes pushed back.'''
+        char = self.get_char_obj(character_name=character)
+
+        if char.online != True:
+            raise ClientError("Cannot move character, not online: %s" % char.online)
+
+        stream.send(command='mov', char=char.name, x=xmod, y=ymod, z=zmod)
+
     def get_messages(self, zone=None):
         '''Get messages from the zone only.
         In the future, get game-wide messages.'''
@@ -338,18 +437,22 @@ class Client(object):
             # zone is probably a zoneid
             zone = self.zones.get(zone)
 
-        data = {"since": self.last_message_update.strftime(settings.DATETIME_FORMAT)}
-        r = self.get(zone, '/messages', cookies=self.cookies, params=data)
+        data = {"after": self.last_message_seq}
+        headers = {'Accept': PACKED_CONTENT_TYPE} if self.packed else {}
+        r = self.get(zone, '/messages', cookies=self.cookies, params=data, headers=headers)
 
         if r.status_code == 200:
-            messages = json.loads(r.content)
+            if r.headers.get('Content-Type') == PACKED_CONTENT_TYPE:
+                result = unpack_messages(r.content)
+            else:
+                result = json.loads(r.content)
+            messages = result['messages']
             for msg in messages:
-                msgid = msg.get('_id', {}).get('$oid')
-                self.messages[msgid] = msg
+                self.messages[msg['id']] = msg
         else:
             raise UnexpectedHTTPStatus("ZoneServer %s" % zone, r.status_code, r.content)
 
-        self.last_message_update = datetime.datetime.now()
+        self.last_message_seq = result['seq']
         return messages
 
     def set_character_status(self, character, status='online'):
@@ -364,6 +467,9 @@ class Client(object):
             result = json_or_exception(r)
             if result is True:
                 char.online = status
+                if status == 'offline':
+                    # The zone starts counting movement steps over.
+                    char.movement_seq = 0
                 return True
             elif result is False:
                 raise ClientError('Setting status %s failed.' % status)
@@ -386,6 +492,35 @@ class Client(object):
             # Could not move. Probably due to collision.
             return content
 
+    def move_character_steps(self, character=None, steps=()):
+        '''Send a batch of (xmod, ymod, zmod) movement steps in one request.
+        Returns the zone's reply: the last step it acknowledged, the steps
+        that were blocked, and where the character ended up.'''
+        char = self.get_char_obj(character_name=character)
+
+        if char.online != True:
+            raise ClientError("Cannot move character, not online: %s" % char.online)
+
+        steps = list(steps)
+        reply = self._post_steps(char, steps)
+        if reply['ack'] > char.movement_seq:
+            # The zone's numbering is ahead of ours, so it dropped these
+            # steps as ones it had already seen. Carry on from its
+            # numbering and send them again.
+            char.movement_seq = reply['ack']
+            reply = self._post_steps(char, steps)
+        return reply
+
+    def _post_steps(self, char, steps):
+        batch = []
+        for xmod, ymod, zmod in steps:
+            char.movement_seq += 1
+            batch.append({'seq': char.movement_seq, 'x': xmod, 'y': ymod, 'z': zmod})
+
+        data = {'character': char.name, 'steps': json.dumps(batch)}
+        r = self.post(self.get_zone_url(char.zone), '/movement', cookies=self.cookies, data=data)
+        return json_or_exception(r)
+
     def get_char_obj(self, character_name):
         if not character_name:
             # No character passed, grab the first one.
@@ -23,13 +23,28 @@
 from peewee import *
 from playhouse.sqlite_ext import SqliteExtDatabase, JSONField
 from playhouse.shortcuts import model_to_dict, RetryOperationalError
+from playhouse.migrate import SqliteMigrator, migrate
 
 import datetime
+from collections import deque
+
+from settings import SPATIAL_CELL_SIZE, MESSAGE_BUFFER_SIZE, SQLITE_PRAGMAS
+from spatialgrid import SpatialGrid
+from wireformat import pack_object
 
 class RetryDB(RetryOperationalError, SqliteExtDatabase):
     pass
 
-db = RetryDB(None, fields={'json':'json'})
+# SqliteDatabase applies the pragmas to every new connection.
+db = RetryDB(None, pragmas=list(SQLITE_PRAGMAS), fields={'json':'json'})
+
+# SQLite allows at most 999 variables in one statement, so lists of ids
+# get looked up in chunks no bigger than this.
+MAX_QUERY_IDS = 900
+
+def id_chunks(ids):
+    '''Split a list of ids into lists of at most MAX_QUERY_IDS.'''
+    return [ids[i:i+MAX_QUERY_IDS] for i in xrange(0, len(ids), MAX_QUERY_IDS)]
 
 import json 
 class ComplexEncoder(json.JSONEncoder):
@@ -57,6 +72,55 @@ class BaseModel(Model):
     def json_dumps(self):
         return json.dumps(model_to_dict(self), cls=ComplexEncoder)
 
+class Sequence(BaseModel):
+    '''The last number each named counter (like a table's change_seq) has
+    handed out. It's kept apart from the rows it numbers, so deleting the
+    row with the highest number never hands that number out again.'''
+
+    name = CharField(primary_key=True)
+    value = IntegerField(default=0)
+
+    @classmethod
+    def advance(cls, name, count=1):
+        '''Hand out the next count numbers, returning the highest of them.
+        Bumping the counter holds the database's write lock until the caller's
+        transaction commits, so the ZoneServer and ScriptServer writing the
+        same database never hand out the same number, and sequence order
+        matches commit order.'''
+        with cls._meta.database.atomic():
+            if not cls.update(value=cls.value + count).where(cls.name == name).execute():
+                cls.insert(name=name, value=count).execute()
+            return cls.current(name)
+
+    @classmethod
+    def current(cls, name):
+        '''The highest number handed out so far.'''
+        return cls.select(cls.value).where(cls.name == name).scalar() or 0
+
+class SequencedModel(BaseModel):
+    '''A model whose rows get a new, monotonically increasing change_seq
+    every time they are saved. Clients ask for "changes after N" with
+    it instead of comparing datetimes from clocks that may disagree.'''
+
+    change_seq = IntegerField(default=0, index=True)
+
+    @classmethod
+    def next_change_seq(cls, count=1):
+        '''Hand out the table's next count change_seqs, returning the
+        highest. Call it in the same transaction as the write using them.'''
+        return Sequence.advance(cls._meta.db_table, count)
+
+    @classmethod
+    def max_change_seq(cls):
+        '''The highest change_seq handed out so far. This is the high-water
+        mark to give clients along with the changes up to it.'''
+        return Sequence.current(cls._meta.db_table)
+
+    def save(self, *args, **kwargs):
+        with self._meta.database.atomic():
+            self.change_seq = type(self).next_change_seq()
+            return super(SequencedModel, self).save(*args, **kwargs)
+
 class User(BaseModel):
     '''User contains details useful for authenticating a user for when they
     initially log in.'''
@@ -104,7 +168,7 @@ class Message(BaseModel):
     channel = IntegerField(null=True, default=0)
     body = CharField(null=True, default=u'')
 
-class Object(BaseModel):
+class Object(SequencedModel):
     '''In-world objects.'''
 
     name = CharField()
@@ -128,11 +192,20 @@ class Object(BaseModel):
     vel_y = FloatField(default=0)
     vel_z = FloatField(default=0)
 
-    states = JSONField(default=[])
+    states = JSONField(default=list)
     physical = BooleanField(default=True)
     last_modified = DateTimeField(default=datetime.datetime.now)
 
-    scripts = JSONField(default=[])
+    scripts = JSONField(default=list)
+
+    class Meta:
+        indexes = (
+            # get_objects(since=...) and every get_objects ordering.
+            (('last_modified',), False),
+            # Looking things up by name, like characters and basezone's
+            # "Loading Complete." marker, already in get_objects' order.
+            (('name', 'last_modified'), False),
+        )
 
     @property
     def loc(self):
@@ -142,17 +215,240 @@ class Object(BaseModel):
     def loc(self, val):
         self.loc_x, self.loc_y, self.loc_z = val
 
+    def prepared(self):
+        # A row read from the database already has ObjectState rows for
+        # its states, so save_states() needn't write them again.
+        if 'states' in self._data:
+            self._saved_states = tuple(self.states or ())
+
     def set_modified(self, date_time=None):
+        '''Note that this object changed. If the zone's state is loaded,
+        it's written out with the next flush instead of right now.'''
         if date_time is None:
             date_time = datetime.datetime.now()
         self.last_modified = date_time
-        self.save()
+        if zone_state.loaded and self.id is not None:
+            zone_state.mark_dirty(self)
+        else:
+            self.save()
+
+    def save(self, *args, **kwargs):
+        result = super(Object, self).save(*args, **kwargs)
+        self.save_states()
+        object_grid.track(self)
+        if zone_state.loaded:
+            zone_state.track(self)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        object_grid.remove(self.id)
+        object_fragments.remove(self.id)
+        zone_state.remove(self.id)
+        with Object._meta.database.atomic():
+            ObjectState.delete().where(ObjectState.obj == self.id).execute()
+            # Leave word for the other processes sharing the database.
+            Tombstone.create(obj=self.id, change_seq=Object.next_change_seq())
+            return super(Object, self).delete_instance(*args, **kwargs)
+
+    def save_states(self):
+        '''Make this object's ObjectState rows match its states, if they
+        have changed since this instance last wrote them.'''
+        states = tuple(self.states or ())
+        if getattr(self, '_saved_states', None) == states:
+            return
+        with Object._meta.database.atomic():
+            ObjectState.delete().where(ObjectState.obj == self.id).execute()
+            if states:
+                ObjectState.insert_many([{'obj': self.id, 'state': state}
+                                         for state in set(states)]).execute()
+        self._saved_states = states
+
+    @classmethod
+    def bulk_create(cls, objects):
+        '''Insert a lot of new, unsaved objects at once, like a zone's
+        content the first time it starts. They're all written with one prepared
+        INSERT in one transaction instead of a save() (and a commit) each,
+        and get their ids and change_seqs filled in.
+
+        The ids are handed out from the highest one when this starts, so
+        nothing else should be creating objects at the same time.'''
+        objects = list(objects)
+        if not objects:
+            return objects
+
+        fields = cls._meta.sorted_fields
+        db = cls._meta.database
+        quote = db.compiler().quote
+        # One statement handed every row, so the per-row work happens in
+        # sqlite3 rather than in building a query for each batch.
+        insert = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            quote(cls._meta.db_table),
+            ', '.join(quote(f.db_column) for f in fields),
+            ', '.join([db.interpolation] * len(fields)))
+        insert_state = cls._states_sql()[1]
+
+        with db.atomic():
+            objid = cls.select(fn.COALESCE(fn.MAX(cls.id), 0)).scalar()
+            seq = cls.next_change_seq(len(objects)) - len(objects)
+            for obj in objects:
+                objid += 1
+                seq += 1
+                obj.id, obj.change_seq = objid, seq
+
+            cursor = db.get_cursor()
+            cursor.executemany(insert, ([f.db_value(obj._data.get(f.name)) for f in fields]
+                                        for obj in objects))
+            cursor.executemany(insert_state, ((obj.id, state, obj.id) for obj in objects
+                                              for state in set(obj.states or ())))
+
+        for obj in objects:
+            obj._saved_states = tuple(obj.states or ())
+            object_grid.track(obj)
+        if zone_state.loaded:
+            zone_state.sync()
+        return objects
+
+    @classmethod
+    def update_many(cls, objects):
+        '''Write out a lot of objects that are already saved at once, like
+        a ZoneState flush. They're all written with one prepared UPDATE in
+        one transaction, and their ObjectState rows are only rewritten
+        if their states have changed. Each gets a new change_seq.'''
+        objects = list(objects)
+        if not objects:
+            return objects
+
+        fields = [f for f in cls._meta.sorted_fields if f.name != 'id']
+        db = cls._meta.database
+        quote = db.compiler().quote
+        update = 'UPDATE %s SET %s WHERE %s = %s' % (
+            quote(cls._meta.db_table),
+            ', '.join('%s = %s' % (quote(f.db_column), db.interpolation) for f in fields),
+            quote(cls.id.db_column), db.interpolation)
+        delete_state, insert_state = cls._states_sql()
+        changed = [obj for obj in objects
+                   if getattr(obj, '_saved_states', None) != tuple(obj.states or ())]
+
+        with db.atomic():
+            seq = cls.next_change_seq(len(objects)) - len(objects)
+            for obj in objects:
+                seq += 1
+                obj.change_seq = seq
+
+            cursor = db.get_cursor()
+            cursor.executemany(update, ([f.db_value(obj._data.get(f.name)) for f in fields] + [obj.id]
+                                        for obj in objects))
+            cursor.executemany(delete_state, ((obj.id,) for obj in changed))
+            cursor.executemany(insert_state, ((obj.id, state, obj.id) for obj in changed
+                                              for state in set(obj.states or ())))
+
+        for obj in changed:
+            obj._saved_states = tuple(obj.states or ())
+        return objects
 
     @staticmethod
-    def get_objects(since=None, physical=None, limit=None, player=None, scripted=None, name=None):
+    def _states_sql():
+        '''The statements deleting an object's ObjectState rows, taking
+        (id,), and inserting one, taking (id, state, id), for handing to
+        executemany. The insert does nothing if the object has been deleted.'''
+        db = ObjectState._meta.database
+        quote = db.compiler().quote
+        table = quote(ObjectState._meta.db_table)
+        obj, state = quote(ObjectState.obj.db_column), quote(ObjectState.state.db_column)
+        return ('DELETE FROM %s WHERE %s = %s' % (table, obj, db.interpolation),
+                'INSERT INTO %s (%s, %s) SELECT %s, %s WHERE EXISTS (SELECT 1 FROM %s WHERE %s = %s)' % (
+                    table, obj, state, db.interpolation, db.interpolation,
+                    quote(Object._meta.db_table), quote(Object.id.db_column), db.interpolation))
+
+    @staticmethod
+    def in_state(state):
+        '''A subquery of the ids of every object in the given state.'''
+        return ObjectState.select(ObjectState.obj).where(ObjectState.state == state)
+
+    @classmethod
+    def max_change_seq(cls):
+        '''The highest change_seq handed out so far, or if the zone's state
+        is loaded, the highest one it has caught up to.'''
+        if zone_state.loaded:
+            return zone_state.synced
+        return super(Object, cls).max_change_seq()
+
+    @staticmethod
+    def get_nearby(loc_x, loc_y, radius, physical=None, exclude=None, sync=True):
+        '''Gets the objects strictly closer than radius (in manhattan distance)
+        to the given location, looking only at the nearby cells of the zone's
+        spatial grid instead of the whole table.
+        Pass sync=False if the grid was already synced recently, like once
+        per tick in the ScriptServer. If the zone's state is loaded, these
+        are its in-memory objects.'''
+        ids = Object.get_nearby_ids(loc_x, loc_y, radius, physical=physical, exclude=exclude, sync=sync)
+        return Object.get_objects(ids=ids)
+
+    @staticmethod
+    def get_nearby_ids(loc_x, loc_y, radius, physical=None, exclude=None, sync=True):
+        # A loaded zone state keeps the grid up to date by itself.
+        if sync and not zone_state.loaded:
+            object_grid.sync()
+
+        where = None
+        if physical is not None:
+            where = lambda is_physical: is_physical == physical
+
+        ids = object_grid.query(loc_x, loc_y, radius, where=where)
+        if exclude is not None:
+            ids = [i for i in ids if i != exclude]
+        return ids
+
+    @staticmethod
+    def collides(loc_x, loc_y, radius, exclude=None, sync=True):
+        '''Is there a physical object (other than the one with id exclude)
+        strictly closer than radius to the given location?'''
+        return bool(Object.get_nearby_ids(loc_x, loc_y, radius, physical=True, exclude=exclude, sync=sync))
+
+    @staticmethod
+    def get_objects(since=None, physical=None, limit=None, player=None, scripted=None, name=None, ids=None,
+                    after=None, upto=None, states=None):
+        '''The objects matching every filter given. states is a list of
+        states (like 'hidden' or 'online') the objects must all be in.'''
+        if zone_state.loaded:
+            return zone_state.get_objects(since=since, physical=physical, limit=limit, player=player,
+                                          scripted=scripted, name=name, ids=ids, after=after, upto=upto,
+                                          states=states)
+
         # TODO: Needs integration test.
         obj = Object.select()
 
+        if after is not None:
+            obj = obj.where(Object.change_seq>after)
+
+        if upto is not None:
+            obj = obj.where(Object.change_seq<=upto)
+
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return []
+            if len(ids) > MAX_QUERY_IDS:
+                # Too many ids for one statement, so look them up a chunk
+                # at a time and sort and limit them all here instead.
+                objects = []
+                for chunk in id_chunks(ids):
+                    objects.extend(Object.get_objects(since=since, physical=physical, player=player,
+                                                      scripted=scripted, name=name, ids=chunk, after=after,
+                                                      upto=upto, states=states))
+                if after is not None or upto is not None:
+                    objects.sort(key=lambda o: o.change_seq)
+                else:
+                    objects.sort(key=lambda o: o.last_modified, reverse=True)
+                if limit == 1:
+                    if not objects:
+                        raise Object.DoesNotExist("No object matches.")
+                    return objects[0]
+                if limit is not None:
+                    objects = objects[:limit]
+                return objects
+            obj = obj.where(Object.id << ids)
+
         if since is not None:
             obj = obj.where(Object.last_modified>=since)
 
@@ -160,7 +456,10 @@ class Object(BaseModel):
             obj = obj.where(Object.physical==physical)
 
         if player is not None:
-            obj = obj.where(Object.states.contains('player')).where(Object.name==player)
+            obj = obj.where(Object.id << Object.in_state('player')).where(Object.name==player)
+
+        for state in states or ():
+            obj = obj.where(Object.id << Object.in_state(state))
 
         if scripted is not None:
             obj = obj.where(Object.scripts!=None) # TODO: Have this only return objects with scripts.
@@ -168,33 +467,572 @@ class Object(BaseModel):
         if name is not None:
             obj = obj.where(Object.name==name)
 
-        obj = obj.order_by(Object.last_modified.desc())
+        if after is not None or upto is not None:
+            # Changes come out in the order they were made, which also lets
+            # SQLite use the change_seq index for the sort.
+            obj = obj.order_by(Object.change_seq)
+        else:
+            obj = obj.order_by(Object.last_modified.desc())
 
         if limit is not None:
             obj = obj.limit(limit)
 
         if limit == 1:
-            return obj
+            return obj.get()
 
         return [o for o in obj]
 
-class Message(BaseModel):
+class Message(SequencedModel):
     message = CharField()
     sender = CharField()
     loc_x = FloatField()
     loc_y = FloatField()
     loc_z = FloatField(default=0)
     player_generated = BooleanField()
+    sent = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            # For finding the oldest non-player messages to prune.
+            (('player_generated', 'sent'), False),
+        )
+
+    @staticmethod
+    def prune(keep):
+        '''Delete all but the newest keep non-player messages, in one
+        statement. Returns how many were deleted.'''
+        # The oldest message we're keeping, found by walking the
+        # (player_generated, sent) index backwards.
+        oldest = (Message.select(Message.sent, Message.id)
+                         .where(Message.player_generated == False)
+                         .order_by(Message.sent.desc(), Message.id.desc())
+                         .offset(keep - 1)
+                         .limit(1)
+                         .first()) if keep > 0 else None
+        query = Message.delete().where(Message.player_generated == False)
+        if oldest is not None:
+            query = query.where((Message.sent < oldest.sent) |
+                                ((Message.sent == oldest.sent) & (Message.id < oldest.id)))
+        elif keep > 0:
+            # There aren't even keep of them.
+            return 0
+        return query.execute()
 
 class ScriptedObject(Object):
     pass
 
-def setup(db_uri='simplemmo.sqlite', echo=False):
+class ObjectState(BaseModel):
+    '''One row for each state an Object is in, kept in step with its
+    states list when it's saved, so finding the objects in a state is an
+    index lookup instead of a scan of every object's states.'''
+    obj = ForeignKeyField(Object, related_name='state_rows')
+    state = CharField()
+
+    class Meta:
+        indexes = (
+            (('state', 'obj'), True),
+        )
+
+class Tombstone(BaseModel):
+    '''An object that was deleted, at the change_seq it was deleted at,
+    so the other processes syncing by change_seq find out about it.'''
+    obj = IntegerField()
+    change_seq = IntegerField(index=True)
+
+    @classmethod
+    def since(cls, seq):
+        '''(object id, change_seq) for each object deleted after seq.'''
+        return list(cls.select(cls.obj, cls.change_seq).where(cls.change_seq > seq).tuples())
+
+class ObjectGrid(SpatialGrid):
+    '''A SpatialGrid of every Object in the zone, keyed by id, with whether
+    it is physical as its data.
+
+    Objects saved by this process are re-indexed as they are written.
+    sync() picks up rows other processes (like the ScriptServer) have written
+    to the database since the last sync, by change_seq, so only changed rows
+    are read, and forgets the objects they have deleted since.'''
+
+    def __init__(self, *args, **kwargs):
+        super(ObjectGrid, self).__init__(*args, **kwargs)
+        self.synced = 0
+
+    def track(self, obj):
+        self.insert(obj.id, obj.loc_x, obj.loc_y, obj.physical)
+
+    def clear(self):
+        super(ObjectGrid, self).clear()
+        self.synced = 0
+
+    def sync(self):
+        '''Index every object changed since the last sync, and drop the
+        ones deleted since.'''
+        query = (Object.select(Object.id, Object.loc_x, Object.loc_y,
+                               Object.physical, Object.change_seq)
+                       .where(Object.change_seq > self.synced))
+        # Both in one read, so nothing's deleted between them.
+        with Object._meta.database.atomic():
+            changed = list(query)
+            deleted = Tombstone.since(self.synced)
+
+        for o in changed:
+            self.track(o)
+            self.synced = max(self.synced, o.change_seq)
+        # A row that's still there was written after any tombstone for its id.
+        live = set(o.id for o in changed)
+        for objid, change_seq in deleted:
+            if objid not in live:
+                self.remove(objid)
+            self.synced = max(self.synced, change_seq)
+
+object_grid = ObjectGrid(cell_size=SPATIAL_CELL_SIZE)
+
+class ZoneState(object):
+    '''The live objects in this zone, held in memory as the source of truth
+    once load()ed. Reads and collision checks are answered from memory.
+    set_modified() only marks an object dirty, and flush() writes all the
+    dirty objects out in one transaction, so something moving every tick
+    doesn't cost a database write every tick.
+
+    Other processes (the ZoneServer and ScriptServer each have one of these)
+    still share the database, so flush() also picks up the rows they have
+    written since the last one, by change_seq, and forgets the objects they
+    have deleted. If both change the same object between flushes, the one
+    flushing last wins.'''
+
+    def __init__(self):
+        self.objects = {}
+        self.dirty = set()
+        self.reset_indexes()
+        self.synced = 0
+        self.loaded = False
+
+    def reset_indexes(self):
+        # Looking objects up by name, characters up by player name, and
+        # who's online, without going through the whole zone.
+        self.names = {}
+        self.players = {}
+        self.online = set()
+        # object id: the name it's indexed under
+        self.indexed = {}
+
+    def load(self):
+        '''Read every object in the zone into memory.'''
+        self.objects = {}
+        self.dirty = set()
+        self.reset_indexes()
+        self.synced = 0
+        object_grid.clear()
+        self.loaded = True
+        self.sync()
+
+    def unload(self):
+        '''Go back to using the database directly. Anything still dirty
+        is thrown away, so flush() first to keep it.'''
+        self.loaded = False
+        self.objects = {}
+        self.dirty = set()
+        self.reset_indexes()
+        self.synced = 0
+
+    def track(self, obj):
+        '''Make the in-memory copy of obj match it.
+        Anybody holding the in-memory instance keeps holding it.'''
+        current = self.objects.get(obj.id)
+        if current is None:
+            self.objects[obj.id] = current = obj
+        elif current is not obj:
+            current._data.update(obj._data)
+            # Whatever obj knows about its ObjectState rows is newer.
+            current._saved_states = getattr(obj, '_saved_states', None)
+        self.index(current)
+        object_grid.track(current)
+        return current
+
+    def index(self, obj):
+        '''File obj under its current name and states.'''
+        self.unindex(obj.id)
+        states = obj.states or ()
+        self.indexed[obj.id] = obj.name
+        self.names.setdefault(obj.name, set()).add(obj.id)
+        if 'player' in states:
+            self.players[obj.name] = obj.id
+        if 'online' in states:
+            self.online.add(obj.id)
+
+    def unindex(self, objid):
+        if objid in self.indexed:
+            name = self.indexed.pop(objid)
+            ids = self.names[name]
+            ids.discard(objid)
+            if not ids:
+                del self.names[name]
+            if self.players.get(name) == objid:
+                del self.players[name]
+        self.online.discard(objid)
+
+    def mark_dirty(self, obj):
+        '''Remember to write obj out with the next flush.'''
+        obj = self.track(obj)
+        self.dirty.add(obj.id)
+
+    def remove(self, objid):
+        self.objects.pop(objid, None)
+        self.dirty.discard(objid)
+        self.unindex(objid)
+
+    def flush(self):
+        '''Write every dirty object out in one transaction, then catch up
+        on everything else that was written since the last flush.'''
+        dirty, self.dirty = self.dirty, set()
+        if dirty:
+            try:
+                Object.update_many(self.objects[objid] for objid in dirty if objid in self.objects)
+            except Exception:
+                # Try again next time.
+                self.dirty |= dirty
+                raise
+        self.sync()
+        return len(dirty)
+
+    def sync(self):
+        '''Read in the rows written since the last sync, and forget the
+        objects deleted since. Objects that are dirty here are left alone,
+        since the next flush overwrites them.'''
+        # Both in one read, so nothing's deleted between them.
+        with Object._meta.database.atomic():
+            changed = list(Object.select().where(Object.change_seq > self.synced))
+            deleted = Tombstone.since(self.synced)
+
+        for o in changed:
+            if o.id not in self.dirty:
+                self.track(o)
+            self.synced = max(self.synced, o.change_seq)
+        # A row that's still there was written after any tombstone for its id.
+        live = set(o.id for o in changed)
+        for objid, change_seq in deleted:
+            if objid not in live:
+                self.remove(objid)
+                object_grid.remove(objid)
+                object_fragments.remove(objid)
+            self.synced = max(self.synced, change_seq)
+        object_grid.synced = self.synced
+
+    def get_objects(self, since=None, physical=None, limit=None, player=None, scripted=None, name=None,
+                    ids=None, after=None, upto=None, states=None):
+        '''Object.get_objects, from memory.'''
+        # Start from the fewest objects any of the indexes allow.
+        narrowed = []
+        if player is not None:
+            narrowed.append([self.players[player]] if player in self.players else [])
+        if name is not None:
+            narrowed.append(self.names.get(name, ()))
+        if states and 'online' in states:
+            narrowed.append(self.online)
+        if ids is not None:
+            narrowed.append(ids)
+        if narrowed:
+            narrowed.sort(key=len)
+            ids = set(narrowed[0]).intersection(*narrowed[1:])
+        if ids is not None:
+            objects = [self.objects[i] for i in ids if i in self.objects]
+        else:
+            objects = self.objects.values()
+
+        if after is not None:
+            objects = [o for o in objects if o.change_seq > after]
+        if upto is not None:
+            objects = [o for o in objects if o.change_seq <= upto]
+        if since is not None:
+            objects = [o for o in objects if o.last_modified >= since]
+        if physical is not None:
+            objects = [o for o in objects if o.physical == physical]
+        if player is not None:
+            objects = [o for o in objects if o.name == player and 'player' in o.states]
+        for state in states or ():
+            objects = [o for o in objects if state in o.states]
+        if scripted is not None:
+            objects = [o for o in objects if o.scripts]
+        if name is not None:
+            objects = [o for o in objects if o.name == name]
+
+        if limit == 1:
+            # Just the first, without sorting the lot.
+            if not objects:
+                raise Object.DoesNotExist("No such object in the zone.")
+            if after is not None or upto is not None:
+                return min(objects, key=lambda o: o.change_seq)
+            return max(objects, key=lambda o: o.last_modified)
+
+        if after is not None or upto is not None:
+            objects.sort(key=lambda o: o.change_seq)
+        else:
+            objects.sort(key=lambda o: o.last_modified, reverse=True)
+
+        if limit is not None:
+            objects = objects[:limit]
+        return objects
+
+zone_state = ZoneState()
+
+class MessageBuffer(object):
+    '''The zone's most recent messages, held in memory once load()ed.
+    Clients poll it with get_messages(after=seq) without touching the
+    database, and it never holds more than size messages.
+
+    Messages said with add() are saved in one transaction at the next
+    flush(), which also reads in what other processes have saved since
+    the last one. Until then they aren't handed out, since they don't
+    have a change_seq yet.'''
+
+    def __init__(self, size=MESSAGE_BUFFER_SIZE):
+        self.size = size
+        self.messages = deque(maxlen=size)
+        self.pending = []
+        self.synced = 0
+        self.loaded = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    def load(self):
+        '''Read the zone's latest messages into memory.'''
+        self.messages = deque(maxlen=self.size)
+        self.pending = []
+        latest = Message.select().order_by(Message.change_seq.desc()).limit(self.size)
+        for m in reversed(list(latest)):
+            self.messages.append(m)
+        self.synced = self.messages[-1].change_seq if self.messages else 0
+        self.loaded = True
+
+    def unload(self):
+        '''Go back to saving messages straight away. Anything not flushed
+        is thrown away.'''
+        self.loaded = False
+        self.messages = deque(maxlen=self.size)
+        self.pending = []
+        self.synced = 0
+
+    def add(self, message):
+        '''Save message with the next flush, or right now if the buffer
+        isn't loaded.'''
+        if self.loaded:
+            self.pending.append(message)
+        else:
+            message.save()
+
+    def flush(self):
+        '''Save every pending message in one transaction, then read in
+        everything saved since the last flush.'''
+        pending, self.pending = self.pending, []
+        if pending:
+            try:
+                with Message._meta.database.atomic():
+                    for message in pending:
+                        message.save()
+            except Exception:
+                self.pending = pending + self.pending
+                raise
+        self.sync()
+        return len(pending)
+
+    def sync(self):
+        query = (Message.select().where(Message.change_seq > self.synced)
+                                 .order_by(Message.change_seq))
+        for m in query:
+            self.messages.append(m)
+            self.synced = m.change_seq
+
+    def get_messages(self, after=0):
+        '''The buffered messages with a change_seq after the given one, oldest
+        first. Anything older than the buffer has been forgotten.'''
+        if self.messages and self.messages[0].change_seq > after:
+            return list(self.messages)
+        return [m for m in self.messages if m.change_seq > after]
+
+message_buffer = MessageBuffer()
+
+class FragmentCache(object):
+    '''Each object's JSON and packed encodings, as of its change_seq.
+    Responses are built by joining these, so only objects that have been
+    saved since they were last sent get encoded again.'''
+
+    JSON, PACKED = 1, 2
+
+    def __init__(self):
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, obj, packed=False):
+        '''Gets obj encoded as JSON, or packed, encoding it if it has
+        changed since the last time.'''
+        entry = self.entries.get(obj.id)
+        if entry is None or entry[0] != obj.change_seq:
+            entry = self.entries[obj.id] = [obj.change_seq, None, None]
+
+        index = self.PACKED if packed else self.JSON
+        fragment = entry[index]
+        if fragment is None:
+            fragment = entry[index] = pack_object(obj) if packed else obj.json_dumps()
+        return fragment
+
+    def remove(self, objid):
+        self.entries.pop(objid, None)
+
+    def clear(self):
+        self.entries = {}
+
+object_fragments = FragmentCache()
+
+def _columns(table):
+    return [c.name for c in db.get_columns(table)]
+
+def _indexes(table):
+    return [i.name for i in db.get_indexes(table)]
+
+def _add_change_seq(migrator):
+    for model in (Message, Object):
+        table = model._meta.db_table
+        if 'change_seq' not in _columns(table):
+            migrate(migrator.add_column(table, 'change_seq', model.change_seq),
+                    migrator.add_index(table, ('change_seq',)))
+
+def _add_message_sent(migrator):
+    if 'sent' not in _columns('message'):
+        migrate(migrator.add_column('message', 'sent', Message.sent))
+    if 'message_player_generated_sent' not in _indexes('message'):
+        migrate(migrator.add_index('message', ('player_generated', 'sent')))
+
+def _add_object_indexes(migrator):
+    existing = _indexes('object')
+    for columns, unique in Object._meta.indexes:
+        if '_'.join(('object',) + tuple(columns)) not in existing:
+            migrate(migrator.add_index('object', columns, unique))
+
+def _add_object_states(migrator):
+    '''Fill in ObjectState from the states every existing object has.'''
+    ObjectState.create_table(True)
+    if ObjectState.select().exists():
+        return
+    with db.atomic():
+        for o in Object.select(Object.id, Object.states):
+            # It has no rows yet, whatever prepared() assumes.
+            o._saved_states = None
+            o.save_states()
+
+def _add_sequences(migrator):
+    '''Start each table's change_seq counter from its highest change_seq.'''
+    Sequence.create_table(True)
+    for model in (Message, Object):
+        name = model._meta.db_table
+        if not Sequence.select().where(Sequence.name == name).exists():
+            highest = model.select(fn.COALESCE(fn.MAX(model.change_seq), 0)).scalar()
+            Sequence.create(name=name, value=highest)
+
+def _add_tombstones(migrator):
+    Tombstone.create_table(True)
+
+# Each step brings a database file up to its version. Steps must cope with
+# a database that create_tables() already made with the latest schema, so
+# they check before changing anything. Only ever append to this.
+MIGRATIONS = (
+    (1, _add_change_seq),
+    (2, _add_message_sent),
+    (3, _add_object_indexes),
+    (4, _add_object_states),
+    (5, _add_sequences),
+    (6, _add_tombstones),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version():
+    return db.execute_sql('PRAGMA user_version').fetchone()[0]
+
+def migrate_schema():
+    '''Run any migration steps an existing database file is too old to
+    have had, and record the version it's at in its user_version.'''
+    migrator = SqliteMigrator(db)
+    version = schema_version()
+    for step_version, step in MIGRATIONS:
+        if version < step_version:
+            step(migrator)
+            db.execute_sql('PRAGMA user_version = %d' % step_version)
+
+# The table a snapshot records the version of the zone code it was made
+# with in, as a single (key, value) row.
+SNAPSHOT_META = 'snapshotmeta'
+
+def mark_snapshot(version):
+    '''Record in this database that it is a snapshot of zone code version.'''
+    database = Object._meta.database
+    quote = database.compiler().quote
+    database.execute_sql('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)' % quote(SNAPSHOT_META))
+    database.execute_sql('INSERT OR REPLACE INTO %s (key, value) VALUES (%s, %s)' % (
+        quote(SNAPSHOT_META), database.interpolation, database.interpolation), ('version', version))
+
+def load_snapshot(path, version=None):
+    '''Copy every object (and its states) out of the zone snapshot at path,
+    a database file some zone was set up in, without running any zone code.
+    Returns how many objects were copied, or None if the snapshot was made
+    with a different schema version, or (if version is given) with another
+    version of the zone's code, and should be rebuilt.
+
+    Like Object.bulk_create, the copies get ids after the highest one
+    already here, so nothing else should be creating objects at the same time.'''
+    database = Object._meta.database
+    quote = database.compiler().quote
+    columns = [quote(f.db_column) for f in Object._meta.sorted_fields
+               if f.name not in ('id', 'change_seq')]
+
+    database.execute_sql('ATTACH DATABASE %s AS snapshot' % database.interpolation, (path,))
+    try:
+        if database.execute_sql('PRAGMA snapshot.user_version').fetchone()[0] != SCHEMA_VERSION:
+            return None
+        if version is not None:
+            marked = database.execute_sql("SELECT 1 FROM snapshot.sqlite_master WHERE type = 'table' AND name = %s"
+                                          % database.interpolation, (SNAPSHOT_META,)).fetchone()
+            made_with = marked and database.execute_sql("SELECT value FROM snapshot.%s WHERE key = 'version'"
+                                                         % quote(SNAPSHOT_META)).fetchone()
+            if not made_with or made_with[0] != version:
+                return None
+
+        with database.atomic():
+            objid = Object.select(fn.COALESCE(fn.MAX(Object.id), 0)).scalar()
+            highest = database.execute_sql('SELECT COALESCE(MAX(%s), 0) FROM snapshot.%s' % (
+                quote(Object.change_seq.db_column), quote(Object._meta.db_table))).fetchone()[0]
+            seq = Object.next_change_seq(highest) - highest
+            copied = database.execute_sql(
+                'INSERT INTO %(table)s (%(id)s, %(seq)s, %(columns)s) '
+                'SELECT %(id)s + %(objid)d, %(seq)s + %(change_seq)d, %(columns)s FROM snapshot.%(table)s'
+                % {'table': quote(Object._meta.db_table), 'columns': ', '.join(columns),
+                   'id': quote(Object.id.db_column), 'seq': quote(Object.change_seq.db_column),
+                   'objid': objid, 'change_seq': seq}).rowcount
+            database.execute_sql(
+                'INSERT INTO %(table)s (%(obj)s, %(state)s) '
+                'SELECT %(obj)s + %(objid)d, %(state)s FROM snapshot.%(table)s'
+                % {'table': quote(ObjectState._meta.db_table), 'obj': quote(ObjectState.obj.db_column),
+                   'state': quote(ObjectState.state.db_column), 'objid': objid})
+    finally:
+        database.execute_sql('DETACH DATABASE snapshot')
+
+    if zone_state.loaded:
+        zone_state.sync()
+    return copied
+
+def setup(db_uri='simplemmo.sqlite', echo=False, pragmas=SQLITE_PRAGMAS):
+    '''Open the database, applying the given pragmas to every connection,
+    and bring its schema up to date.'''
     print "dburi:", db_uri
     global db
     db.init(db_uri)
+    # peewee only takes pragmas when the database is made, and db has
+    # to stay the instance the models were defined with.
+    db._pragmas = list(pragmas)
     db.connect()
-    db.create_tables([User, Character, Zone, Message, Object], True)
+    db.create_tables([User, Character, Zone, Message, Object, ObjectState, Sequence, Tombstone], True)
+    migrate_schema()
 
 
 if __name__ == "__main__":
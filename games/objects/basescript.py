@@ -1,7 +1,7 @@
 
 import datetime
 
-from elixir_models import Message
+from elixir_models import Message, message_buffer
 
 import re
 import random
@@ -20,6 +20,10 @@ class Script(object):
     '''This is a placeholder class used for doing object script things.
     It's mostly just used for detecting if an object is really a script or not.
     '''
+    # How many seconds the ScriptServer waits between calls to tick().
+    # 0 means every time the ScriptServer ticks.
+    tick_interval = 0
+
     def __init__(self, mongo_engine_object=None):
         self.me_obj = mongo_engine_object
         print "Initted with %s" % self.me_obj
@@ -56,7 +60,8 @@ class Script(object):
 
     def say(self, message):
         '''Write the given text to the zone message database.'''
-        Message(sender=self.me_obj.name, message=message, loc_x=self.me_obj.loc_x, loc_y=self.me_obj.loc_y, loc_z=self.me_obj.loc_z, player_generated=False).save()
+        message_buffer.add(Message(sender=self.me_obj.name, message=message, loc_x=self.me_obj.loc_x,
+                                   loc_y=self.me_obj.loc_y, loc_z=self.me_obj.loc_z, player_generated=False))
         print "[%s] %s: %s" % (datetime.datetime.now(), self.me_obj.name, message)
 
     def rand_say(self, sayings):
@@ -64,26 +69,33 @@ class Script(object):
         self.say(random.choice(sayings))
 
     def tick(self):
+        '''Do something every tick_interval seconds. Return a number of
+        seconds to be ticked again after that long instead.
+        Scripts that don't override this are never ticked.'''
         pass
 
+    def nearby(self, radius, physical=None):
+        '''Get the other objects strictly closer than radius to this one.
+        This only looks at the zone's spatial grid cells around us, which
+        the ScriptServer keeps in sync once per tick.'''
+        return Object.get_nearby(self.me_obj.loc_x, self.me_obj.loc_y, radius,
+                                 physical=physical, exclude=self.me_obj.id, sync=False)
+
     def move(self, xmod, ymod, zmod):
-        self.me_obj.loc_x += xmod
-        self.me_obj.loc_y += ymod
-        self.me_obj.loc_z += zmod
+        loc_x = self.me_obj.loc_x + xmod
+        loc_y = self.me_obj.loc_y + ymod
+        loc_z = self.me_obj.loc_z + zmod
+
+        # Is there anything physical within 1 of where we're going?
+        if Object.collides(loc_x, loc_y, 1, exclude=self.me_obj.id, sync=False):
+            # We collided against something, so return now and don't
+            # save the location changes into the database.
+            return False
+
+        # We didn't collide with any objects.
+        self.me_obj.loc_x, self.me_obj.loc_y, self.me_obj.loc_z = loc_x, loc_y, loc_z
         self.me_obj.set_modified()
-
-        from helpers import manhattan
-        ourx, oury = self.me_obj.loc_x, self.me_obj.loc_y
-        for o in Object.get_objects(physical=True):
-            # Is the distance between that object and the character less than 3?
-            if manhattan(o.loc_x, o.loc_y, ourx, oury) < 1:
-                # We collided against something, so return now and don't
-                # save the location changes into the database.
-                return False
-        else:
-            # We didn't collide with any objects.
-            self.me_obj.save()
-            return True
+        return True
 
     def wander(self):
         return self.move(random.randint(-1, 1), random.randint(-1, 1), random.randint(-1, 1))
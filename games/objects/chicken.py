@@ -1,8 +1,13 @@
 
+import random
+
 from games.objects.basescript import Script
 
 
 class Chicken(Script):
+    # Chickens don't like anything closer to them than this.
+    personal_space = 3
+
     def __init__(self, *args, **kwargs):
         # Overriding so people remember to do this on their scripts.
         super(Chicken, self).__init__(*args, **kwargs)
@@ -24,11 +29,21 @@ class Chicken(Script):
         obj.save()
         return obj
 
+    def step_away(self, crowd):
+        '''Take a step away from the middle of crowd.'''
+        mid_x = sum(obj.loc_x for obj in crowd) / float(len(crowd))
+        mid_y = sum(obj.loc_y for obj in crowd) / float(len(crowd))
+        return self.move(cmp(self.me_obj.loc_x, mid_x), cmp(self.me_obj.loc_y, mid_y), 0)
+
     def tick(self):
-        if self.roll("1d100") == 100:
+        crowd = self.nearby(self.personal_space)
+        if crowd:
+            # Too close for comfort, so shuffle off.
+            if not self.step_away(crowd):
+                self.rand_say(self.collide_chat)
+        elif self.roll("1d2") == 1:
             self.rand_say(self.idle_chat)
-
-        if self.roll("1d100") == 100:
+        else:
             # Move around randomly.
             self.say("I think I'll take a stroll!")
             r = self.wander()
@@ -37,3 +52,6 @@ class Chicken(Script):
             else:
                 self.say("That stroll was nice.")
 
+        # Doze off until the next cluck or stroll.
+        return random.uniform(1, 9)
+
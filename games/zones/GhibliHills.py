@@ -36,6 +36,7 @@ class Zone(BaseZone):
         self.logger.info("Placing chickens...")
 
         # Place 10 chickens randomly:
+        chickens = []
         for i in xrange(10):
             obj = Object()
             obj.name = "Chicken #%d" % i
@@ -46,7 +47,8 @@ class Zone(BaseZone):
             obj.vel_x, obj.vel_y, obj.vel_z = 0, 0, 0
             obj.states.extend(['alive', 'whole', 'clickable'])
             obj.scripts = ['games.objects.chicken']
-            obj.save()
+            chickens.append(obj)
+        Object.bulk_create(chickens)
 
         self.logger.info(str([o.name for o in Object.get_objects()]))
 
@@ -1,7 +1,11 @@
 
+import os
+import hashlib
+import inspect
 from random import randint, uniform
 
-from elixir_models import Object
+from elixir_models import Object, load_snapshot
+from settings import ZONE_SNAPSHOT_FILE
 
 # Some helpers for random.
 def randloc():
@@ -31,6 +35,7 @@ class BaseZone(object):
 
     @staticmethod
     def randobj(name="Object #%s", resource='object', count=1, states=None, scripts=None):
+        '''Place count objects randomly, all inserted at once.'''
         objs = []
         for i in xrange(count):
             obj = Object()
@@ -44,9 +49,8 @@ class BaseZone(object):
                 obj.states.extend(states)
             if scripts:
                 obj.scripts.extend(scripts)
-            obj.save()
             objs.append(obj)
-        return objs
+        return Object.bulk_create(objs)
 
     def setup_logging(self, logger=None):
         if logger:
@@ -57,9 +61,46 @@ class BaseZone(object):
 
     def load(self):
         if not self.is_loaded():
-            self.insert_objects()
-            # Loading complete.
-            self.set_loaded()
+            if not self.use_snapshot():
+                self.insert_objects()
+                # Loading complete.
+                self.set_loaded()
+
+    def snapshot_path(self):
+        return ZONE_SNAPSHOT_FILE % type(self).__module__.split('.')[-1]
+
+    @classmethod
+    def code_version(cls):
+        '''A hash of the source of the zone's class and the classes it
+        inherits from, which is what decides the objects it starts with.'''
+        digest = hashlib.sha1()
+        sources = []
+        for c in inspect.getmro(cls):
+            try:
+                source = inspect.getsourcefile(c)
+            except TypeError:
+                # Built in, like object.
+                continue
+            if source and source not in sources:
+                sources.append(source)
+                with open(source, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def use_snapshot(self):
+        '''Copy the zone's objects out of its snapshot (see zonesnapshot.py)
+        instead of running insert_objects, if it has one made from this
+        version of the zone's code. Returns whether it did.'''
+        path = self.snapshot_path()
+        if not os.path.exists(path):
+            return False
+
+        count = load_snapshot(path, version=self.code_version())
+        if count is None:
+            self.logger.warning("%s was made with a different schema or zone code, so it isn't being used." % path)
+            return False
+        self.logger.info("Loaded %d objects from %s." % (count, path))
+        return True
 
     def is_loaded(self):
         if Object.get_objects(name='Loading Complete.'):
@@ -80,9 +121,11 @@ class BaseZone(object):
 
     def insert_objects(self):
         '''Insert any objects you want to be present in the zone into the
-        database in this call.
+        database in this call. Lots of them are much faster to put in with
+        Object.bulk_create (or randobj) than by saving each one.
 
-        This gets called exactly once per database. If you change something here
+        This gets called exactly once per database, and not at all when the
+        zone has an up-to-date snapshot. If you change something here
         and want it to appear in the zone's database, you will need to clear the
         database first.
 
@@ -110,7 +110,8 @@ class ZoneHandler(BaseHandler):
                 from start_subprocess import start_zone, start_scriptserver
                 s = start_scriptserver(zonename=name, instancetype=instance_type, owner=owner)
                 z, serverurl = start_zone(zonename=name, instancetype=instance_type, owner=owner)
-                JOBS.extend([z, s])
+                JOBS.append(z)
+                JOBS.extend(s)
 
             elif START_ZONE_WITH == DOCKER:
                 logging.info("Starting process with docker.")
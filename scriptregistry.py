@@ -0,0 +1,89 @@
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''ScriptRegistry
+Finds the Script classes in an object's script modules (like
+'games.objects.chicken'), once per module instead of on every activation.
+'''
+
+import sys
+
+from games.objects.basescript import Script
+
+
+class ScriptRegistry(object):
+    '''Maps each script path to the Script subclasses its module has,
+    importing and looking through the module only the first time it's asked.
+
+    forget() a path (or everything) when its module changes, or reload()
+    it to pick up the new code straight away.'''
+
+    def __init__(self):
+        self.classes = {}
+
+    def __len__(self):
+        return len(self.classes)
+
+    def get(self, script):
+        '''The Script subclasses in the module at the given path.'''
+        classes = self.classes.get(script)
+        if classes is None:
+            classes = self.classes[script] = self.find(self.load(script))
+        return classes
+
+    def instances(self, obj):
+        '''A new instance of every Script class in each of obj's scripts.'''
+        return [C(obj) for script in obj.scripts for C in self.get(script)]
+
+    @staticmethod
+    def load(script):
+        scriptclass = script.split('.')[-1]
+        return __import__(script, globals(), locals(), [scriptclass], -1)
+
+    @staticmethod
+    def find(module):
+        classes = []
+        for key in dir(module):
+            C = getattr(module, key)
+            try:
+                # No sense in instantiating the default Script either.
+                if not issubclass(C, Script) or C is Script:
+                    continue
+            except TypeError:
+                # C isn't a class at all.
+                continue
+            classes.append(C)
+        return classes
+
+    def forget(self, script=None):
+        '''Look the given script (or every script) up again next time.'''
+        if script is None:
+            self.classes = {}
+        else:
+            self.classes.pop(script, None)
+
+    def reload(self, script):
+        '''Reload the script's module and forget its old classes.'''
+        module = sys.modules.get(script)
+        if module is not None:
+            reload(module)
+        self.forget(script)
+
+script_registry = ScriptRegistry()
@@ -24,8 +24,16 @@ A server that runs scripts for all the objects in a zone.
 This is started by the MasterZoneServer when its sibling ZoneServer is started.
 '''
 
+import os
+import sys
+import json
 import time
+import heapq
+import random
+import itertools
+import threading
 import logging
+from collections import deque
 logger = logging.getLogger('ScriptServer')
 hdlr = logging.FileHandler('log/scriptserver.log')
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -37,94 +45,484 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 
-from elixir_models import Object, Message, ScriptedObject
+from elixir_models import Object, Message, ScriptedObject, zone_state, message_buffer, object_grid
 from games.objects.basescript import Script
+from scriptregistry import script_registry
+from helpers import manhattan
 
 import settings
 
-from basetickserver import BaseTickServer
+from basetickserver import BaseTickServer, monotonic
 
 class ScriptEventHandler(FileSystemEventHandler):
-    def on_any_event(self, event):
-        import tornado.autoreload
-        tornado.autoreload._reload()
+    '''Notes which Python modules under SCRIPT_PATH have changed, so the
+    ScriptServer can reload just them once they've stopped changing.
+    Events come in on the observer's thread, and ready() is called from
+    the tick loop.'''
+
+    def __init__(self, delay=settings.SCRIPT_RELOAD_DELAY):
+        super(ScriptEventHandler, self).__init__()
+        self.delay = delay
+        self.lock = threading.Lock()
+        # module name: when it last changed
+        self.changed = {}
+
+    @staticmethod
+    def module_name(path):
+        '''games/objects/chicken.py -> games.objects.chicken, or None for
+        anything that isn't Python source.'''
+        if not path or not path.endswith('.py'):
+            return None
+        parts = os.path.relpath(path)[:-len('.py')].split(os.sep)
+        if parts[-1] == '__init__':
+            parts.pop()
+        if not parts or parts[0] == '..':
+            return None
+        return '.'.join(parts)
+
+    def on_any_event(self, event, now=None):
+        if event.is_directory:
+            return
+        if now is None:
+            now = monotonic()
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            module = self.module_name(path)
+            if module is not None:
+                with self.lock:
+                    self.changed[module] = now
+
+    def ready(self, now=None):
+        '''The modules that changed, and haven't since for delay seconds.'''
+        if not self.changed:
+            return []
+        if now is None:
+            now = monotonic()
+        with self.lock:
+            ready = [module for module, when in self.changed.items() if now - when >= self.delay]
+            for module in ready:
+                del self.changed[module]
+        return ready
+
+class MessageRetention(object):
+    '''Keeps only the newest MAX_ZONE_OBJECT_MESSAGE_COUNT non-player
+    messages around, pruning the rest with one DELETE every interval
+    seconds, instead of checking on every tick.'''
+
+    def __init__(self, keep=settings.MAX_ZONE_OBJECT_MESSAGE_COUNT,
+                 interval=settings.MESSAGE_RETENTION_INTERVAL):
+        self.keep = keep
+        self.interval = interval
+        self.last_sweep = time.time()
+
+        # Running totals, for keeping an eye on how much this costs.
+        self.sweeps = 0
+        self.pruned = 0
+        self.seconds = 0.0
+
+    def due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self.last_sweep >= self.interval
+
+    def sweep(self):
+        '''Prune old messages now. Returns how many were deleted.'''
+        start = time.time()
+        pruned = Message.prune(self.keep)
+        self.last_sweep = time.time()
+
+        self.sweeps += 1
+        self.pruned += pruned
+        self.seconds += self.last_sweep - start
+        if pruned:
+            logger.info("Pruned %d old messages in %.4fs." % (pruned, self.last_sweep - start))
+        return pruned
+
+    def stats(self):
+        return {'sweeps': self.sweeps, 'pruned': self.pruned, 'seconds': self.seconds}
+
+class TickTimes(object):
+    '''How long a script's ticks have taken: running totals, plus the
+    latest few for percentiles.'''
+
+    def __init__(self, samples=settings.SCRIPT_STATS_SAMPLES):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.worst:
+            self.worst = seconds
+        self.recent.append(seconds)
+
+    def stats(self):
+        recent = sorted(self.recent)
+        percentile = lambda p: recent[int(round(p * (len(recent) - 1)))] if recent else 0.0
+        return {'count': self.count, 'total': self.total, 'max': self.worst,
+                'p50': percentile(0.5), 'p99': percentile(0.99)}
+
+class ScriptProfiler(object):
+    '''Times every script tick, by script class and by script instance, so
+    operators can find the one chicken that's slowing the zone down.
+
+    Ticks that go over budget seconds are logged, once per script per
+    write(). write() saves the stats as JSON every interval seconds.'''
+
+    def __init__(self, path=None, budget=settings.SCRIPT_TICK_BUDGET,
+                 interval=settings.SCRIPT_STATS_INTERVAL):
+        self.path = path
+        self.budget = budget
+        self.interval = interval
+        self.last_write = monotonic()
+        self.reset()
+
+    def reset(self):
+        self.classes = {}
+        # script instance: (its name, TickTimes)
+        self.scripts = {}
+        self.warned = set()
+
+    def forget_scripts(self, scripts=None):
+        '''Let go of the given script instances (or all of them), like
+        when they're reloaded.'''
+        if scripts is None:
+            self.scripts = {}
+            self.warned = set()
+        for script in scripts or ():
+            self.scripts.pop(script, None)
+            self.warned.discard(script)
+
+    def record(self, script, seconds):
+        entry = self.scripts.get(script)
+        if entry is None:
+            cls = type(script)
+            classname = "%s.%s" % (cls.__module__, cls.__name__)
+            obj = getattr(script, 'me_obj', None)
+            name = "%s #%s (%s)" % (classname, getattr(obj, 'id', None), getattr(obj, 'name', None))
+            if classname not in self.classes:
+                self.classes[classname] = TickTimes()
+            entry = self.scripts[script] = (name, self.classes[classname], TickTimes())
+
+        name, class_times, times = entry
+        class_times.add(seconds)
+        times.add(seconds)
+
+        if self.budget is not None and seconds > self.budget and script not in self.warned:
+            self.warned.add(script)
+            logger.warning("%s took %.4fs to tick, over its %.4fs budget." % (name, seconds, self.budget))
+
+    def stats(self, top=20):
+        '''Stats for every script class, and the top scripts by total time.'''
+        slowest = sorted(self.scripts.values(), key=lambda entry: entry[2].total, reverse=True)[:top]
+        return {'classes': dict((name, times.stats()) for name, times in self.classes.items()),
+                'scripts': [dict(times.stats(), name=name) for name, class_times, times in slowest]}
+
+    def due(self, now=None):
+        if self.path is None:
+            return False
+        if now is None:
+            now = monotonic()
+        return now - self.last_write >= self.interval
+
+    def write(self, **extra):
+        '''Replace the stats file with the current stats, plus anything
+        else passed in.'''
+        stats = self.stats()
+        stats.update(extra)
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        os.rename(temp, self.path)
+        self.last_write = monotonic()
+        self.warned = set()
+
+class ScriptLOD(object):
+    '''Level of detail for script ticks: scripts near online characters tick
+    at full rate, ones further out tick slower, and ones nobody is around
+    to see don't tick at all. See settings.SCRIPT_LOD_TIERS.
+
+    update() only looks again around characters that have moved or logged
+    on since the last one, except every refresh seconds, when it looks
+    around everybody to catch the scripted objects that wandered.'''
+
+    def __init__(self, tiers=settings.SCRIPT_LOD_TIERS, interval=settings.SCRIPT_LOD_INTERVAL,
+                 refresh=settings.SCRIPT_LOD_REFRESH, step=0.1):
+        self.tiers = tiers
+        self.interval = interval
+        self.refresh = refresh
+        # The shortest wait a slowed down script's is multiplied from.
+        self.step = step
+        self.last_refresh = None
+        self.last_update = None
+
+        # character id: (loc_x, loc_y, {object id: slowdown} around them)
+        self.characters = {}
+        # object id: slowdown, by the closest character.
+        self.slowdowns = {}
+
+    def slowdown(self, script):
+        '''How many times slower script should tick, or None to not tick it.'''
+        return self.slowdowns.get(script.me_obj.id)
+
+    def around(self, loc_x, loc_y):
+        '''{object id: slowdown} for every object in a tier around a character.'''
+        slowdowns = {}
+        for objid in object_grid.query(loc_x, loc_y, self.tiers[-1][0]):
+            x, y, physical = object_grid.get(objid)
+            distance = manhattan(loc_x, loc_y, x, y)
+            for tier_distance, slowdown in self.tiers:
+                if distance < tier_distance:
+                    slowdowns[objid] = slowdown
+                    break
+        return slowdowns
+
+    def update(self, now=None):
+        '''Work out the tiers again around whoever has moved.
+        Returns how many characters were looked around.'''
+        if now is None:
+            now = monotonic()
+        if self.last_update is not None and now - self.last_update < self.interval:
+            return 0
+        self.last_update = now
+
+        refresh = self.last_refresh is None or now - self.last_refresh >= self.refresh
+        if refresh:
+            self.last_refresh = now
+
+        online = Object.get_objects(states=['player', 'online'])
+        characters = {}
+        looked = 0
+        for o in online:
+            old = self.characters.get(o.id)
+            if refresh or old is None or (old[0], old[1]) != (o.loc_x, o.loc_y):
+                characters[o.id] = (o.loc_x, o.loc_y, self.around(o.loc_x, o.loc_y))
+                looked += 1
+            else:
+                characters[o.id] = old
+
+        if looked or len(characters) != len(self.characters):
+            slowdowns = {}
+            for loc_x, loc_y, around in characters.values():
+                for objid, slowdown in around.iteritems():
+                    if slowdown < slowdowns.get(objid, slowdown + 1):
+                        slowdowns[objid] = slowdown
+            self.slowdowns = slowdowns
+        self.characters = characters
+        return looked
+
+class ScriptScheduler(object):
+    '''Ticks each script only when it's due, so a zone full of mostly idle
+    scripts costs next to nothing between their wakeups.
+
+    A script is due every tick_interval seconds, or however many seconds
+    its tick() last returned. Scripts that don't override Script.tick
+    aren't scheduled at all.
+
+    With a ScriptLOD, scripts far from any online character are slowed
+    down or skipped.'''
+
+    def __init__(self, profiler=None, lod=None):
+        # (when, order added, script), soonest first.
+        self.queue = []
+        self.order = itertools.count()
+        self.profiler = profiler
+        self.lod = lod
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, script, now=None):
+        '''Schedule script's first tick. Scripts are spread out over their
+        first interval so they don't all wake up at once.'''
+        if getattr(script.tick, '__func__', None) is Script.tick.__func__:
+            return
+        if now is None:
+            now = monotonic()
+        when = now + random.uniform(0, script.tick_interval)
+        heapq.heappush(self.queue, (when, next(self.order), script))
+
+    def remove(self, scripts):
+        '''Stop ticking the given scripts.'''
+        scripts = set(scripts)
+        self.queue = [entry for entry in self.queue if entry[2] not in scripts]
+        heapq.heapify(self.queue)
+
+    def run(self, now=None):
+        '''Tick every script that's due. Returns how many were ticked.'''
+        if now is None:
+            now = monotonic()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            due.append(heapq.heappop(self.queue)[2])
+
+        ticked = 0
+        for script in due:
+            # A script that raises is logged and tried again next interval,
+            # and doesn't stop the scripts after it from ticking.
+            wait = script.tick_interval
+            try:
+                slowdown = 1 if self.lod is None else self.lod.slowdown(script)
+                if slowdown is None:
+                    # Nobody's around to see it, so check again later.
+                    wait = self.lod.interval
+                    continue
+                ticked += 1
+
+                start = monotonic()
+                try:
+                    wait = script.tick()
+                finally:
+                    if self.profiler is not None:
+                        self.profiler.record(script, monotonic() - start)
+                if wait is None:
+                    wait = script.tick_interval
+                if slowdown > 1:
+                    wait = max(wait, self.lod.step) * slowdown
+            except Exception:
+                logger.exception("%r raised while ticking." % script)
+            finally:
+                heapq.heappush(self.queue, (now + wait, next(self.order), script))
+        return ticked
 
 class ZoneScriptRunner(BaseTickServer):
     '''This is a class that holds all sorts of methods for running scripts for
     a zone. It does not talk to the HTTP handler(s) directly, but instead uses
     the same database. It might take player movement updates directly in the
-    future for speed, but this is unlikely.'''
+    future for speed, but this is unlikely.
 
-    def __init__(self, zoneid):
+    A big zone's scripts can be split between shards ScriptServer processes,
+    each running the scripts of the objects whose id % shards is its shard.
+    They all keep the whole zone in memory for their scripts to look at,
+    and each writes out its own scripts' changes every tick, picking up
+    everybody else's as it does. So sharding splits up the ticking, but
+    every shard still pays the whole zone's memory and sync cost.'''
+
+    def __init__(self, zoneid, shard=0, shards=1):
         super(ZoneScriptRunner, self).__init__()
+        self.shard = shard
+        self.shards = shards
 
         # While the zone is not loaded, wait.
         logger.info("Waiting for zone to complete loading.")
         while not Object.get_objects(name="Loading Complete."):
             time.sleep(.1)
 
-        # Watch the script path for any changes, and reboot the scriptserver if they do.
+        # Watch the script path for any changes, and reload what changed.
+        self.changes = ScriptEventHandler()
         self.observer = Observer()
-        self.observer.schedule(ScriptEventHandler(), path=settings.SCRIPT_PATH, recursive=True)
+        self.observer.schedule(self.changes, path=settings.SCRIPT_PATH, recursive=True)
         self.observer.start()
 
+        # Keep the zone's objects in memory, and write what the scripts
+        # change (and say) out once per tick.
+        zone_state.load()
+        message_buffer.load()
+
+        # One shard cleaning up messages is plenty.
+        self.retention = MessageRetention() if shard == 0 else None
+
+        if shards > 1:
+            zoneid = "%s-shard%d" % (zoneid, shard)
+        self.profiler = ScriptProfiler(path=settings.SCRIPT_STATS_FILE % zoneid)
+        self.lod = ScriptLOD(step=self.tick_length) if settings.SCRIPT_LOD_TIERS else None
+
         self.load_scripts()
         logger.info("Started with data for zone: %s" % zoneid)
 
+    def owns(self, obj):
+        '''Does this shard run obj's scripts?'''
+        return self.shards == 1 or obj.id % self.shards == self.shard
+
     def load_scripts(self):
         '''(Re)Load scripts for objects in this zone.'''
         self.scripts = {}
+        self.scheduler = ScriptScheduler(profiler=self.profiler, lod=self.lod)
+        self.profiler.forget_scripts()
 
-        # Query DB for a list of all objects' script names,
-        #   ordered according to proximity to players
+        # Query DB for a list of all objects' script names.
+        # How often they tick depends on how close players are, see ScriptLOD.
         logger.info(Object.get_objects(scripted=True))
         for o in Object.get_objects(scripted=True):
+            if not self.owns(o):
+                continue
             logger.info("Scripted Object: {0}".format(o.name))
             # Store list of script names in self
 
-            # For each script name in the list:
+            # Instantiate each of its scripts' classes, which the registry
+            # only has to find the first time.
             for script in o.scripts:
                 logger.info("Importing %s" % script)
-                if script not in self.scripts:
-                    self.scripts[script] = []
-
-                # Import those by name via __import__
-                scriptclass = script.split('.')[-1]
-                module = __import__(script, globals(), locals(), [scriptclass], -1)
-                # For each entry in the script's dir()
-                for key in dir(module):
-                    C = getattr(module, key)
-
-                    # No sense in instantiating the default Script instance.
-                    if C == Script:
-                        continue
-
-                    try:
-                        # Does this object have the attributes that scripts need?
-                        if not all((C.tick, C.activate, C.create)):
-                            continue
-                    except AttributeError:
-                        continue
-
-                    # Store object instance in a list.
-                    self.scripts[script].append(C(mongo_engine_object=o))
+                instances = self.scripts.setdefault(script, [])
+                for C in script_registry.get(script):
+                    instance = C(mongo_engine_object=o)
+                    instances.append(instance)
+                    self.scheduler.add(instance)
         return self.scripts
 
 
+    def reload_module(self, module):
+        '''Pick up the changes to a module. Scripts are reloaded in place,
+        but anything else they depend on needs the whole process restarted.'''
+        if module in self.scripts:
+            self.reload_script(module)
+        elif module in sys.modules:
+            logger.info("%s changed, restarting." % module)
+            import tornado.autoreload
+            tornado.autoreload._reload()
+
+    def reload_script(self, script):
+        '''Reload a script's module and swap its running instances for ones
+        of the new classes, without stopping the other scripts. If the new
+        code doesn't load, the old instances keep running.'''
+        # Make every new instance before touching the old ones, so a
+        # constructor that raises leaves the old ones running.
+        try:
+            script_registry.reload(script)
+            classes = script_registry.get(script)
+            new = [C(mongo_engine_object=o)
+                   for o in Object.get_objects(scripted=True) if self.owns(o) and script in o.scripts
+                   for C in classes]
+        except Exception:
+            logger.exception("Couldn't reload %s, keeping the old version." % script)
+            return False
+
+        old = self.scripts.get(script, [])
+        self.scheduler.remove(old)
+        self.profiler.forget_scripts(old)
+        self.scripts[script] = new
+        for instance in new:
+            self.scheduler.add(instance)
+        logger.info("Reloaded %s: %d scripts replaced by %d." % (script, len(old), len(new)))
+        return True
+
     def tick(self):
-        '''Iterate through all known scripts and call their tick method.'''
-        # Tick all the things
-        logger.info(self.scripts)
-        for scriptname, scripts in self.scripts.items():
-            for script in scripts:
-                logger.debug("Ticking {0}".format(script))
-                # TODO: Pass some locals or somesuch so that they can query the db
-                script.tick()
-
-        # Clean up mongodb's messages by deleting all but the most recent 100 non-player messages
-        for m in Message.select().where(Message.player_generated==False).order_by('-sent')[settings.MAX_ZONE_OBJECT_MESSAGE_COUNT:]:
-            logger.info("Deleting message from %s" % m.sent.time())
-            m.delete()
+        '''Reload any scripts that changed, then tick the ones that are due.'''
+        for module in self.changes.ready():
+            self.reload_module(module)
+
+        # TODO: Pass some locals or somesuch so that they can query the db
+        if self.lod is not None:
+            self.lod.update()
+        ticked = self.scheduler.run()
+        logger.debug("Ticked %d of %d scripts." % (ticked, len(self.scheduler)))
+
+        # Write out everything the scripts changed in one go, and pick up
+        # whatever the ZoneServer changed in the meantime.
+        zone_state.flush()
+        message_buffer.flush()
+
+        # Every so often, clean up all but the most recent non-player messages.
+        if self.retention is not None and self.retention.due():
+            self.retention.sweep()
+
+        # Let operators see which scripts are eating the tick.
+        if self.profiler.due():
+            extra = {'tick': self.stats()}
+            if self.retention is not None:
+                extra['retention'] = self.retention.stats()
+            self.profiler.write(**extra)
 
     def start(self):
         logger.info("Running ZoneScript Server.")
@@ -138,6 +536,8 @@ if __name__ == "__main__":
 
     define("dburi", default='testing.sqlite', help="Where is the database?", type=str)
     define("zoneid", default='playerinstance-defaultzone-None', help="What is the zoneid?", type=str)
+    define("shard", default=0, help="Which of the zone's script shards is this?", type=int)
+    define("shards", default=1, help="How many script shards does the zone have?", type=int)
 
     tornado.options.parse_command_line()
     dburi = options.dburi
@@ -147,7 +547,7 @@ if __name__ == "__main__":
     from elixir_models import setup
     setup(db_uri=dburi)
 
-    zsr = ZoneScriptRunner(zoneid)
+    zsr = ZoneScriptRunner(zoneid, shard=options.shard, shards=options.shards)
     try:
         zsr.start()
     except:
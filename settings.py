@@ -52,6 +52,20 @@ SENTRY_DSN = _server_str % (PROTOCOL, _dsn, 9000) + '/1'
 AGPL_STRING = "BEGIN AGPL LICENSE BLOCK"
 SKIP_FOLDERS = ("/.", ".git", ".svn", "/build/", "/srv/")
 
+# Database Settings
+# Applied to every SQLite connection by elixir_models.setup().
+# The ZoneServer and its ScriptServer share one database file. WAL lets one
+# of them read while the other writes, and synchronous=NORMAL only fsyncs
+# at checkpoints instead of on every commit. A power cut can lose the last
+# few commits, but never corrupts the file, which is fine for zone data.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('mmap_size', 64 * 1024 * 1024), # Bytes of the file to memory map.
+    ('cache_size', -16 * 1024), # Negative means KiB rather than pages.
+    ('busy_timeout', 5000), # Milliseconds to wait for a lock before giving up.
+)
+
 # AuthServer Settings
 ADMINISTRATORS = ['admin']
 HASH_ROUNDS = 85219
@@ -61,6 +75,12 @@ ZONESTARTPORT = 1300
 ZONEENDPORT = 1400
 ZONESTARTUPTIME = 20
 DEFAULT_CHARACTER_ZONE = 'defaultzone'
+SPATIAL_CELL_SIZE = 10 # Width of a spatial grid cell, in world units.
+INTEREST_RADIUS = 50 # Clients only hear about objects this close to their character.
+ZONE_FLUSH_INTERVAL = 200 # Milliseconds between writing changed objects out to the database.
+SIMULATION_STEP = 50 # Milliseconds between applying everybody's queued movement.
+MESSAGE_BUFFER_SIZE = 1000 # How many of a zone's latest messages are kept in memory for clients.
+ZONE_SNAPSHOT_FILE = "snapshots/%s.sqlite" # Each zone's compiled starting objects. Build them with zonesnapshot.py.
 
 SUPERVISORD = 'supervisord' # Constant
 SUBPROCESS = 'subprocess' # Constant
@@ -69,8 +89,21 @@ START_ZONE_WITH = SUBPROCESS
 
 # ScriptServer Settings
 MAX_ZONE_OBJECT_MESSAGE_COUNT = 1000
+MESSAGE_RETENTION_INTERVAL = 30 # Seconds between pruning old non-player messages.
+SCRIPT_TICK_BUDGET = 0.005 # Seconds one script's tick can take before it's logged as slow. None to never warn.
+SCRIPT_STATS_FILE = "log/scriptstats-%s.json" # Where each zone's ScriptServer writes how long its scripts take.
+SCRIPT_STATS_INTERVAL = 10 # Seconds between writing SCRIPT_STATS_FILE.
+# (distance from the nearest online character, how many times slower scripts
+# tick), nearest first. Scripts further than the last distance from every
+# online character don't tick at all. None ticks everything at full rate.
+SCRIPT_LOD_TIERS = ((INTEREST_RADIUS, 1), (INTEREST_RADIUS * 3, 4))
+SCRIPT_LOD_INTERVAL = 0.5 # Seconds between checking where the online characters have got to.
+SCRIPT_LOD_REFRESH = 5 # Seconds between looking around every character again, for objects that wandered.
+SCRIPT_SHARDS = 1 # How many ScriptServer processes each zone's scripted objects are split between.
+SCRIPT_STATS_SAMPLES = 200 # How many of each script's latest ticks the percentiles are taken from.
 MAX_DICE_AMOUNT = 100
 SCRIPT_PATH = "./games/" # If this is defined, watch it for changes, and reload scripts when this changes.
+SCRIPT_RELOAD_DELAY = 0.5 # Seconds a changed script has to stay unchanged before it's reloaded.
 
 # Client Settings
 CLIENT_TIMEOUT = 10 # Client gives up connecting after 10 seconds.
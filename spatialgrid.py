@@ -0,0 +1,108 @@
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''SpatialGrid
+A uniform grid (spatial hash) for finding things near a point without
+looking at everything else in the zone.
+'''
+
+from helpers import manhattan
+
+
+class SpatialGrid(object):
+    '''Buckets keys into square cells of cell_size world units, so a query
+    only has to look at the handful of cells its radius overlaps.
+
+    >>> grid = SpatialGrid(cell_size=10)
+    >>> grid.insert('barrel', 1, 1)
+    >>> grid.insert('chicken', 50, 50)
+    >>> grid.query(0, 0, 3)
+    ['barrel']
+    '''
+
+    def __init__(self, cell_size=10):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def cell(self, x, y):
+        '''Gets the coordinates of the cell that (x, y) falls in.'''
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def get(self, key):
+        '''Gets the (x, y, data) entry stored for key, or None.'''
+        return self.entries.get(key)
+
+    def insert(self, key, x, y, data=None):
+        '''Put key at (x, y), moving it if it is already in the grid.'''
+        cell = self.cell(x, y)
+        old = self.entries.get(key)
+        if old is not None:
+            oldcell = self.cell(old[0], old[1])
+            if oldcell != cell:
+                self._discard(oldcell, key)
+        self.cells.setdefault(cell, set()).add(key)
+        self.entries[key] = (x, y, data)
+
+    def remove(self, key):
+        '''Take key out of the grid. Does nothing if it isn't there.'''
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self._discard(self.cell(old[0], old[1]), key)
+
+    def _discard(self, cell, key):
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                # Don't let empty cells pile up as things wander around.
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells = {}
+        self.entries = {}
+
+    def query(self, x, y, radius, where=None):
+        '''Gets the keys strictly closer than radius (in manhattan distance)
+        to (x, y). If where is given, it is called with each candidate's
+        data and only keys it returns True for are kept.'''
+        minx, miny = self.cell(x - radius, y - radius)
+        maxx, maxy = self.cell(x + radius, y + radius)
+
+        found = []
+        for cx in xrange(minx, maxx + 1):
+            for cy in xrange(miny, maxy + 1):
+                bucket = self.cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for key in bucket:
+                    ex, ey, data = self.entries[key]
+                    if manhattan(ex, ey, x, y) >= radius:
+                        continue
+                    if where is not None and not where(data):
+                        continue
+                    found.append(key)
+        return found
@@ -51,14 +51,19 @@ def start_zone(port=1300, zonename="defaultzone", instancetype="playerinstance",
     s = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
     return s, url
 
-def start_scriptserver(zonename="defaultzone", instancetype="playerinstance", owner="Groxnor", dburi='testing.sqlite'):
-
-    args = ['scriptserver.py', '--zoneid=%s-%s-%s' % (instancetype, zonename, owner), '--dburi=%s' % dburi]
-    cmd = [sys.executable]+args
-    logging.info("Starting %s" % ' '.join(args))
-    logging.info(cmd)
-    s = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    return s
+def start_scriptserver(zonename="defaultzone", instancetype="playerinstance", owner="Groxnor", dburi='testing.sqlite',
+                       shards=settings.SCRIPT_SHARDS):
+    '''Start the zone's ScriptServer, or one for each of its shards.
+    Returns a list of the processes.'''
+    processes = []
+    for shard in xrange(shards):
+        args = ['scriptserver.py', '--zoneid=%s-%s-%s' % (instancetype, zonename, owner), '--dburi=%s' % dburi,
+                '--shard=%d' % shard, '--shards=%d' % shards]
+        cmd = [sys.executable]+args
+        logging.info("Starting %s" % ' '.join(args))
+        logging.info(cmd)
+        processes.append(subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT))
+    return processes
 
 if __name__ == "__main__":
     if start_zone():
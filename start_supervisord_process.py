@@ -22,7 +22,7 @@ import xmlrpclib
 import supervisor
 from supervisor.xmlrpc import SupervisorTransport
 
-from settings import ZONESTARTPORT, ZONEENDPORT
+from settings import ZONESTARTPORT, ZONEENDPORT, SCRIPT_SHARDS
 
 from elixir_models import Zone, session
 
@@ -92,9 +92,11 @@ def start_zone(port=1300, zonename="defaultzone", instancetype="playerinstance",
         settings = {'command': command, 'autostart': str(True), 'autorestart': str(autorestart), 'redirect_stderr': str(True)}
         addtogroup = _add_process(s, processgroup, zoneid, settings, port)
 
-        # Start up a scriptserver:
-        settings['command'] = '/usr/bin/python scriptserver.py %s' % zoneid
-        zonescriptserver = _add_process(s, processgroup, zoneid+"-scriptserver", settings, 1)
+        # Start up a scriptserver, or one per shard:
+        for shard in xrange(SCRIPT_SHARDS):
+            settings['command'] = '/usr/bin/python scriptserver.py --zoneid=%s --shard=%d --shards=%d' % (zoneid, shard, SCRIPT_SHARDS)
+            name = zoneid+"-scriptserver" if SCRIPT_SHARDS == 1 else "%s-scriptserver%d" % (zoneid, shard)
+            zonescriptserver = _add_process(s, processgroup, name, settings, 1)
 
         if addtogroup:
             from settings import PROTOCOL, HOSTNAME
@@ -0,0 +1,116 @@
+import unittest
+
+import sys
+sys.path.append(".")
+
+from mock import patch
+
+from elixir_models import Object, ObjectState, Message, Sequence, Tombstone, object_grid, message_buffer, zone_state
+from games.objects.basescript import Script
+from games.objects.chicken import Chicken
+
+from playhouse.test_utils import test_database
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+test_db = SqliteExtDatabase(':memory:')
+
+class TestScriptMovement(unittest.TestCase):
+    def setUp(self):
+        object_grid.clear()
+
+    def tearDown(self):
+        object_grid.clear()
+
+    def test_nearby(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken", loc_x=0, loc_y=0)
+            friend = Object.create(name="Other Chicken", loc_x=2, loc_y=0)
+            Object.create(name="Faraway Chicken", loc_x=90, loc_y=90)
+
+            result = Script(chicken).nearby(5)
+
+        self.assertEqual([friend], result)
+
+    def test_move(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken", loc_x=0, loc_y=0)
+
+            result = Script(chicken).move(1, 1, 0)
+
+            self.assertTrue(result)
+            self.assertEqual((1, 1, 0), Object.get(id=chicken.id).loc)
+
+    def test_move_collision(self):
+        '''A blocked move returns False and leaves the object where it was.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken", loc_x=0, loc_y=0)
+            Object.create(name="Barrel", loc_x=1, loc_y=0)
+
+            result = Script(chicken).move(1, 0, 0)
+
+            self.assertFalse(result)
+            self.assertEqual((0, 0, 0), Object.get(id=chicken.id).loc)
+
+class TestChicken(unittest.TestCase):
+    def setUp(self):
+        object_grid.clear()
+
+    def tearDown(self):
+        zone_state.unload()
+        message_buffer.unload()
+        object_grid.clear()
+
+    def tick(self, *others):
+        '''Tick a chicken at the origin of a loaded zone with others in it.'''
+        with test_database(test_db, (Object, ObjectState, Message, Sequence, Tombstone)):
+            Object.create(name="Chicken", loc_x=0, loc_y=0)
+            for loc_x, loc_y in others:
+                Object.create(name="Barrel", loc_x=loc_x, loc_y=loc_y)
+            zone_state.load()
+            chicken = Object.get_objects(limit=1, name="Chicken")
+
+            with patch.object(Chicken, 'roll', return_value=1):
+                Chicken(chicken).tick()
+        return chicken
+
+    def test_tick_steps_away(self):
+        chicken = self.tick((1, 1))
+
+        self.assertEqual((-1, -1), (chicken.loc_x, chicken.loc_y))
+
+    def test_tick_cornered(self):
+        '''A chicken with nowhere to step away to stays put.'''
+        chicken = self.tick((2, 0), (-1, 0))
+
+        self.assertEqual((0, 0), (chicken.loc_x, chicken.loc_y))
+
+    def test_tick_alone(self):
+        '''A chicken with nothing nearby just clucks.'''
+        chicken = self.tick((9, 9))
+
+        self.assertEqual((0, 0), (chicken.loc_x, chicken.loc_y))
+
+class TestScriptSay(unittest.TestCase):
+    def tearDown(self):
+        message_buffer.unload()
+
+    def test_say(self):
+        with test_database(test_db, (Object, ObjectState, Message, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken")
+
+            Script(chicken).say("Bawk!")
+
+            self.assertEqual(["Bawk!"], [m.message for m in Message.select()])
+
+    def test_say_buffered(self):
+        '''Once the zone's messages are loaded, saying something waits
+        for the next flush.'''
+        with test_database(test_db, (Object, ObjectState, Message, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken")
+            message_buffer.load()
+
+            Script(chicken).say("Bawk!")
+            self.assertEqual(0, Message.select().count())
+
+            message_buffer.flush()
+            self.assertEqual(["Bawk!"], [m.message for m in message_buffer.get_messages()])
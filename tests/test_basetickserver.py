@@ -0,0 +1,85 @@
+import unittest
+
+import sys
+sys.path.append(".")
+
+from basetickserver import BaseTickServer
+
+class FakeClock(object):
+    '''Time that only passes when something sleeps or does work.'''
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+class TickServer(BaseTickServer):
+    '''Takes costs[n] seconds for its nth tick, and stops after the last.'''
+    def __init__(self, costs):
+        super(TickServer, self).__init__()
+        self.tick_length = 0.1
+        self.costs = list(costs)
+        self.clock = FakeClock()
+        self.sleep = self.clock.sleep
+        self.started = []
+
+    def tick(self):
+        self.started.append(self.clock.now)
+        self.clock.now += self.costs.pop(0)
+        if not self.costs:
+            self.stop()
+
+class TestBaseTickServer(unittest.TestCase):
+    def test_sleeps_between_ticks(self):
+        '''Idle ticks sleep out the rest of their tick_length instead of spinning.'''
+        server = TickServer([0.02] * 3)
+        server.start()
+
+        self.assertEqual(3, server.current_tick)
+        for slept in server.clock.slept:
+            self.assertAlmostEqual(0.08, slept)
+        for i, started in enumerate(server.started):
+            self.assertAlmostEqual(100.0 + i * 0.1, started)
+
+    def test_catches_up(self):
+        '''A long tick is made up for by running the next ones straight away.'''
+        server = TickServer([0.25, 0, 0, 0, 0])
+        server.start()
+
+        expected = [100.0, 100.25, 100.25, 100.3, 100.4]
+        for want, started in zip(expected, server.started):
+            self.assertAlmostEqual(want, started)
+        self.assertEqual(0, server.skipped)
+        self.assertEqual(1, server.stats()['overruns'])
+        self.assertAlmostEqual(0.15, server.stats()['worst_lateness'])
+
+    def test_max_frameskip(self):
+        '''Past max_frameskip ticks behind, the rest are dropped.'''
+        server = TickServer([2.0] + [0] * 4)
+        server.tick_length = 0.25
+        server.max_frameskip = 3
+        server.start()
+
+        # Nine ticks were due by the time the first one finished. The
+        # next two ran, the five after them were dropped, and the one
+        # due right now runs straight away.
+        self.assertEqual(5, server.skipped)
+        self.assertEqual([100.0, 102.0, 102.0, 102.0, 102.25], server.started)
+
+    def test_stats(self):
+        server = TickServer([0.02, 0.04])
+        server.start()
+
+        stats = server.stats()
+        self.assertEqual(2, stats['ticks'])
+        self.assertEqual(0, stats['overruns'])
+        self.assertAlmostEqual(0.03, stats['mean_tick'])
+        self.assertAlmostEqual(0.04, stats['worst_tick'])
+
+        server.reset_stats()
+        self.assertEqual(0, server.stats()['ticks'])
@@ -1,13 +1,25 @@
 import unittest
 
+import os
+import json
+import sqlite3
+import tempfile
+import datetime
+
 import sys
 sys.path.append(".")
 
-from elixir_models import db, User, Character
+from mock import Mock, patch
+
+from elixir_models import db, User, Character, Object, ObjectState, Message, Sequence, Tombstone, object_grid, object_fragments, zone_state
+from elixir_models import MessageBuffer
 from elixir_models import setup as elixir_models_setup
+import elixir_models
 
 from playhouse.test_utils import test_database
 
+from wireformat import pack_object
+
 from playhouse.sqlite_ext import SqliteExtDatabase
 test_db = SqliteExtDatabase(':memory:')
 
@@ -40,7 +52,825 @@ class TestCharacter(unittest.TestCase):
         # self.assertEqual(expected, character.__repr__())
         pass # TODO: implement your test here
 
+class TestObject(unittest.TestCase):
+    def test_get_objects_ids(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            first = Object.create(name="First")
+            Object.create(name="Second")
+            third = Object.create(name="Third")
+
+            result = Object.get_objects(ids=set([first.id, third.id]))
+            self.assertEqual(set([first.id, third.id]), set(o.id for o in result))
+            self.assertEqual([], Object.get_objects(ids=[]))
+
+    def test_get_objects_many_ids(self):
+        '''More ids than go in one statement get looked up in chunks.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)), \
+                patch('elixir_models.MAX_QUERY_IDS', 10):
+            Object.bulk_create([Object(name="Chicken %d" % i) for i in xrange(25)])
+            ids = [o.id for o in Object.select()]
+
+            self.assertEqual(set(ids), set(o.id for o in Object.get_objects(ids=ids)))
+            self.assertEqual(25, len(Object.get_nearby(0, 0, 10)))
+
+            latest = Object.get_objects(ids=ids, after=0, limit=3)
+            self.assertEqual(sorted(o.change_seq for o in Object.select())[:3],
+                             [o.change_seq for o in latest])
+            self.assertEqual(latest[0], Object.get_objects(ids=ids, after=0, limit=1))
+
+    def test_get_objects_limit_one(self):
+        '''Asking for just one object gets the object itself.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            obj = Object.create(name="Groxnor", states=['player'])
+
+            self.assertEqual(obj, Object.get_objects(limit=1, player="Groxnor"))
+            with self.assertRaises(Object.DoesNotExist):
+                Object.get_objects(limit=1, player="Nobody")
+
+class TestObjectState(unittest.TestCase):
+    def states(self, obj):
+        return sorted(s.state for s in ObjectState.select().where(ObjectState.obj == obj.id))
+
+    def test_save_writes_states(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player', 'online'])
+            self.assertEqual(['online', 'player'], self.states(groxnor))
+
+            groxnor.states.remove('online')
+            groxnor.states.append('offline')
+            groxnor.save()
+            self.assertEqual(['offline', 'player'], self.states(groxnor))
+
+    def test_get_objects_states(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Groxnor", states=['player', 'hidden'])
+            Object.create(name="Ghost", states=['hidden'])
+            Object.create(name="Barrel")
+
+            self.assertEqual(set(["Groxnor", "Ghost"]),
+                             set(o.name for o in Object.get_objects(states=['hidden'])))
+            self.assertEqual(["Groxnor"], [o.name for o in Object.get_objects(states=['hidden', 'player'])])
+            self.assertEqual([], Object.get_objects(states=['clickable']))
+
+    def test_player_ignores_name_in_other_states(self):
+        '''Only the object in the player state is the player, not just
+        anything with "player" somewhere in its states.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Groxnor", states=['playerlike'])
+            self.assertRaises(Object.DoesNotExist, Object.get_objects, limit=1, player="Groxnor")
+
+    def test_delete_instance_removes_states(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player'])
+            groxnor.delete_instance()
+
+            self.assertEqual(0, ObjectState.select().count())
+
+class TestBulkCreate(unittest.TestCase):
+    def setUp(self):
+        object_grid.clear()
+
+    def tearDown(self):
+        zone_state.unload()
+        object_grid.clear()
+
+    def test_bulk_create(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            first = Object.create(name="First")
+            barrels = [Object(name="Barrel #%d" % i, loc_x=i, states=['closed']) for i in xrange(100)]
+
+            self.assertEqual(barrels, Object.bulk_create(barrels))
+
+            self.assertEqual(101, Object.select().count())
+            for i, barrel in enumerate(barrels):
+                self.assertEqual(barrel.name, Object.get(id=barrel.id).name)
+                self.assertEqual(first.change_seq + i + 1, barrel.change_seq)
+            self.assertEqual(barrels[-1].change_seq, Object.max_change_seq())
+            self.assertEqual(100, len(Object.get_objects(states=['closed'])))
+            self.assertEqual((99, 0, True), object_grid.get(barrels[-1].id))
+
+    def test_bulk_create_nothing(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            self.assertEqual([], Object.bulk_create([]))
+
+    def test_bulk_create_loaded(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            zone_state.load()
+            Object.bulk_create([Object(name="Barrel")])
+
+            self.assertEqual("Barrel", Object.get_objects(limit=1, name="Barrel").name)
+
+class TestLoadSnapshot(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        snapshot_db = SqliteExtDatabase(self.path)
+        with test_database(snapshot_db, (Object, ObjectState, Sequence, Tombstone), drop_tables=False):
+            Object.bulk_create([Object(name="Barrel #%d" % i, loc_x=i, states=['closed']) for i in xrange(3)])
+            elixir_models.mark_snapshot('abc123')
+        snapshot_db.execute_sql('PRAGMA user_version = %d' % elixir_models.SCHEMA_VERSION)
+        snapshot_db.close()
+        object_grid.clear()
+
+    def tearDown(self):
+        zone_state.unload()
+        object_grid.clear()
+        os.remove(self.path)
+
+    def test_load_snapshot(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            first = Object.create(name="First", states=['closed'])
+
+            self.assertEqual(3, elixir_models.load_snapshot(self.path))
+
+            barrels = list(Object.select().where(Object.name != "First").order_by(Object.id))
+            self.assertEqual(["Barrel #0", "Barrel #1", "Barrel #2"], [o.name for o in barrels])
+            self.assertEqual([first.id + 1, first.id + 2, first.id + 3], [o.id for o in barrels])
+            self.assertEqual([0, 1, 2], [o.loc_x for o in barrels])
+            self.assertEqual(4, len(Object.get_objects(states=['closed'])))
+            self.assertEqual(first.change_seq + 3, Object.max_change_seq())
+
+    def test_load_snapshot_loaded(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            zone_state.load()
+            elixir_models.load_snapshot(self.path)
+
+            self.assertEqual(3, len(zone_state.objects))
+            self.assertEqual((2, 0, True), object_grid.get(3))
+
+    def test_load_snapshot_version(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            self.assertEqual(None, elixir_models.load_snapshot(self.path, version='def456'))
+            self.assertEqual(0, Object.select().count())
+            self.assertEqual(3, elixir_models.load_snapshot(self.path, version='abc123'))
+
+    def test_load_snapshot_unmarked(self):
+        '''Snapshots from before they were marked aren't trusted with any
+        version of the zone's code.'''
+        conn = sqlite3.connect(self.path)
+        conn.execute('DROP TABLE snapshotmeta')
+        conn.commit()
+        conn.close()
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            self.assertEqual(None, elixir_models.load_snapshot(self.path, version='abc123'))
+            self.assertEqual(3, elixir_models.load_snapshot(self.path))
+
+    def test_load_snapshot_other_schema(self):
+        sqlite3.connect(self.path).execute('PRAGMA user_version = 1')
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            self.assertEqual(None, elixir_models.load_snapshot(self.path))
+            self.assertEqual(0, Object.select().count())
+
+class TestChangeSequence(unittest.TestCase):
+    def test_save_bumps_change_seq(self):
+        '''Every save gets a new, higher change_seq.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            first = Object.create(name="First")
+            second = Object.create(name="Second")
+            self.assertEqual((1, 2), (first.change_seq, second.change_seq))
+
+            first.save()
+            self.assertEqual(3, first.change_seq)
+            self.assertEqual(3, Object.max_change_seq())
+
+    def test_get_objects_after(self):
+        '''Only rows changed after the cursor, and up to the mark, are returned.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            first = Object.create(name="First")
+            second = Object.create(name="Second")
+            first.save()
+            Object.create(name="Third")
+
+            result = Object.get_objects(after=1, upto=3)
+
+            self.assertEqual(set([first.id, second.id]), set(o.id for o in result))
+
+    def test_max_change_seq_empty(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            self.assertEqual(0, Object.max_change_seq())
+
+    def test_change_seq_survives_delete(self):
+        '''Deleting the newest row doesn't hand its change_seq out again.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            first = Object.create(name="First")
+            second = Object.create(name="Second")
+            cursor = Object.max_change_seq()
+            second.delete_instance()
+
+            first.save()
+
+            self.assertGreater(first.change_seq, cursor)
+            self.assertEqual([first.id], [o.id for o in Object.get_objects(after=cursor)])
+
+    def test_sequences_are_separate(self):
+        with test_database(test_db, (Object, ObjectState, Message, Sequence, Tombstone)):
+            Object.create(name="First")
+            message = Message.create(message="Hi", sender="Groxnor", loc_x=0, loc_y=0, player_generated=True)
+
+            self.assertEqual(1, message.change_seq)
+            self.assertEqual(1, Object.max_change_seq())
+
+class TestObjectGrid(unittest.TestCase):
+    def setUp(self):
+        object_grid.clear()
+
+    def tearDown(self):
+        object_grid.clear()
+
+    def test_save_indexes_object(self):
+        '''Saving an object puts it in the grid at its new location.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            obj = Object.create(name="Barrel", loc_x=5, loc_y=5)
+            obj.loc_x = 50
+            obj.save()
+
+            self.assertEqual((50, 5, True), object_grid.get(obj.id))
+
+    def test_delete_instance_unindexes_object(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            obj = Object.create(name="Barrel")
+            obj.delete_instance()
+
+            self.assertNotIn(obj.id, object_grid)
+
+    def test_sync_picks_up_other_writers(self):
+        '''Rows written behind the grid's back show up after a sync.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.insert(name="Chicken", loc_x=1, loc_y=1,
+                          change_seq=Object.next_change_seq()).execute()
+            self.assertEqual(0, len(object_grid))
+
+            object_grid.sync()
+
+            self.assertEqual(1, len(object_grid))
+
+    def test_sync_drops_objects_deleted_elsewhere(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            gone = Object.create(name="Chicken")
+            kept = Object.create(name="Barrel")
+            object_grid.sync()
+            # Another process deletes it, so this grid isn't told directly.
+            Object.get(id=gone.id).delete_instance()
+            object_grid.insert(gone.id, gone.loc_x, gone.loc_y, gone.physical)
+
+            object_grid.sync()
+
+            self.assertNotIn(gone.id, object_grid)
+            self.assertIn(kept.id, object_grid)
+            self.assertEqual(Object.max_change_seq(), object_grid.synced)
+
+    def test_sync_keeps_reused_ids(self):
+        '''A tombstone older than the row now using its id doesn't remove it.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Tombstone.create(obj=5, change_seq=Object.next_change_seq())
+            Object.insert(id=5, name="Chicken", change_seq=Object.next_change_seq()).execute()
+
+            object_grid.sync()
+
+            self.assertIn(5, object_grid)
+
+    def test_get_nearby(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            near = Object.create(name="Near", loc_x=1, loc_y=1)
+            Object.create(name="Far", loc_x=100, loc_y=100)
+
+            result = Object.get_nearby(0, 0, 5)
+
+            self.assertEqual([near], result)
+
+    def test_collides(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            me = Object.create(name="Me", loc_x=0, loc_y=0)
+            Object.create(name="Ghost", loc_x=1, loc_y=0, physical=False)
+
+            # Neither ourselves nor non-physical things get in the way.
+            self.assertFalse(Object.collides(0, 0, 3, exclude=me.id))
+
+            Object.create(name="Wall", loc_x=0, loc_y=2)
+            self.assertTrue(Object.collides(0, 0, 3, exclude=me.id))
+
+class TestFragmentCache(unittest.TestCase):
+    def setUp(self):
+        object_fragments.clear()
+
+    def tearDown(self):
+        object_fragments.clear()
+
+    def test_get_reuses_fragment(self):
+        '''An object that hasn't changed isn't encoded again.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            barrel = Object.create(name="Barrel")
+            first = object_fragments.get(barrel)
+            barrel.name = "Not saved yet"
+            self.assertIs(first, object_fragments.get(Object.get(id=barrel.id)))
+            self.assertEqual("Barrel", json.loads(first)['name'])
+
+    def test_get_after_save(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            barrel = Object.create(name="Barrel")
+            object_fragments.get(barrel)
+            barrel.name = "Keg"
+            barrel.save()
+            self.assertEqual("Keg", json.loads(object_fragments.get(barrel))['name'])
+
+    def test_get_packed(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            barrel = Object.create(name="Barrel")
+            self.assertEqual(pack_object(barrel), object_fragments.get(barrel, packed=True))
+
+    def test_delete_forgets_object(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            barrel = Object.create(name="Barrel")
+            object_fragments.get(barrel)
+            barrel.delete_instance()
+            self.assertEqual(0, len(object_fragments))
+
+class TestZoneState(unittest.TestCase):
+    def setUp(self):
+        object_grid.clear()
+
+    def tearDown(self):
+        zone_state.unload()
+        object_grid.clear()
+
+    def test_load(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            barrel = Object.create(name="Barrel", loc_x=5, loc_y=5)
+            zone_state.load()
+
+            self.assertEqual([barrel.id], zone_state.objects.keys())
+            self.assertEqual(barrel.change_seq, Object.max_change_seq())
+            self.assertEqual([barrel.id], Object.get_nearby_ids(4, 4, 3))
+
+    def test_set_modified_waits_for_flush(self):
+        '''Changes are seen in memory straight away, but only written
+        to the database when the zone flushes.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Chicken")
+            zone_state.load()
+            chicken = Object.get_objects(limit=1, name="Chicken")
+            chicken.loc_x = 20
+            chicken.set_modified()
+
+            self.assertEqual(20, Object.get_objects(limit=1, name="Chicken").loc_x)
+            self.assertTrue(Object.collides(20, 0, 1))
+            self.assertEqual(0, Object.get(id=chicken.id).loc_x)
+
+            self.assertEqual(1, zone_state.flush())
+
+            self.assertEqual(20, Object.get(id=chicken.id).loc_x)
+            self.assertEqual(chicken.change_seq, Object.max_change_seq())
+            self.assertEqual(0, zone_state.flush())
+
+    def test_flush_picks_up_other_writers(self):
+        '''Rows other processes write show up in memory after a flush,
+        without replacing the instances anybody is holding.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken")
+            zone_state.load()
+            mine = zone_state.objects[chicken.id]
+            Object.update(loc_x=7, change_seq=Object.next_change_seq()).execute()
+            Object.insert(name="Barrel", change_seq=Object.next_change_seq()).execute()
+
+            zone_state.flush()
+
+            self.assertIs(mine, zone_state.objects[chicken.id])
+            self.assertEqual(7, mine.loc_x)
+            self.assertEqual(2, len(Object.get_objects()))
+
+    def test_flush_dirty_wins(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken")
+            zone_state.load()
+            Object.update(loc_x=7, change_seq=Object.next_change_seq()).execute()
+            mine = zone_state.objects[chicken.id]
+            mine.loc_x = 3
+            mine.set_modified()
+
+            zone_state.flush()
+
+            self.assertEqual(3, mine.loc_x)
+            self.assertEqual(3, Object.get(id=chicken.id).loc_x)
+
+    def test_get_objects(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Groxnor", states=['player'])
+            Object.create(name="Chicken", scripts=['games.objects.chicken'], physical=False)
+            zone_state.load()
+
+            self.assertEqual("Groxnor", Object.get_objects(limit=1, player="Groxnor").name)
+            self.assertEqual(["Chicken"], [o.name for o in Object.get_objects(scripted=True)])
+            self.assertEqual(["Chicken"], [o.name for o in Object.get_objects(physical=False)])
+            self.assertEqual(["Chicken"], [o.name for o in Object.get_objects(after=1)])
+            self.assertRaises(Object.DoesNotExist, Object.get_objects, limit=1, player="Nobody")
+            self.assertEqual(["Groxnor"], [o.name for o in Object.get_objects(states=['player'])])
+
+    def test_get_nearby(self):
+        '''Nearby objects are the in-memory ones, not copies from before
+        the last flush.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Near", loc_x=1, loc_y=1)
+            far = Object.create(name="Far", loc_x=100, loc_y=100)
+            zone_state.load()
+            mine = zone_state.objects[far.id]
+            mine.loc_x, mine.loc_y = 2, 2
+            mine.set_modified()
+
+            with patch.object(Object, 'select', side_effect=AssertionError("Went to the database.")):
+                result = Object.get_nearby(0, 0, 5)
+
+            self.assertEqual(2, len(result))
+            self.assertIn(mine, result)
+            for o in result:
+                self.assertIs(zone_state.objects[o.id], o)
+
+    def test_lookups_skip_unrelated_objects(self):
+        '''Looking up a name or a player only looks at the objects with
+        that name, however big the zone is.'''
+        class Untouchable(object):
+            def __getattr__(self, attr):
+                raise AssertionError("Looked at an unrelated object's %s." % attr)
+
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player'])
+            barrel = Object.create(name="Barrel")
+            chickens = Object.bulk_create([Object(name="Chicken") for i in xrange(10)])
+            zone_state.load()
+            for chicken in chickens:
+                zone_state.objects[chicken.id] = Untouchable()
+
+            self.assertEqual(groxnor.id, Object.get_objects(limit=1, player="Groxnor").id)
+            self.assertEqual([barrel.id], [o.id for o in Object.get_objects(name="Barrel")])
+            self.assertEqual([], Object.get_objects(player="Barrel"))
+            self.assertRaises(Object.DoesNotExist, Object.get_objects, limit=1, player="Nobody")
+
+    def test_name_index(self):
+        '''Renamed, deleted and new objects are found under their new names.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player'])
+            zone_state.load()
+
+            mine = zone_state.objects[groxnor.id]
+            mine.name = "Grox"
+            mine.set_modified()
+            # Made in another process.
+            Object.insert(name="Groxnor", states=['player'], change_seq=Object.next_change_seq()).execute()
+            zone_state.sync()
+
+            self.assertEqual(groxnor.id, Object.get_objects(limit=1, player="Grox").id)
+            self.assertNotEqual(groxnor.id, Object.get_objects(limit=1, player="Groxnor").id)
+
+            mine.delete_instance()
+            self.assertEqual([], Object.get_objects(name="Grox"))
+            self.assertNotIn("Grox", zone_state.players)
+
+    def test_online_index(self):
+        '''Who's online is kept track of as objects change, however they
+        change, so looking it up doesn't go through the whole zone.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player', 'online'])
+            Object.bulk_create([Object(name="Chicken", states=['alive']) for i in xrange(10)])
+            zone_state.load()
+            self.assertEqual(set([groxnor.id]), zone_state.online)
+
+            # Coming online in another process.
+            bleeblebox = Object.create(name="Bleeblebox", states=['player', 'offline'])
+            Object.update(states=['player', 'online'], change_seq=Object.next_change_seq()).where(
+                Object.id == bleeblebox.id).execute()
+            zone_state.sync()
+            # Going offline here.
+            mine = zone_state.objects[groxnor.id]
+            mine.states = ['player', 'offline']
+            mine.set_modified()
+
+            self.assertEqual(set([bleeblebox.id]), zone_state.online)
+            self.assertEqual(["Bleeblebox"], [o.name for o in Object.get_objects(states=['player', 'online'])])
+            self.assertEqual([], Object.get_objects(states=['online'], ids=[groxnor.id]))
+
+            Object.get(id=bleeblebox.id).delete_instance()
+            self.assertEqual(set(), zone_state.online)
+
+    def test_flush_writes_states(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player'])
+            zone_state.load()
+            mine = zone_state.objects[groxnor.id]
+            mine.states.append('online')
+            mine.set_modified()
+
+            zone_state.flush()
+
+            self.assertEqual(2, ObjectState.select().count())
+
+    def test_flush_leaves_unchanged_states(self):
+        '''Objects read from the database, at load() or by a later sync,
+        don't have their ObjectState rows rewritten unless their states change.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player'])
+            zone_state.load()
+            Object.insert(name="Chicken", states=['alive'], change_seq=Object.next_change_seq()).execute()
+            zone_state.sync()
+            # Rows that a rewrite would throw away.
+            for obj in zone_state.objects.values():
+                ObjectState.create(obj=obj.id, state='marker')
+                obj.loc_x = 5
+                obj.set_modified()
+
+            zone_state.flush()
+
+            self.assertEqual(2, ObjectState.select().where(ObjectState.state == 'marker').count())
+            self.assertEqual(('player',), zone_state.objects[groxnor.id]._saved_states)
+
+    def test_flush_writes_in_one_batch(self):
+        '''Flushing doesn't save() the objects one by one.'''
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            Object.bulk_create([Object(name="Chicken #%d" % i) for i in xrange(5)])
+            zone_state.load()
+            for chicken in zone_state.objects.values():
+                chicken.loc_x = chicken.id
+                chicken.set_modified()
+            before = Object.max_change_seq()
+
+            with patch.object(Object, 'save') as save:
+                self.assertEqual(5, zone_state.flush())
+            self.assertFalse(save.called)
+
+            zone_state.load()
+            self.assertEqual(range(before + 1, before + 6),
+                             sorted(o.change_seq for o in zone_state.objects.values()))
+            self.assertEqual([o.id for o in zone_state.objects.values()],
+                             [o.loc_x for o in zone_state.objects.values()])
+
+    def test_flush_skips_objects_deleted_elsewhere(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken", states=['alive'])
+            zone_state.load()
+            mine = zone_state.objects[chicken.id]
+            mine.states.append('whole')
+            mine.set_modified()
+            # Another process deletes it, so this zone state isn't told directly.
+            Object.get(id=chicken.id).delete_instance()
+            zone_state.objects[chicken.id] = mine
+            zone_state.dirty.add(chicken.id)
+
+            zone_state.flush()
+
+            self.assertEqual(0, Object.select().count())
+            self.assertEqual(0, ObjectState.select().count())
+            self.assertEqual({}, zone_state.objects)
+
+    def test_sync_drops_objects_deleted_elsewhere(self):
+        with test_database(test_db, (Object, ObjectState, Sequence, Tombstone)):
+            chicken = Object.create(name="Chicken")
+            barrel = Object.create(name="Barrel")
+            zone_state.load()
+            Tombstone.create(obj=chicken.id, change_seq=Object.next_change_seq())
+            Object.delete().where(Object.id == chicken.id).execute()
+
+            zone_state.sync()
+
+            self.assertEqual([barrel.id], zone_state.objects.keys())
+            self.assertNotIn(chicken.id, object_grid)
+            self.assertEqual(Object.max_change_seq(), zone_state.synced)
+
+class TestMessageBuffer(unittest.TestCase):
+    def setUp(self):
+        self.buffer = MessageBuffer(size=3)
+
+    def say(self, message):
+        return Message(message=message, sender="Chicken", loc_x=0, loc_y=0, player_generated=False)
+
+    def test_load(self):
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            for i in range(5):
+                self.say(str(i)).save()
+            self.buffer.load()
+
+            self.assertEqual(['2', '3', '4'], [m.message for m in self.buffer.get_messages()])
+            self.assertEqual(5, self.buffer.synced)
+
+    def test_add_waits_for_flush(self):
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            self.buffer.load()
+            self.buffer.add(self.say("Bawk"))
+            self.buffer.add(self.say("Bawk bawk"))
+
+            self.assertEqual([], self.buffer.get_messages())
+            self.assertEqual(0, Message.select().count())
+
+            self.assertEqual(2, self.buffer.flush())
+
+            self.assertEqual(2, Message.select().count())
+            self.assertEqual(["Bawk bawk"], [m.message for m in self.buffer.get_messages(after=1)])
+
+    def test_flush_picks_up_other_writers(self):
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            self.buffer.load()
+            self.say("From the ScriptServer").save()
+
+            self.buffer.flush()
+
+            self.assertEqual(1, len(self.buffer))
+
+    def test_bounded(self):
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            self.buffer.load()
+            for i in range(5):
+                self.buffer.add(self.say(str(i)))
+            self.buffer.flush()
+
+            self.assertEqual(3, len(self.buffer))
+            self.assertEqual(['3', '4'], [m.message for m in self.buffer.get_messages(after=3)])
+
+    def test_add_not_loaded(self):
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            self.buffer.add(self.say("Bawk"))
+
+            self.assertEqual(1, Message.select().count())
+
+class TestMessagePrune(unittest.TestCase):
+    def say(self, message, sent, player_generated=False):
+        return Message.create(message=message, sender="Chicken", loc_x=0, loc_y=0,
+                              player_generated=player_generated, sent=sent)
+
+    def test_prune(self):
+        '''Only the newest non-player messages are kept.'''
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            now = datetime.datetime.now()
+            for i in range(5):
+                self.say(str(i), now + datetime.timedelta(seconds=i))
+            self.say("Hello", now - datetime.timedelta(days=1), player_generated=True)
+
+            self.assertEqual(3, Message.prune(2))
+
+            self.assertEqual(['3', '4', 'Hello'], sorted(m.message for m in Message.select()))
+
+    def test_prune_same_time(self):
+        '''Messages sent at the same moment are told apart by id.'''
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            now = datetime.datetime.now()
+            for i in range(4):
+                self.say(str(i), now)
+
+            self.assertEqual(1, Message.prune(3))
+
+            self.assertEqual(['1', '2', '3'], sorted(m.message for m in Message.select()))
+
+    def test_prune_nothing_to_do(self):
+        with test_database(test_db, (Message, Sequence, Tombstone)):
+            self.say("Bawk", datetime.datetime.now())
+
+            self.assertEqual(0, Message.prune(2))
+            self.assertEqual(1, Message.select().count())
+
 class TestSetup(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        db.close()
+        db.init(None)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def connect(self):
+        '''Another process's connection to the same file.'''
+        conn = sqlite3.connect(self.path, timeout=0, isolation_level=None)
+        self.addCleanup(conn.close)
+        return conn
+
     def test_setup(self):
-        # self.assertEqual(expected, setup(db_uri, echo))
-        pass # TODO: implement your test here
+        elixir_models_setup(db_uri=self.path)
+
+        self.assertEqual(elixir_models.SCHEMA_VERSION, elixir_models.schema_version())
+        self.assertEqual('wal', db.execute_sql('PRAGMA journal_mode').fetchone()[0])
+        # NORMAL
+        self.assertEqual(1, db.execute_sql('PRAGMA synchronous').fetchone()[0])
+        self.assertEqual(5000, db.execute_sql('PRAGMA busy_timeout').fetchone()[0])
+
+    def test_migrate_object_states(self):
+        '''Objects in a database from before ObjectState get their rows.'''
+        elixir_models_setup(db_uri=self.path)
+        db.execute_sql('DROP TABLE objectstate')
+        db.execute_sql('PRAGMA user_version = 3')
+        Object.insert(name="Groxnor", states=['player', 'online']).execute()
+        db.close()
+
+        elixir_models_setup(db_uri=self.path)
+
+        self.assertEqual(["Groxnor"], [o.name for o in Object.get_objects(states=['online'])])
+
+    def create_version_0(self):
+        '''A database file from before there were any migrations.'''
+        reals = ', '.join('"%s" REAL NOT NULL' % name for name in
+                          ('loc_x', 'loc_y', 'loc_z', 'rot_x', 'rot_y', 'rot_z',
+                           'scale_x', 'scale_y', 'scale_z', 'speed', 'vel_x', 'vel_y', 'vel_z'))
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE "object" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, '
+                     '"resource" VARCHAR(255) NOT NULL, "owner" VARCHAR(255), %s, "states" JSON NOT NULL, '
+                     '"physical" INTEGER NOT NULL, "last_modified" DATETIME NOT NULL, '
+                     '"scripts" JSON NOT NULL)' % reals)
+        conn.execute('CREATE TABLE "message" ("id" INTEGER NOT NULL PRIMARY KEY, "message" VARCHAR(255) NOT NULL, '
+                     '"sender" VARCHAR(255) NOT NULL, "loc_x" REAL NOT NULL, "loc_y" REAL NOT NULL, '
+                     '"loc_z" REAL NOT NULL, "player_generated" INTEGER NOT NULL)')
+        conn.execute('INSERT INTO object VALUES (1, "Groxnor", "none", NULL, %s, \'["player"]\', 1, '
+                     '"2012-01-01 00:00:00", "[]")' % ', '.join(['0'] * 13))
+        conn.execute('INSERT INTO message VALUES (1, "Bawk", "Chicken", 0, 0, 0, 0)')
+        conn.commit()
+        conn.close()
+
+    def assertCurrent(self):
+        '''Every migration step's changes are there.'''
+        self.assertEqual(elixir_models.SCHEMA_VERSION, elixir_models.schema_version())
+        tables = db.get_tables()
+        for table in ('message', 'object'):
+            self.assertIn('change_seq', elixir_models._columns(table))
+            self.assertIn(table + '_change_seq', elixir_models._indexes(table))
+        self.assertIn('sent', elixir_models._columns('message'))
+        self.assertIn('message_player_generated_sent', elixir_models._indexes('message'))
+        for columns, unique in Object._meta.indexes:
+            self.assertIn('_'.join(('object',) + tuple(columns)), elixir_models._indexes('object'))
+        for table in ('objectstate', 'sequence', 'tombstone'):
+            self.assertIn(table, tables)
+
+    def test_migrate_from_version_0(self):
+        self.create_version_0()
+
+        elixir_models_setup(db_uri=self.path)
+
+        self.assertCurrent()
+        self.assertEqual(["Groxnor"], [o.name for o in Object.get_objects(states=['player'])])
+        self.assertEqual(["Bawk"], [m.message for m in Message.select()])
+        # New changes come after the rows already there.
+        self.assertEqual(1, Object.create(name="Chicken").change_seq)
+
+    def test_migrate_from_intermediate_version(self):
+        '''Only the steps past the file's version run.'''
+        elixir_models_setup(db_uri=self.path)
+        Object.create(name="Groxnor")
+        Object.create(name="Chicken")
+        db.execute_sql('DROP TABLE sequence')
+        db.execute_sql('DROP TABLE tombstone')
+        db.execute_sql('PRAGMA user_version = 4')
+        db.close()
+
+        steps = [(version, Mock(wraps=step)) for version, step in elixir_models.MIGRATIONS]
+        with patch('elixir_models.MIGRATIONS', steps):
+            elixir_models_setup(db_uri=self.path)
+
+        self.assertEqual([False] * 4 + [True] * 2, [step.called for version, step in steps])
+        self.assertCurrent()
+        # The counter carries on from the highest change_seq.
+        self.assertEqual(2, Sequence.current('object'))
+        self.assertEqual(3, Object.create(name="Barrel").change_seq)
+
+    def test_migrate_current(self):
+        '''A database that's already up to date is left alone.'''
+        elixir_models_setup(db_uri=self.path)
+        db.close()
+
+        steps = [(version, Mock()) for version, step in elixir_models.MIGRATIONS]
+        with patch('elixir_models.MIGRATIONS', steps):
+            elixir_models_setup(db_uri=self.path)
+
+        self.assertFalse(any(step.called for version, step in steps))
+        self.assertCurrent()
+
+    def test_reader_does_not_block_writes(self):
+        '''Somebody in the middle of reading doesn't stop a tick's writes
+        from being committed.'''
+        elixir_models_setup(db_uri=self.path, pragmas=(('journal_mode', 'wal'), ('busy_timeout', 0)))
+        Object.create(name="Chicken")
+        reader = self.connect()
+        reader.execute('BEGIN')
+        self.assertEqual(1, reader.execute('SELECT count(*) FROM object').fetchone()[0])
+
+        with db.atomic():
+            Object.create(name="Barrel")
+
+        # The reader still sees the zone as it was when it started reading.
+        self.assertEqual(1, reader.execute('SELECT count(*) FROM object').fetchone()[0])
+        reader.execute('COMMIT')
+        self.assertEqual(2, reader.execute('SELECT count(*) FROM object').fetchone()[0])
+
+    def test_writes_do_not_block_readers(self):
+        elixir_models_setup(db_uri=self.path, pragmas=(('journal_mode', 'wal'), ('busy_timeout', 0)))
+        Object.create(name="Chicken")
+
+        with db.atomic():
+            Object.create(name="Barrel")
+            self.assertEqual(1, self.connect().execute('SELECT count(*) FROM object').fetchone()[0])
+
+    def test_rollback_journal_blocks(self):
+        '''Without WAL, the same reader stops the writer committing.'''
+        elixir_models_setup(db_uri=self.path, pragmas=(('journal_mode', 'delete'), ('busy_timeout', 0)))
+        reader = self.connect()
+        reader.execute('BEGIN')
+        reader.execute('SELECT count(*) FROM object').fetchone()
+
+        with self.assertRaises(sqlite3.OperationalError):
+            with db.atomic():
+                Object.create(name="Barrel")
+        db.rollback()
@@ -0,0 +1,59 @@
+import unittest
+from mock import Mock, patch
+
+import sys
+sys.path.append(".")
+
+from scriptregistry import ScriptRegistry
+from games.objects.basescript import Script
+
+class Chicken(Script):
+    pass
+
+class TestScriptRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = ScriptRegistry()
+        # Script itself and things that aren't classes are left out.
+        self.module = Mock(spec=['Chicken', 'Script', 'random'],
+                           Chicken=Chicken, Script=Script, random=Mock())
+
+    def test_get(self):
+        with patch.dict('sys.modules', {'games.objects.fakechicken': self.module}):
+            self.assertEqual([Chicken], self.registry.get('games.objects.fakechicken'))
+
+    def test_get_looks_once(self):
+        '''The module is only looked through the first time.'''
+        with patch.dict('sys.modules', {'games.objects.fakechicken': self.module}):
+            with patch.object(ScriptRegistry, 'find', return_value=[Chicken]) as find:
+                self.registry.get('games.objects.fakechicken')
+                self.registry.get('games.objects.fakechicken')
+
+        self.assertEqual(1, find.call_count)
+
+    def test_instances(self):
+        obj = Mock(scripts=['games.objects.fakechicken'])
+        with patch.dict('sys.modules', {'games.objects.fakechicken': self.module}):
+            first = self.registry.instances(obj)
+            second = self.registry.instances(obj)
+
+        self.assertEqual([obj], [s.me_obj for s in first])
+        # Every activation still gets its own instance.
+        self.assertIsNot(first[0], second[0])
+
+    def test_forget(self):
+        with patch.dict('sys.modules', {'games.objects.fakechicken': self.module}):
+            self.registry.get('games.objects.fakechicken')
+            self.registry.forget('games.objects.fakechicken')
+            self.assertEqual(0, len(self.registry))
+
+            self.module.Chicken = Script
+            self.assertEqual([], self.registry.get('games.objects.fakechicken'))
+
+    def test_reload(self):
+        with patch('scriptregistry.reload', create=True) as mock_reload:
+            with patch.dict('sys.modules', {'games.objects.fakechicken': self.module}):
+                self.registry.get('games.objects.fakechicken')
+                self.registry.reload('games.objects.fakechicken')
+
+        mock_reload.assert_called_once_with(self.module)
+        self.assertEqual(0, len(self.registry))
@@ -1,34 +1,53 @@
 import unittest
 from mock import patch, Mock
 
+import os
+import json
+import shutil
+import tempfile
+
 import sys
 sys.path.append(".")
-from scriptserver import ZoneScriptRunner
+from scriptserver import ZoneScriptRunner, MessageRetention, ScriptScheduler, ScriptProfiler, TickTimes, ScriptLOD
+from scriptserver import ScriptEventHandler
+from elixir_models import Object, ObjectState, Sequence, Tombstone, object_grid
+from playhouse.test_utils import test_database
+from peewee import SqliteDatabase
+from scriptregistry import ScriptRegistry
 
 class TestZoneScriptRunner(unittest.TestCase):
 
     def test___init__(self):
         zoneid = "zoneid"
         with patch('scriptserver.Object'):
-            with patch.object(ZoneScriptRunner, 'load_scripts') as mock_load_scripts:
-                zone_script_runner = ZoneScriptRunner(zoneid)
-                self.assertTrue(zone_script_runner)
+            with patch('scriptserver.zone_state') as mock_zone_state:
+                with patch('scriptserver.message_buffer'):
+                    with patch.object(ZoneScriptRunner, 'load_scripts') as mock_load_scripts:
+                        zone_script_runner = ZoneScriptRunner(zoneid)
+                        self.assertTrue(zone_script_runner)
         self.assertEqual(1, mock_load_scripts.call_count)
+        self.assertTrue(mock_zone_state.load.called)
 
     def test_load_scripts(self):
         expected = {}
         zoneid = "zoneid"
         with patch('scriptserver.Object'):
             with patch.object(ZoneScriptRunner, 'load_scripts'):
-                with patch('scriptserver.Object'):
-                    zone_script_runner = ZoneScriptRunner(zoneid)
+                with patch('scriptserver.zone_state'):
+                    with patch('scriptserver.message_buffer'):
+                        zone_script_runner = ZoneScriptRunner(zoneid)
+
+        from games.objects.basescript import Script
 
-        with patch('scriptserver.ScriptedObject') as ScriptedObject:
+        class Chicken(Script):
+            pass
+
+        MockThing = Mock()
+        MockThing.fake.chicken = Mock(Chicken=Chicken)
+        with patch('scriptserver.script_registry', ScriptRegistry()):
             with patch('scriptserver.Object') as MockObject:
-                MockThing = Mock()
                 with patch.dict('sys.modules', {'thing': MockThing, 'thing.fake': MockThing.fake,
                                                 'thing.fake.chicken': MockThing.fake.chicken}):
-                    MockThing.fake.chicken.Chicken.tick = Mock()
                     MockScriptedObject = Mock()
                     MockScriptedObject.scripts = ['thing.fake.chicken']
                     MockObject.get_objects.return_value = [MockScriptedObject]
@@ -36,6 +55,7 @@ class TestZoneScriptRunner(unittest.TestCase):
 
         self.assertNotEqual(expected, result)
         self.assertIn('thing.fake.chicken', result)
+        self.assertEqual([MockScriptedObject], [c.me_obj for c in result['thing.fake.chicken']])
 
     def test_start(self):
         # zone_script_runner = ZoneScriptRunner(zoneid)
@@ -43,6 +63,468 @@ class TestZoneScriptRunner(unittest.TestCase):
         pass # TODO: implement your test here
 
     def test_tick(self):
-        # zone_script_runner = ZoneScriptRunner(zoneid)
-        # self.assertEqual(expected, zone_script_runner.tick())
-        pass # TODO: implement your test here
+        with patch('scriptserver.Object'):
+            with patch('scriptserver.zone_state'):
+                with patch('scriptserver.message_buffer'):
+                    with patch.object(ZoneScriptRunner, 'load_scripts'):
+                        zone_script_runner = ZoneScriptRunner("zoneid")
+
+        script = Mock(tick_interval=0, tick=Mock(return_value=None))
+        zone_script_runner.scheduler = ScriptScheduler()
+        zone_script_runner.scheduler.add(script)
+        zone_script_runner.lod = Mock()
+        with patch('scriptserver.zone_state') as mock_zone_state:
+            with patch('scriptserver.message_buffer') as mock_message_buffer:
+                with patch('scriptserver.Message'):
+                    zone_script_runner.tick()
+
+        self.assertTrue(script.tick.called)
+        self.assertTrue(zone_script_runner.lod.update.called)
+        # Whatever the scripts changed or said gets written out once, after they all ran.
+        mock_zone_state.flush.assert_called_once_with()
+        mock_message_buffer.flush.assert_called_once_with()
+
+    def runner(self, shard, shards):
+        with patch('scriptserver.Object'):
+            with patch('scriptserver.zone_state'):
+                with patch('scriptserver.message_buffer'):
+                    with patch.object(ZoneScriptRunner, 'load_scripts'):
+                        return ZoneScriptRunner("zoneid", shard=shard, shards=shards)
+
+    def test_load_scripts_shard(self):
+        '''Each shard only runs the scripts of its own objects.'''
+        from games.objects.basescript import Script
+
+        class Chicken(Script):
+            pass
+
+        objects = [Mock(id=objid, scripts=['thing.chicken']) for objid in (1, 2, 3)]
+        runners = [self.runner(shard, 2) for shard in (0, 1)]
+        loaded = []
+        with patch('scriptserver.script_registry', Mock(get=Mock(return_value=[Chicken]))):
+            with patch('scriptserver.Object') as MockObject:
+                MockObject.get_objects.return_value = objects
+                for runner in runners:
+                    scripts = runner.load_scripts()
+                    loaded.append([s.me_obj.id for s in scripts['thing.chicken']])
+
+        self.assertEqual([[2], [1, 3]], loaded)
+
+    def test_shard_stats_and_retention(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with patch('settings.SCRIPT_STATS_FILE', os.path.join(directory, '%s.json')):
+            first, second = self.runner(0, 2), self.runner(1, 2)
+
+        self.assertTrue(first.profiler.path.endswith('zoneid-shard0.json'))
+        self.assertTrue(second.profiler.path.endswith('zoneid-shard1.json'))
+        # Only the first shard prunes messages.
+        self.assertIsNotNone(first.retention)
+        self.assertIsNone(second.retention)
+
+        second.scheduler = ScriptScheduler()
+        second.lod = None
+        second.profiler.last_write = -second.profiler.interval
+        with patch('scriptserver.zone_state'):
+            with patch('scriptserver.message_buffer'):
+                with patch('scriptserver.Message') as MockMessage:
+                    second.tick()
+
+        self.assertFalse(MockMessage.prune.called)
+        self.assertEqual(['zoneid-shard1.json'], os.listdir(directory))
+        with open(os.path.join(directory, 'zoneid-shard1.json')) as f:
+            stats = json.load(f)
+        self.assertIn('tick', stats)
+        self.assertNotIn('retention', stats)
+
+    def test_reload_script(self):
+        '''Only the changed script's instances are swapped for new ones.'''
+        from games.objects.basescript import Script
+
+        class OldChicken(Script):
+            def tick(self):
+                pass
+
+        class NewChicken(OldChicken):
+            pass
+
+        runner = self.runner(0, 1)
+        chicken = Mock(id=1, scripts=['games.objects.chicken'])
+        other = Mock(tick_interval=0, tick=Mock(return_value=None))
+        old = OldChicken(chicken)
+        runner.scripts = {'games.objects.chicken': [old], 'games.objects.other': [other]}
+        runner.scheduler = ScriptScheduler()
+        runner.scheduler.add(old)
+        runner.scheduler.add(other)
+
+        registry = Mock(get=Mock(return_value=[NewChicken]))
+        with patch('scriptserver.script_registry', registry):
+            with patch('scriptserver.Object') as MockObject:
+                MockObject.get_objects.return_value = [chicken]
+                self.assertTrue(runner.reload_script('games.objects.chicken'))
+
+        registry.reload.assert_called_once_with('games.objects.chicken')
+        new = runner.scripts['games.objects.chicken']
+        self.assertEqual([NewChicken], [type(c) for c in new])
+        self.assertIs(chicken, new[0].me_obj)
+        self.assertEqual(set([new[0], other]), set(entry[2] for entry in runner.scheduler.queue))
+
+    def test_reload_script_broken(self):
+        runner = self.runner(0, 1)
+        old = Mock(tick_interval=0, tick=Mock(return_value=None))
+        runner.scripts = {'games.objects.chicken': [old]}
+        runner.scheduler = ScriptScheduler()
+        runner.scheduler.add(old)
+
+        registry = Mock(reload=Mock(side_effect=SyntaxError("oops")))
+        with patch('scriptserver.script_registry', registry):
+            with patch('scriptserver.logger'):
+                self.assertFalse(runner.reload_script('games.objects.chicken'))
+
+        self.assertEqual([old], runner.scripts['games.objects.chicken'])
+        self.assertEqual(1, len(runner.scheduler))
+
+    def test_reload_script_broken_constructor(self):
+        '''New code that imports but can't be instantiated keeps the old
+        instances running too.'''
+        runner = self.runner(0, 1)
+        chicken = Mock(id=1, scripts=['games.objects.chicken'])
+        old = Mock(tick_interval=0, tick=Mock(return_value=None))
+        runner.scripts = {'games.objects.chicken': [old]}
+        runner.scheduler = ScriptScheduler()
+        runner.scheduler.add(old)
+        runner.profiler = Mock()
+
+        registry = Mock(get=Mock(return_value=[Mock(side_effect=KeyError('loc'))]))
+        with patch('scriptserver.script_registry', registry):
+            with patch('scriptserver.Object') as MockObject:
+                MockObject.get_objects.return_value = [chicken]
+                with patch('scriptserver.logger'):
+                    self.assertFalse(runner.reload_script('games.objects.chicken'))
+
+        self.assertEqual([old], runner.scripts['games.objects.chicken'])
+        self.assertEqual([old], [entry[2] for entry in runner.scheduler.queue])
+        self.assertFalse(runner.profiler.forget_scripts.called)
+
+    def test_reload_module(self):
+        runner = self.runner(0, 1)
+        runner.scripts = {'games.objects.chicken': []}
+        with patch.object(runner, 'reload_script') as reload_script:
+            with patch('tornado.autoreload._reload') as restart:
+                runner.reload_module('games.objects.chicken')
+                # Never imported, so nothing to do.
+                runner.reload_module('games.objects.unused')
+                self.assertFalse(restart.called)
+
+                # Everything else gets the whole process restarted.
+                runner.reload_module('games.objects.basescript')
+                self.assertTrue(restart.called)
+
+        reload_script.assert_called_once_with('games.objects.chicken')
+
+class TestScriptEventHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = ScriptEventHandler(delay=0.5)
+
+    def event(self, path, dest_path=None, is_directory=False):
+        event = Mock(src_path=os.path.join(os.getcwd(), path), is_directory=is_directory)
+        event.dest_path = dest_path and os.path.join(os.getcwd(), dest_path)
+        return event
+
+    def test_module_name(self):
+        module_name = ScriptEventHandler.module_name
+        self.assertEqual('games.objects.chicken', module_name(os.path.join('games', 'objects', 'chicken.py')))
+        self.assertEqual('games.objects', module_name(os.path.join('games', 'objects', '__init__.py')))
+        self.assertEqual(None, module_name(os.path.join('games', 'objects', 'chicken.pyc')))
+        self.assertEqual(None, module_name(os.path.join('log', 'scriptserver.log')))
+
+    def test_debounced(self):
+        '''A module is only ready once it's stopped changing for a bit.'''
+        self.handler.on_any_event(self.event('games/objects/chicken.py'), now=0)
+        self.handler.on_any_event(self.event('games/objects/chicken.py'), now=0.3)
+
+        self.assertEqual([], self.handler.ready(now=0.6))
+        self.assertEqual(['games.objects.chicken'], self.handler.ready(now=0.8))
+        self.assertEqual([], self.handler.ready(now=2))
+
+    def test_ignores_other_files(self):
+        self.handler.on_any_event(self.event('games/objects/chicken.pyc'), now=0)
+        self.handler.on_any_event(self.event('games/objects', is_directory=True), now=0)
+
+        self.assertEqual([], self.handler.ready(now=1))
+
+    def test_moved(self):
+        '''Editors that save by moving a temporary file into place count.'''
+        self.handler.on_any_event(self.event('games/objects/.chicken.py.swp', 'games/objects/chicken.py'), now=0)
+
+        self.assertEqual(['games.objects.chicken'], self.handler.ready(now=1))
+
+class TestScriptScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ScriptScheduler()
+
+    def script(self, tick_interval=0, wait=None):
+        return Mock(tick_interval=tick_interval, tick=Mock(return_value=wait))
+
+    def test_every_tick(self):
+        script = self.script()
+        self.scheduler.add(script, now=0)
+
+        self.assertEqual(1, self.scheduler.run(now=0))
+        self.assertEqual(1, self.scheduler.run(now=0.1))
+        self.assertEqual(2, script.tick.call_count)
+
+    def test_tick_interval(self):
+        script = self.script(tick_interval=10)
+        with patch('scriptserver.random.uniform', return_value=0):
+            self.scheduler.add(script, now=0)
+
+        self.assertEqual(1, self.scheduler.run(now=0))
+        self.assertEqual(0, self.scheduler.run(now=9))
+        self.assertEqual(1, self.scheduler.run(now=10))
+
+    def test_first_ticks_spread_out(self):
+        with patch('scriptserver.random.uniform', return_value=4) as uniform:
+            self.scheduler.add(self.script(tick_interval=10), now=0)
+
+        uniform.assert_called_once_with(0, 10)
+        self.assertEqual(0, self.scheduler.run(now=3))
+        self.assertEqual(1, self.scheduler.run(now=4))
+
+    def test_tick_returns_wait(self):
+        '''A script can say when it wants to be ticked next.'''
+        script = self.script(tick_interval=10, wait=2)
+        with patch('scriptserver.random.uniform', return_value=0):
+            self.scheduler.add(script, now=0)
+
+        self.scheduler.run(now=0)
+        self.assertEqual(1, self.scheduler.run(now=2))
+
+    def test_soonest_first(self):
+        order = []
+        late = self.script(tick_interval=5)
+        late.tick.side_effect = lambda: order.append('late')
+        early = self.script(tick_interval=5)
+        early.tick.side_effect = lambda: order.append('early')
+        with patch('scriptserver.random.uniform', side_effect=[3, 1]):
+            self.scheduler.add(late, now=0)
+            self.scheduler.add(early, now=0)
+
+        self.scheduler.run(now=5)
+        self.assertEqual(['early', 'late'], order)
+
+    def test_tick_raises(self):
+        '''A script that raises is tried again later, and the scripts due
+        after it still get ticked.'''
+        profiler = Mock()
+        scheduler = ScriptScheduler(profiler=profiler)
+        broken = self.script(tick_interval=5)
+        broken.tick.side_effect = ValueError("Bawk?")
+        fine = self.script(tick_interval=5)
+        with patch('scriptserver.random.uniform', side_effect=[1, 2]):
+            scheduler.add(broken, now=0)
+            scheduler.add(fine, now=0)
+
+        self.assertEqual(2, scheduler.run(now=2))
+        self.assertTrue(fine.tick.called)
+        self.assertEqual(2, len(scheduler))
+        self.assertEqual(2, profiler.record.call_count)
+
+        self.assertEqual(0, scheduler.run(now=6))
+        self.assertEqual(2, scheduler.run(now=7))
+        self.assertEqual(2, broken.tick.call_count)
+
+    def test_idle_scripts_not_scheduled(self):
+        from games.objects.basescript import Script
+
+        class Statue(Script):
+            pass
+
+        self.scheduler.add(Statue(), now=0)
+        self.assertEqual(0, len(self.scheduler))
+
+    def test_profiler(self):
+        profiler = Mock()
+        scheduler = ScriptScheduler(profiler=profiler)
+        script = self.script()
+        scheduler.add(script, now=0)
+
+        scheduler.run(now=0)
+
+        self.assertEqual(script, profiler.record.call_args[0][0])
+
+    def test_lod_slows_down(self):
+        lod = Mock(step=0.1, interval=0.5)
+        lod.slowdown.return_value = 4
+        scheduler = ScriptScheduler(lod=lod)
+        script = self.script()
+        scheduler.add(script, now=0)
+
+        scheduler.run(now=0)
+        # Scripts that want every tick get every fourth.
+        self.assertEqual(0, scheduler.run(now=0.39))
+        self.assertEqual(1, scheduler.run(now=0.4))
+
+    def test_lod_suspends(self):
+        lod = Mock(step=0.1, interval=0.5)
+        lod.slowdown.return_value = None
+        scheduler = ScriptScheduler(lod=lod)
+        script = self.script()
+        scheduler.add(script, now=0)
+
+        scheduler.run(now=0)
+        self.assertFalse(script.tick.called)
+
+        # Somebody came near, so it's ticked the next time it's checked.
+        lod.slowdown.return_value = 1
+        self.assertEqual(0, scheduler.run(now=0.4))
+        scheduler.run(now=0.5)
+        self.assertTrue(script.tick.called)
+
+class TestScriptLOD(unittest.TestCase):
+    def setUp(self):
+        object_grid.clear()
+        self.lod = ScriptLOD(tiers=((10, 1), (30, 4)), interval=1, refresh=10)
+
+    def tearDown(self):
+        object_grid.clear()
+
+    def slowdown(self, obj):
+        return self.lod.slowdown(Mock(me_obj=obj))
+
+    def test_tiers(self):
+        with test_database(SqliteDatabase(':memory:'), (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Groxnor", states=['player', 'online'])
+            near = Object.create(name="Near", loc_x=5)
+            far = Object.create(name="Far", loc_x=20)
+            gone = Object.create(name="Gone", loc_x=100)
+            Object.create(name="Sleepy", states=['player', 'offline'], loc_x=100)
+
+            self.assertEqual(1, self.lod.update(now=0))
+
+        self.assertEqual(1, self.slowdown(near))
+        self.assertEqual(4, self.slowdown(far))
+        self.assertEqual(None, self.slowdown(gone))
+
+    def test_update_when_characters_move(self):
+        with test_database(SqliteDatabase(':memory:'), (Object, ObjectState, Sequence, Tombstone)):
+            groxnor = Object.create(name="Groxnor", states=['player', 'online'])
+            Object.create(name="Bleeblebox", states=['player', 'online'], loc_x=1000)
+            chicken = Object.create(name="Chicken", loc_x=100)
+            self.assertEqual(2, self.lod.update(now=0))
+            self.assertEqual(None, self.slowdown(chicken))
+
+            # Too soon to look again.
+            groxnor.loc_x = 95
+            groxnor.save()
+            self.assertEqual(0, self.lod.update(now=0.5))
+
+            # Only the character that moved gets looked around again.
+            self.assertEqual(1, self.lod.update(now=1))
+            self.assertEqual(1, self.slowdown(chicken))
+
+            # Until it's time to look around everybody.
+            self.assertEqual(0, self.lod.update(now=2))
+            self.assertEqual(2, self.lod.update(now=11))
+
+    def test_nearest_character_wins(self):
+        with test_database(SqliteDatabase(':memory:'), (Object, ObjectState, Sequence, Tombstone)):
+            Object.create(name="Groxnor", states=['player', 'online'])
+            Object.create(name="Bleeblebox", states=['player', 'online'], loc_x=45)
+            chicken = Object.create(name="Chicken", loc_x=40)
+            self.lod.update(now=0)
+
+        self.assertEqual(1, self.slowdown(chicken))
+
+class TestTickTimes(unittest.TestCase):
+    def test_stats(self):
+        times = TickTimes(samples=100)
+        for ms in xrange(1, 201):
+            times.add(ms / 1000.0)
+
+        stats = times.stats()
+        self.assertEqual(200, stats['count'])
+        self.assertAlmostEqual(20.1, stats['total'])
+        self.assertEqual(0.2, stats['max'])
+        # Percentiles only look at the latest samples.
+        self.assertEqual(0.151, stats['p50'])
+        self.assertEqual(0.199, stats['p99'])
+
+    def test_stats_empty(self):
+        self.assertEqual(0.0, TickTimes().stats()['p99'])
+
+class TestScriptProfiler(unittest.TestCase):
+    def setUp(self):
+        self.profiler = ScriptProfiler(budget=0.01)
+
+    def chicken(self, objid):
+        from games.objects.basescript import Script
+
+        class Chicken(Script):
+            pass
+        obj = Mock(id=objid)
+        obj.name = "Chicken"
+        return Chicken(obj)
+
+    def test_record(self):
+        first, second = self.chicken(1), self.chicken(2)
+        self.profiler.record(first, 0.001)
+        self.profiler.record(first, 0.003)
+        self.profiler.record(second, 0.002)
+
+        stats = self.profiler.stats()
+        classname = __name__ + '.Chicken'
+        self.assertEqual([classname], stats['classes'].keys())
+        self.assertEqual(3, stats['classes'][classname]['count'])
+        # Slowest first.
+        self.assertEqual([0.004, 0.002], [s['total'] for s in stats['scripts']])
+        self.assertEqual(classname + ' #1 (Chicken)', stats['scripts'][0]['name'])
+
+    def test_over_budget_warns_once(self):
+        chicken = self.chicken(1)
+        with patch('scriptserver.logger') as mock_logger:
+            self.profiler.record(chicken, 0.005)
+            self.assertFalse(mock_logger.warning.called)
+
+            self.profiler.record(chicken, 0.05)
+            self.profiler.record(chicken, 0.05)
+            self.assertEqual(1, mock_logger.warning.call_count)
+
+    def test_write(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        profiler = ScriptProfiler(path=os.path.join(tempdir, 'stats.json'), interval=10)
+        profiler.record(self.chicken(1), 0.001)
+
+        self.assertFalse(profiler.due(profiler.last_write + 9))
+        self.assertTrue(profiler.due(profiler.last_write + 10))
+        profiler.write(tick={'ticks': 5})
+
+        with open(profiler.path) as f:
+            stats = json.load(f)
+        self.assertEqual(1, len(stats['scripts']))
+        self.assertEqual(5, stats['tick']['ticks'])
+        self.assertFalse(profiler.due())
+
+    def test_no_path_never_due(self):
+        self.assertFalse(self.profiler.due(self.profiler.last_write + 1000))
+
+class TestMessageRetention(unittest.TestCase):
+    def test_due(self):
+        retention = MessageRetention(keep=10, interval=30)
+
+        self.assertFalse(retention.due(retention.last_sweep + 29))
+        self.assertTrue(retention.due(retention.last_sweep + 30))
+
+    def test_sweep(self):
+        retention = MessageRetention(keep=10, interval=30)
+        with patch('scriptserver.Message') as MockMessage:
+            MockMessage.prune = Mock(return_value=7)
+            retention.sweep()
+            retention.sweep()
+
+        MockMessage.prune.assert_called_with(10)
+        stats = retention.stats()
+        self.assertEqual(2, stats['sweeps'])
+        self.assertEqual(14, stats['pruned'])
+        self.assertFalse(retention.due())
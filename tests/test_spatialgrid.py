@@ -0,0 +1,65 @@
+import unittest
+
+import sys
+sys.path.append(".")
+
+from spatialgrid import SpatialGrid
+
+class TestSpatialGrid(unittest.TestCase):
+    def setUp(self):
+        self.grid = SpatialGrid(cell_size=10)
+
+    def test_insert(self):
+        self.grid.insert('barrel', 1, 2, data=True)
+
+        self.assertIn('barrel', self.grid)
+        self.assertEqual(1, len(self.grid))
+        self.assertEqual((1, 2, True), self.grid.get('barrel'))
+
+    def test_insert_moves_between_cells(self):
+        '''Re-inserting a key moves it instead of duplicating it.'''
+        self.grid.insert('chicken', 1, 1)
+        self.grid.insert('chicken', 55, 55)
+
+        self.assertEqual(1, len(self.grid))
+        self.assertEqual([], self.grid.query(1, 1, 3))
+        self.assertEqual(['chicken'], self.grid.query(55, 55, 3))
+        # The cell it left should be cleaned up.
+        self.assertNotIn(self.grid.cell(1, 1), self.grid.cells)
+
+    def test_remove(self):
+        self.grid.insert('barrel', 1, 1)
+        self.grid.remove('barrel')
+        self.grid.remove('never-inserted')
+
+        self.assertNotIn('barrel', self.grid)
+        self.assertEqual({}, self.grid.cells)
+
+    def test_query_is_strictly_within_radius(self):
+        self.grid.insert('close', 1, 1)
+        self.grid.insert('edge', 3, 0)
+
+        self.assertEqual(['close'], self.grid.query(0, 0, 3))
+
+    def test_query_crosses_cell_boundaries(self):
+        '''Neighbours in adjacent cells, including negative ones, are found.'''
+        self.grid.insert('west', -1, 0)
+        self.grid.insert('east', 10, 0)
+
+        self.assertEqual(['west'], self.grid.query(1, 0, 3))
+        self.assertEqual(['east'], self.grid.query(9, 0, 3))
+
+    def test_query_where(self):
+        self.grid.insert('solid', 1, 0, data=True)
+        self.grid.insert('ghost', 0, 1, data=False)
+
+        result = self.grid.query(0, 0, 3, where=lambda physical: physical)
+
+        self.assertEqual(['solid'], result)
+
+    def test_clear(self):
+        self.grid.insert('barrel', 1, 1)
+        self.grid.clear()
+
+        self.assertEqual(0, len(self.grid))
+        self.assertEqual([], self.grid.query(1, 1, 3))
@@ -0,0 +1,135 @@
+import unittest
+import datetime
+
+import sys
+sys.path.append(".")
+
+import wireformat
+from wireformat import pack_object, unpack_object, pack_objects, unpack_objects, WireFormatError
+from wireformat import pack_messages, unpack_messages
+
+def make_object(**kwargs):
+    obj = {'id': 7, 'change_seq': 42, 'name': u'Chicken #1', 'resource': u'chicken',
+           'owner': None, 'loc_x': 5.0, 'loc_y': -3.0, 'loc_z': 0.0,
+           'rot_x': 0.0, 'rot_y': 0.0, 'rot_z': 90.0,
+           'scale_x': 1.0, 'scale_y': 1.0, 'scale_z': 1.0,
+           'speed': 1.0, 'vel_x': 0.0, 'vel_y': 0.0, 'vel_z': 0.0,
+           'states': [u'alive', u'clickable'], 'physical': True,
+           'last_modified': datetime.datetime(2012, 3, 4, 5, 6, 7, 890000),
+           'scripts': [u'games.objects.chicken']}
+    obj.update(kwargs)
+    return obj
+
+class TestPackObject(unittest.TestCase):
+    def test_round_trip(self):
+        obj = make_object()
+
+        result, offset = unpack_object(pack_object(obj))
+
+        expected = dict(obj, last_modified=obj['last_modified'].isoformat())
+        self.assertEqual(expected, result)
+
+    def test_defaults_are_left_out(self):
+        '''Fields at their defaults don't take up any space.'''
+        plain = pack_object(make_object())
+        moving = pack_object(make_object(vel_x=1.5, vel_y=2.5))
+
+        self.assertEqual(len(plain) + 2*wireformat.DOUBLE.size, len(moving))
+
+    def test_non_default_flags(self):
+        obj = make_object(physical=False, owner=u'Groxnor', states=[])
+
+        result, offset = unpack_object(pack_object(obj))
+
+        self.assertEqual(False, result['physical'])
+        self.assertEqual(u'Groxnor', result['owner'])
+        self.assertEqual([], result['states'])
+
+    def test_none_round_trip(self):
+        '''None stays None, even where the default is something else.'''
+        obj = make_object(resource=None, loc_y=None, states=None, physical=None, owner=None, last_modified=None)
+
+        result, offset = unpack_object(pack_object(obj))
+
+        self.assertEqual(obj, result)
+
+    def test_same_fields_some_none(self):
+        '''Objects that differ from their defaults in the same fields pack
+        right whether or not those fields are None.'''
+        objects = [make_object(), make_object(name=None, loc_x=None), make_object(id=8)]
+
+        data = pack_objects(objects)
+
+        expected = [dict(obj, last_modified=obj['last_modified'].isoformat()) for obj in objects]
+        self.assertEqual(expected, unpack_objects(data)['objects'])
+
+    def test_precise_floats(self):
+        '''Coordinates far from the origin keep all their precision.'''
+        obj = make_object(loc_x=123456.789012345, loc_y=-0.1, vel_z=1e-9)
+
+        result, offset = unpack_object(pack_object(obj))
+
+        self.assertEqual(obj['loc_x'], result['loc_x'])
+        self.assertEqual(obj['loc_y'], result['loc_y'])
+        self.assertEqual(obj['vel_z'], result['vel_z'])
+
+    def test_unicode(self):
+        result, offset = unpack_object(pack_object(make_object(name=u'Kyck\xeflingen')))
+
+        self.assertEqual(u'Kyck\xeflingen', result['name'])
+
+    def test_object_attributes(self):
+        '''Model instances pack the same as their dicts.'''
+        class Thing(object):
+            pass
+        thing = Thing()
+        thing.__dict__.update(make_object())
+
+        self.assertEqual(pack_object(make_object()), pack_object(thing))
+
+class TestPackObjects(unittest.TestCase):
+    def test_round_trip(self):
+        objects = [make_object(id=1), make_object(id=2, name=u'Barrel')]
+
+        result = unpack_objects(pack_objects(objects, seq=99, entered=[1, 2], left=[3]))
+
+        self.assertEqual(99, result['seq'])
+        self.assertEqual([1, 2], result['entered'])
+        self.assertEqual([3], result['left'])
+        self.assertEqual([1, 2], [o['id'] for o in result['objects']])
+        self.assertEqual(u'Barrel', result['objects'][1]['name'])
+
+    def test_empty(self):
+        result = unpack_objects(pack_objects([]))
+
+        self.assertEqual({'seq': 0, 'objects': [], 'entered': [], 'left': []}, result)
+
+    def test_not_packed(self):
+        with self.assertRaises(WireFormatError):
+            unpack_objects('[{"id": 1}]')
+        with self.assertRaises(WireFormatError):
+            unpack_objects('')
+
+class TestPackMessages(unittest.TestCase):
+    def test_round_trip(self):
+        messages = [{'id': 1, 'change_seq': 8, 'message': u'Bawk!', 'sender': u'Chicken #1',
+                     'loc_x': 5.5, 'loc_y': -3.25, 'loc_z': 0.0, 'player_generated': False,
+                     'sent': datetime.datetime(2012, 3, 4, 5, 6, 7, 890000)},
+                    {'id': 2, 'change_seq': 9, 'message': u'Hej d\xe5', 'sender': u'Groxnor',
+                     'loc_x': 0.1, 'loc_y': 0.0, 'loc_z': 2.0, 'player_generated': True,
+                     'sent': '2012-03-04T05:06:08'}]
+
+        result = unpack_messages(pack_messages(messages, seq=9))
+
+        self.assertEqual(9, result['seq'])
+        self.assertEqual([dict(messages[0], sent='2012-03-04T05:06:07.890000'), messages[1]],
+                         result['messages'])
+
+    def test_empty(self):
+        self.assertEqual({'seq': 0, 'messages': []}, unpack_messages(pack_messages([])))
+
+    def test_not_packed(self):
+        with self.assertRaises(WireFormatError):
+            unpack_messages(pack_objects([]))
+        with self.assertRaises(WireFormatError):
+            unpack_messages('')
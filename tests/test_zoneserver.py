@@ -20,7 +20,10 @@
 # ##### END AGPL LICENSE BLOCK #####
 
 import unittest
+import tornado.web
 from tornado.web import Application
+from tornado import gen
+from tornado.ioloop import IOLoop
 
 import json
 
@@ -28,11 +31,17 @@ import datetime
 
 from mock import Mock, patch
 
+from tornado.concurrent import Future
+
 import sys
 sys.path.append(".")
 
 import zoneserver
 from zoneserver import MovementHandler, CharacterController, ScriptedObjectHandler, DateLimitedObjectHandler
+from zoneserver import InterestManager, ObjectStream, WSMovementHandler, SnapshotCache, encode_objects
+from scriptregistry import ScriptRegistry
+from zoneserver import MovementQueue, MessageHandler, CharStatusHandler
+import clientlib
 
 class TestCharacterControllerGetCharacter(unittest.TestCase):
     def setUp(self):
@@ -124,7 +133,7 @@ class TestCharacterControllerSetMovement(unittest.TestCase):
         self.character_controller = CharacterController()
 
         self.MockObject = Mock(name="Object")
-        self.MockObject.get_objects = Mock(return_value=list())
+        self.MockObject.collides = Mock(return_value=False)
         self.character_patch = patch.object(zoneserver, 'Object', self.MockObject)
         self.character_patch.start()
 
@@ -152,26 +161,26 @@ class TestCharacterControllerSetMovement(unittest.TestCase):
     def test_set_movement_physics_collision(self):
         mock_char = Mock(speed=1, loc_x=0, loc_y=0, loc_z=0)
 
-        self.MockObject.get_objects = Mock(return_value=[mock_char])
+        self.MockObject.collides = Mock(return_value=True)
 
-        from copy import deepcopy
         with patch.object(zoneserver, 'Object', self.MockObject):
-            with patch.object(self.character_controller, 'create_character', Mock(return_value=deepcopy(mock_char))):
+            with patch.object(self.character_controller, 'create_character', Mock(return_value=mock_char)):
                 result = self.character_controller.set_movement("character", 1, 1, 3)
 
         self.assertFalse(result)
+        # A blocked move shouldn't have touched the character at all.
+        self.assertEqual((mock_char.loc_x, mock_char.loc_y), (0, 0))
+        self.assertFalse(mock_char.set_modified.called)
 
     def test_set_movement_physics_no_collision(self):
-        mock_char = Mock(speed=1, loc_x=0, loc_y=0, loc_z=0)
-        mock_otherchar = Mock(speed=1, loc_x=4, loc_y=4, loc_z=4)
-
-        self.MockObject.get_objects = Mock(return_value=[mock_otherchar])
+        mock_char = Mock(id=1, speed=1, loc_x=0, loc_y=0, loc_z=0)
 
         with patch.object(zoneserver, 'Object', self.MockObject):
             with patch.object(self.character_controller, 'create_character', Mock(return_value=mock_char)):
                 result = self.character_controller.set_movement("character", 1, 2, 3)
 
         self.assertEqual(result, mock_char)
+        self.MockObject.collides.assert_called_once_with(1, 2, 3, exclude=1)
 
 
 class TestCharacterControllerIsOwner(unittest.TestCase):
@@ -232,27 +241,588 @@ class TestDateLimitedObjectHandlerUnit(unittest.TestCase):
 
         self.assertEqual(expected, result)
 
+    def test_get_interesting_objects(self):
+        mock_interest = Mock()
+        mock_interest.update = Mock(return_value=(set([1, 2, 3]), set([3]), set([4])))
+        changed, entered = Mock(name='changed'), Mock(name='entered')
+
+        MockObject = Mock()
+        MockObject.get_objects = Mock(side_effect=[[changed], [entered]])
+        with patch.object(zoneserver, 'Object', MockObject):
+            with patch.object(zoneserver, 'interest', mock_interest):
+                result = self.objects_handler.get_interesting_objects('character')
+
+        self.assertEqual([changed, entered], result['objects'])
+        self.assertEqual([3], result['entered'])
+        self.assertEqual([4], result['left'])
+        # Only objects already in view are limited by since.
+        MockObject.get_objects.assert_any_call(since=None, after=None, upto=None, ids=set([1, 2]))
+        MockObject.get_objects.assert_any_call(ids=set([3]))
+
+    def get(self, **arguments):
+        self.req.headers = {}
+        self.objects_handler.get_current_user = Mock(return_value='username')
+        self.objects_handler.write = Mock()
+        self.objects_handler.get_argument = Mock(side_effect=lambda name, default=None: arguments.get(name, default))
+        MockObject = Mock()
+        MockObject.max_change_seq = Mock(return_value=7)
+        MockObject.get_objects = Mock(return_value=[{'id': 1, 'change_seq': 6}])
+        with patch.object(zoneserver, 'Object', MockObject), \
+                patch.object(zoneserver, 'snapshots', SnapshotCache()):
+            self.objects_handler.get()
+        return MockObject, json.loads(self.objects_handler.write.call_args[0][0])
+
+    def test_get_after(self):
+        '''Changes after the client's cursor are sent, up to a seq it sends back next time.'''
+        MockObject, result = self.get(after='3')
+
+        MockObject.get_objects.assert_called_once_with(after=3, upto=7)
+        self.assertEqual({'objects': [{'id': 1, 'change_seq': 6}], 'seq': 7}, result)
+
+    def test_get_after_bad(self):
+        with self.assertRaises(tornado.web.HTTPError) as cm:
+            self.get(after='yesterday')
+
+        self.assertEqual(400, cm.exception.status_code)
+
+class TestCharStatusHandler(unittest.TestCase):
+    def setUp(self):
+        self.app = Application([('/', CharStatusHandler),], cookie_secret='secret')
+        self.req = Mock()
+        self.handler = CharStatusHandler(self.app, self.req)
+        self.handler.get_current_user = Mock(return_value='username')
+        self.handler.get_secure_cookie = Mock(return_value='username')
+        self.handler.write = Mock()
+
+    def post(self, status, result=True):
+        self.handler.get_argument = Mock(side_effect={'character': 'Groxnor', 'status': status}.get)
+        with patch.object(CharacterController, 'set_char_status', Mock(return_value=result)), \
+                patch.object(zoneserver, 'movement') as movement, \
+                patch.object(zoneserver, 'interest') as interest:
+            self.handler.post()
+        return movement, interest
+
+    def test_offline_forgets(self):
+        movement, interest = self.post('offline')
+
+        movement.forget.assert_called_once_with('Groxnor')
+        interest.forget.assert_called_once_with('Groxnor')
+        self.handler.write.assert_called_once_with('true')
+
+    def test_online_remembers(self):
+        '''Coming online again doesn't reset the step numbering.'''
+        movement, interest = self.post('online')
+
+        self.assertFalse(movement.forget.called)
+        self.assertFalse(interest.forget.called)
+
+    def test_failed_offline_remembers(self):
+        movement, interest = self.post('offline', result=False)
+
+        self.assertFalse(movement.forget.called)
+        self.handler.write.assert_called_once_with('false')
+
+class TestMessageHandler(unittest.TestCase):
+    def setUp(self):
+        self.app = Application([('/', MessageHandler),], cookie_secret='secret')
+        self.req = Mock()
+        self.req.headers = {}
+        self.handler = MessageHandler(self.app, self.req)
+        self.handler.get_current_user = Mock(return_value='username')
+        self.handler.write = Mock()
+
+    def test_get(self):
+        mock_buffer = Mock(synced=5)
+        mock_buffer.get_messages = Mock(return_value=[{'message': 'Bawk'}])
+        self.handler.get_argument = Mock(return_value='3')
+        with patch.object(zoneserver, 'message_buffer', mock_buffer):
+            self.handler.get()
+
+        mock_buffer.get_messages.assert_called_once_with(after=3)
+        self.assertEqual({'seq': 5, 'messages': [{'message': 'Bawk'}]},
+                         json.loads(self.handler.write.call_args[0][0]))
+
+    def test_get_packed(self):
+        from wireformat import PACKED_CONTENT_TYPE, unpack_messages
+        message = {'id': 4, 'change_seq': 5, 'message': u'Bawk', 'sender': u'Chicken', 'loc_x': 1.0,
+                   'loc_y': 2.0, 'loc_z': 0.0, 'player_generated': False, 'sent': '2012-03-04T05:06:07'}
+        mock_buffer = Mock(synced=5)
+        mock_buffer.get_messages = Mock(return_value=[message])
+        self.handler.get_argument = Mock(return_value='3')
+        self.req.headers = {'Accept': PACKED_CONTENT_TYPE}
+        with patch.object(zoneserver, 'message_buffer', mock_buffer):
+            self.handler.get()
+
+        self.assertEqual({'seq': 5, 'messages': [message]},
+                         unpack_messages(self.handler.write.call_args[0][0]))
+
+class TestInterestManager(unittest.TestCase):
+    def setUp(self):
+        self.interest = InterestManager(radius=10)
+        self.mock_char = Mock(id=1, loc_x=0, loc_y=0)
+
+    def update(self, nearby):
+        MockObject = Mock()
+        MockObject.get_nearby_ids = Mock(return_value=nearby)
+        with patch.object(zoneserver, 'Object', MockObject):
+            with patch.object(CharacterController, 'get_character', Mock(return_value=self.mock_char)):
+                return self.interest.update('character')
+
+    def test_update(self):
+        visible, entered, left = self.update([1, 2])
+
+        self.assertEqual(set([1, 2]), visible)
+        self.assertEqual(set([1, 2]), entered)
+        self.assertEqual(set(), left)
+
+    def test_update_enter_and_leave(self):
+        self.update([1, 2])
+        visible, entered, left = self.update([1, 3])
+
+        self.assertEqual(set([1, 3]), visible)
+        self.assertEqual(set([3]), entered)
+        self.assertEqual(set([2]), left)
+
+    def test_update_includes_self(self):
+        '''A character can always see itself.'''
+        visible, entered, left = self.update([])
+
+        self.assertEqual(set([1]), visible)
+
+    def test_update_no_character(self):
+        with patch.object(CharacterController, 'get_character', Mock(return_value=False)):
+            self.assertEqual(None, self.interest.update('character'))
+
+    def test_forget(self):
+        self.update([1, 2])
+        self.interest.forget('character')
+        visible, entered, left = self.update([1, 2])
+
+        self.assertEqual(set([1, 2]), entered)
+
+class TestMovementQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = MovementQueue()
+        self.mock_char = Mock(id=1, speed=1, loc_x=0, loc_y=0, loc_z=0)
+        self.MockObject = Mock()
+        self.MockObject.collides = Mock(return_value=False)
+
+    def step(self):
+        with patch.object(zoneserver, 'Object', self.MockObject):
+            with patch.object(CharacterController, 'create_character', Mock(return_value=self.mock_char)) as create:
+                self.queue.step()
+        return create
+
+    def test_push_waits_for_step(self):
+        future = self.queue.push('character', 1, 0, 0)
+
+        self.assertFalse(future.done())
+        self.assertEqual(1, len(self.queue))
+        self.assertEqual(0, self.mock_char.loc_x)
+
+    def test_step(self):
+        '''Every input is applied in order, but the character is only
+        looked up and marked modified once.'''
+        first = self.queue.push('character', 1, 0, 0)
+        second = self.queue.push('character', 0, 2, 0)
+
+        create = self.step()
+
+        self.assertEqual(self.mock_char, first.result())
+        self.assertEqual(self.mock_char, second.result())
+        self.assertEqual((1, 2), (self.mock_char.loc_x, self.mock_char.loc_y))
+        self.assertEqual(1, create.call_count)
+        self.assertEqual(1, self.mock_char.set_modified.call_count)
+        self.assertEqual(0, len(self.queue))
+
+    def test_step_collision(self):
+        self.MockObject.collides = Mock(side_effect=[False, True])
+        first = self.queue.push('character', 1, 0, 0)
+        second = self.queue.push('character', 1, 0, 0)
+
+        self.step()
+
+        self.assertEqual(self.mock_char, first.result())
+        self.assertFalse(second.result())
+        self.assertEqual(1, self.mock_char.loc_x)
+
+    def test_step_error(self):
+        '''An input that raises fails only its own Future.'''
+        self.MockObject.collides = Mock(side_effect=[False, ValueError("Bad input"), False])
+        futures = [self.queue.push('character', 1, 0, 0) for i in xrange(3)]
+
+        self.step()
+
+        self.assertEqual(self.mock_char, futures[0].result())
+        self.assertRaises(ValueError, futures[1].result)
+        self.assertEqual(self.mock_char, futures[2].result())
+        self.assertEqual(2, self.mock_char.loc_x)
+        self.assertEqual(1, self.mock_char.set_modified.call_count)
+
+    def test_step_resolves_everything(self):
+        '''Every Future is resolved even if finishing the step raises.'''
+        self.mock_char.set_modified = Mock(side_effect=IOError("Disk full"))
+        future = self.queue.push('character', 1, 0, 0)
+
+        self.assertRaises(IOError, self.step)
+        self.assertTrue(future.done())
+
+    def test_push_steps(self):
+        pushed =self.queue.push_steps('character', [(2, 0, 1, 0), (1, 1, 0, 0)])
+
+        self.assertEqual([1, 2], [seq for seq, future in pushed])
+        self.assertEqual(2, self.queue.acked['character'])
+
+        self.step()
+
+        self.assertEqual((1, 1), (self.mock_char.loc_x, self.mock_char.loc_y))
+
+    def test_push_steps_resent(self):
+        '''Steps that were already queued aren't applied again.'''
+        self.queue.push_steps('character', [(1, 1, 0, 0), (2, 1, 0, 0)])
+        pushed = self.queue.push_steps('character', [(1, 1, 0, 0), (2, 1, 0, 0), (3, 1, 0, 0)])
+
+        self.assertEqual([3], [seq for seq, future in pushed])
+        self.assertEqual(3, len(self.queue))
+
+    def test_forget(self):
+        self.queue.push_steps('character', [(1, 1, 0, 0)])
+        self.queue.forget('character')
+
+        self.assertEqual(1, len(self.queue.push_steps('character', [(1, 1, 0, 0)])))
+
+    def test_step_nothing_queued(self):
+        create = self.step()
+
+        self.assertFalse(create.called)
+
 class TestMovementHandler(unittest.TestCase):
     def setUp(self):
         self.app = Application([('/', MovementHandler),])
         self.req = Mock()
         self.movement_handler = MovementHandler(self.app, self.req)
+        self.movement_handler.get_current_user = Mock(return_value='username')
+        self.movement_handler.get_secure_cookie = Mock(return_value='username')
+        self.movement_handler.write = Mock()
+        self.queue = MovementQueue()
+        self.mock_char = Mock(id=1, speed=1, loc_x=0, loc_y=0, loc_z=0)
+        self.MockObject = Mock()
+        self.MockObject.collides = Mock(return_value=False)
+
+    def post(self, steps):
+        '''Post a batch of steps and run the movement step that answers it.'''
+        self.movement_handler.get_argument = Mock(side_effect={'character': 'Groxnor',
+                                                               'steps': json.dumps(steps)}.get)
+
+        @gen.coroutine
+        def post():
+            future = self.movement_handler.post()
+            with patch.object(zoneserver, 'Object', self.MockObject), \
+                    patch.object(CharacterController, 'create_character', Mock(return_value=self.mock_char)):
+                self.queue.step()
+            yield future
+
+        with patch.object(zoneserver, 'movement', self.queue), \
+                patch.object(CharacterController, 'get_character', Mock(return_value={'name': 'Groxnor'})):
+            IOLoop.current().run_sync(post)
+        return json.loads(self.movement_handler.write.call_args[0][0])
+
+    def test_post_steps(self):
+        '''A batch of steps is applied in one movement step and acked.'''
+        result = self.post([{'seq': 1, 'x': 1}, {'seq': 2, 'y': 1}])
+
+        self.assertEqual({'ack': 2, 'blocked': [], 'object': {'name': 'Groxnor'}}, result)
+        self.assertEqual((1, 1), (self.mock_char.loc_x, self.mock_char.loc_y))
+        self.assertEqual(1, self.mock_char.set_modified.call_count)
+
+    def test_post_steps_blocked(self):
+        self.MockObject.collides = Mock(side_effect=[False, True])
+
+        result = self.post([{'seq': 1, 'x': 1}, {'seq': 2, 'x': 1}])
+
+        self.assertEqual(2, result['ack'])
+        self.assertEqual([2], result['blocked'])
+        self.assertEqual(1, self.mock_char.loc_x)
+
+    def test_post_steps_replayed(self):
+        '''Steps the zone has already seen, resent or out of order, are dropped.'''
+        self.post([{'seq': 1, 'x': 1}, {'seq': 2, 'x': 1}])
+
+        result = self.post([{'seq': 2, 'x': 1}, {'seq': 3, 'y': 1}, {'seq': 1, 'x': 1}])
+
+        self.assertEqual(3, result['ack'])
+        self.assertEqual((2, 1), (self.mock_char.loc_x, self.mock_char.loc_y))
+
+    def test_post_steps_malformed(self):
+        for steps in ('[{"x": 1}]', 'not json', '[1]', '{"seq": 1}'):
+            self.movement_handler.get_argument = Mock(side_effect={'character': 'Groxnor', 'steps': steps}.get)
+            with patch.object(zoneserver, 'movement', self.queue):
+                with self.assertRaises(tornado.web.HTTPError) as cm:
+                    IOLoop.current().run_sync(self.movement_handler.post)
+            self.assertEqual(400, cm.exception.status_code)
+        self.assertEqual(0, len(self.queue))
+
+class TestClientMovement(unittest.TestCase):
+    '''The client's side of numbered movement steps, against a zone
+    that numbers them the way MovementQueue does.'''
+    def setUp(self):
+        self.queue = MovementQueue()
+        self.client = clientlib.Client()
+        self.client.get_zone_url = Mock(return_value='http://zone')
+        self.client.post = Mock(side_effect=self.zone_post)
+        self.char = clientlib.Character('Groxnor')
+        self.char.zone = 'playerinstance-GhibliHills-Groxnor'
+        self.char.online = 'online'
+        self.client.characters = {'Groxnor': self.char}
+        self.applied = []
+
+    def zone_post(self, url, path, cookies=None, data=None):
+        if path == '/setstatus':
+            if data['status'] == 'offline':
+                self.queue.forget(data['character'])
+            result = True
+        else:
+            steps = [(s['seq'], s['x'], s['y'], s['z']) for s in json.loads(data['steps'])]
+            pushed = self.queue.push_steps(data['character'], steps)
+            self.applied.extend(seq for seq, future in pushed)
+            result = {'ack': self.queue.acked.get(data['character'], 0), 'blocked': [], 'object': None}
+        return Mock(status_code=200, content=json.dumps(result))
+
+    def test_move_character_steps(self):
+        result = self.client.move_character_steps('Groxnor', [(1, 0, 0), (0, 1, 0)])
+
+        self.assertEqual(2, result['ack'])
+        self.assertEqual([1, 2], self.applied)
+        self.assertEqual(2, self.char.movement_seq)
+
+    def test_online_again_keeps_numbering(self):
+        '''Setting a character online again doesn't start its steps over,
+        so the zone doesn't drop them as replays.'''
+        self.client.move_character_steps('Groxnor', [(1, 0, 0), (1, 0, 0)])
+        self.client.set_character_status('Groxnor', 'online')
+        self.client.move_character_steps('Groxnor', [(1, 0, 0)])
+
+        self.assertEqual([1, 2, 3], self.applied)
+
+    def test_offline_resets_numbering(self):
+        self.client.move_character_steps('Groxnor', [(1, 0, 0), (1, 0, 0)])
+        self.client.set_character_status('Groxnor', 'offline')
+
+        self.assertEqual(0, self.char.movement_seq)
+
+        self.char.online = 'online'
+        self.client.move_character_steps('Groxnor', [(1, 0, 0)])
+
+        self.assertEqual([1, 2, 1], self.applied)
+
+    def test_resync_from_ack(self):
+        '''If the zone is ahead of the client, the client takes its
+        numbering from the ack and resends the steps it dropped.'''
+        self.queue.push_steps('Groxnor', [(5, 1, 0, 0)])
+
+        result = self.client.move_character_steps('Groxnor', [(1, 0, 0), (0, 1, 0)])
+
+        self.assertEqual([6, 7], self.applied)
+        self.assertEqual(7, result['ack'])
+        self.assertEqual(7, self.char.movement_seq)
+
+class TestEncodeObjects(unittest.TestCase):
+    def test_encode_objects_list(self):
+        objects = [{'id': 1, 'name': u'Barrel'}, {'id': 2, 'name': u'Keg'}]
+
+        self.assertEqual(objects, json.loads(encode_objects(objects)))
+
+    def test_encode_objects_dict(self):
+        result = {'objects': [{'id': 1}], 'seq': 4, 'entered': [1], 'left': []}
+
+        self.assertEqual(result, json.loads(encode_objects(result)))
+
+    def test_encode_objects_empty(self):
+        self.assertEqual({'objects': []}, json.loads(encode_objects({'objects': []})))
+
+    def test_encode_objects_packed(self):
+        from wireformat import unpack_objects
+        result = {'objects': [{'id': 1, 'change_seq': 3, 'name': u'Barrel'}], 'seq': 4, 'entered': [1]}
+
+        unpacked = unpack_objects(encode_objects(result, packed=True))
+
+        self.assertEqual(4, unpacked['seq'])
+        self.assertEqual([1], unpacked['entered'])
+        self.assertEqual(u'Barrel', unpacked['objects'][0]['name'])
+
+class TestSnapshotCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = SnapshotCache(max_entries=2)
+        self.build = Mock(return_value='encoded')
+
+    def test_get_shared(self):
+        '''Everybody asking at the same seq shares one build.'''
+        self.assertEqual('encoded', self.cache.get(5, 'all', self.build))
+        self.assertEqual('encoded', self.cache.get(5, 'all', self.build))
+
+        self.assertEqual(1, self.build.call_count)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_get_new_seq(self):
+        self.cache.get(5, 'all', self.build)
+        self.cache.get(6, 'all', self.build)
+
+        self.assertEqual(2, self.build.call_count)
+        self.assertEqual(6, self.cache.seq)
+
+    def test_get_max_entries(self):
+        for key in range(3):
+            self.cache.get(5, key, self.build)
+        self.cache.get(5, 2, self.build)
+
+        self.assertEqual(4, self.build.call_count)
+        self.assertEqual(2, len(self.cache.entries))
+
+    def test_invalidate(self):
+        self.cache.get(5, 'all', self.build)
+        self.cache.invalidate()
+        self.cache.get(5, 'all', self.build)
+
+        self.assertEqual(2, self.build.call_count)
+
+class TestObjectStream(unittest.TestCase):
+    def setUp(self):
+        self.stream = ObjectStream()
+        self.MockObject = Mock()
+        self.MockObject.max_change_seq = Mock(return_value=5)
+        self.MockObject.get_objects = Mock(return_value=[])
+        self.object_patch = patch.object(zoneserver, 'Object', self.MockObject)
+        self.object_patch.start()
+        self.snapshots_patch = patch.object(zoneserver, 'snapshots', SnapshotCache())
+        self.snapshots_patch.start()
+
+    def tearDown(self):
+        self.object_patch.stop()
+        self.snapshots_patch.stop()
+
+    def test_subscribe(self):
+        socket = Mock()
+        result = self.stream.subscribe(socket)
+
+        self.assertEqual({'seq': 5, 'objects': []}, json.loads(result))
+        self.assertIn(socket, self.stream.subscribers)
+        self.assertEqual(5, self.stream.seq)
+
+    def test_subscribe_misses_nothing(self):
+        '''A write landing just after the snapshot still goes out next tick.'''
+        socket = Mock()
+        self.MockObject.max_change_seq.side_effect = [5, 6, 6]
+
+        self.stream.subscribe(socket)
+        self.stream.tick()
+
+        self.assertEqual(6, self.stream.seq)
+        self.MockObject.get_objects.assert_called_with(after=5, upto=6)
+        socket.write_message.assert_called_once_with(json.dumps({'seq': 6, 'objects': []}), binary=False)
+
+    def test_subscribe_shares_snapshot(self):
+        '''Subscribers arriving between two writes share one snapshot.'''
+        self.stream.subscribe(Mock())
+        self.stream.subscribe(Mock())
+
+        self.assertEqual(1, self.MockObject.get_objects.call_count)
+
+    def test_tick(self):
+        '''Changes are encoded once and pushed to every subscriber.'''
+        sockets = [Mock(), Mock()]
+        for socket in sockets:
+            self.stream.subscribe(socket)
+        self.MockObject.max_change_seq.return_value = 7
+
+        self.stream.tick()
+
+        self.MockObject.get_objects.assert_called_with(after=5, upto=7)
+        for socket in sockets:
+            socket.write_message.assert_called_once_with(json.dumps({'seq': 7, 'objects': []}), binary=False)
+        self.assertEqual(7, self.stream.seq)
+
+    def test_tick_packed(self):
+        '''Each format is only encoded once per tick.'''
+        sockets = [Mock(), Mock()]
+        for socket in sockets:
+            self.stream.subscribe(socket, packed=True)
+        self.MockObject.max_change_seq.return_value = 7
+
+        with patch.object(zoneserver, 'pack_objects', Mock(return_value='packed')) as mock_pack:
+            self.stream.tick()
+
+        mock_pack.assert_called_once_with([], seq=7, entered=(), left=())
+        for socket in sockets:
+            socket.write_message.assert_called_once_with('packed', binary=True)
+
+    def test_tick_nothing_changed(self):
+        socket = Mock()
+        self.stream.subscribe(socket)
+
+        self.stream.tick()
+
+        self.assertFalse(socket.write_message.called)
+
+    def test_tick_drops_closed_sockets(self):
+        from tornado.websocket import WebSocketClosedError
+        socket = Mock()
+        socket.write_message = Mock(side_effect=WebSocketClosedError())
+        self.stream.subscribe(socket)
+        self.MockObject.max_change_seq.return_value = 7
+
+        self.stream.tick()
+
+        self.assertNotIn(socket, self.stream.subscribers)
+
+    def test_tick_no_subscribers(self):
+        self.stream.tick()
+
+        self.assertFalse(self.MockObject.get_objects.called)
+        self.assertEqual(None, self.stream.seq)
 
 class TestWSMovementHandler(unittest.TestCase):
-    def test_on_message(self):
-        # w_s_movement_handler = WSMovementHandler()
-        # self.assertEqual(expected, w_s_movement_handler.on_message(message))
-        self.skipTest("Not Implemented.")
+    def setUp(self):
+        self.app = Application([('/', WSMovementHandler),])
+        self.req = Mock()
+        self.handler = WSMovementHandler(self.app, self.req)
+        self.handler.user = 'username'
+        self.handler.write_message = Mock()
 
-    def test_open(self):
-        # w_s_movement_handler = WSMovementHandler()
-        # self.assertEqual(expected, w_s_movement_handler.open())
-        self.skipTest("Not Implemented.")
+    def test_on_message_mov(self):
+        mock_movement = Mock()
+        result = Future()
+        result.set_result(False)
+        mock_movement.push = Mock(return_value=result)
+        with patch.object(zoneserver, 'movement', mock_movement):
+            self.handler.on_message(json.dumps({'command': 'mov', 'char': 'character', 'x': 1, 'y': 0, 'z': 0}))
 
-    def test_set_movement(self):
-        # w_s_movement_handler = WSMovementHandler()
-        # self.assertEqual(expected, w_s_movement_handler.set_movement(character, xmod, ymod, zmod))
-        self.skipTest("Not Implemented.")
+        mock_movement.push.assert_called_once_with('character', 1, 0, 0, user='username')
+        self.handler.write_message.assert_called_once_with(json.dumps({'command': 'mov', 'result': False}))
+
+    def test_on_message_sub(self):
+        mock_stream = Mock()
+        mock_stream.subscribe = Mock(return_value='snapshot')
+        with patch.object(zoneserver, 'stream', mock_stream):
+            self.handler.on_message(json.dumps({'command': 'sub'}))
+
+        mock_stream.subscribe.assert_called_once_with(self.handler, packed=False)
+        self.handler.write_message.assert_called_once_with('snapshot', binary=False)
+
+    def test_on_close(self):
+        mock_stream = Mock()
+        with patch.object(zoneserver, 'stream', mock_stream):
+            self.handler.on_close()
+
+        mock_stream.unsubscribe.assert_called_once_with(self.handler)
+
+    def test_open_not_logged_in(self):
+        self.handler.get_secure_cookie = Mock(return_value=None)
+        self.handler.close = Mock()
+
+        self.handler.open()
+
+        self.assertTrue(self.handler.close.called)
 
 class TestAdminHandler(unittest.TestCase):
     def test___init__(self):
@@ -281,9 +851,6 @@ class TestScriptedObjectHandler(unittest.TestCase):
 
         expected = [mock_scripted_object]
 
-        MockScriptedObject = Mock()
-        MockScriptedObject.objects.return_value = expected
-
         from games.objects.basescript import Script
 
         # Define a test class here because making Mock pass an issubclass
@@ -295,7 +862,7 @@ class TestScriptedObjectHandler(unittest.TestCase):
         MockScriptModule = Mock(MyScript=MyScript, name='testscript')
 
         with patch.object(zoneserver, 'Object', Mock(get=Mock(return_value=mock_scripted_object))):
-            with patch.object(zoneserver, 'ScriptedObject', MockScriptedObject):
+            with patch.object(zoneserver, 'script_registry', ScriptRegistry()):
                 with patch.dict('sys.modules', {'games.objects.testscript': MockScriptModule}):
                     result = self.scripted_object_handler.activate_object(None, None)
 
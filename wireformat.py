@@ -0,0 +1,330 @@
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''WireFormat
+A compact binary encoding for zone objects, for clients that ask for it
+with an Accept header of PACKED_CONTENT_TYPE instead of getting JSON.
+
+A packed response is a header:
+    magic, seq, number of objects, number of entered ids, number of left ids
+followed by the entered and left object ids, then each object as:
+    id, change_seq, field bitmask, then the fields whose bits are set:
+    first the fixed-size ones (REAL, FLAG, TIME), then the strings and
+    lists, each in bitmask order.
+A field's bit is only set when it differs from the model's default, so
+the rotations, scales and velocities most objects never touch cost nothing.
+If the top bit of the mask is set, a second mask follows it, with a bit
+set for each field that is None even though its default isn't.
+Since the fixed-size part of an object is laid out the same way for
+every object with the same masks, it is packed and unpacked with one
+struct compiled for those masks.
+
+Packed /messages are a header:
+    magic, seq, number of messages
+then each message as:
+    id, change_seq, loc_x, loc_y, loc_z, player_generated, sent, message, sender
+
+This module is shared by the servers and clientlib, so it must not need
+the database models.
+'''
+
+import struct
+import operator
+import datetime
+
+PACKED_CONTENT_TYPE = 'application/x-simplemmo-packed'
+
+MAGIC = 'SMO3'
+HEADER = struct.Struct('<4sIIHH')
+OBJECT_HEADER = struct.Struct('<IIL')
+OBJECT_IDS = struct.Struct('<II')
+NULL_MASK = struct.Struct('<L')
+NULLS = 1 << 31
+ID = struct.Struct('<I')
+DOUBLE = struct.Struct('<d')
+SHORT = struct.Struct('<H')
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+MESSAGES_MAGIC = 'SMM1'
+MESSAGES_HEADER = struct.Struct('<4sII')
+MESSAGE = struct.Struct('<II3d?d')
+
+# Field kinds.
+STRING, REAL, FLAG, LIST, TIME = range(5)
+
+# (name, kind, default) in bitmask order. Only ever append to this, and
+# keep it under 31 fields, since the top bit of the mask is NULLS.
+FIELDS = (
+    ('name', STRING, u''),
+    ('resource', STRING, u'none'),
+    ('owner', STRING, None),
+    ('loc_x', REAL, 0),
+    ('loc_y', REAL, 0),
+    ('loc_z', REAL, 0),
+    ('rot_x', REAL, 0),
+    ('rot_y', REAL, 0),
+    ('rot_z', REAL, 0),
+    ('scale_x', REAL, 1),
+    ('scale_y', REAL, 1),
+    ('scale_z', REAL, 1),
+    ('speed', REAL, 1),
+    ('vel_x', REAL, 0),
+    ('vel_y', REAL, 0),
+    ('vel_z', REAL, 0),
+    ('states', LIST, []),
+    ('physical', FLAG, True),
+    ('last_modified', TIME, None),
+    ('scripts', LIST, []),
+)
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+FIELD_NAMES = tuple(name for name, kind, default in FIELDS)
+_get_fields = operator.attrgetter(*FIELD_NAMES)
+_DEFAULTS = tuple(default for name, kind, default in FIELDS)
+# The fields that can only be None by being sent in the null mask.
+_NULLABLE = [bit for bit, default in enumerate(_DEFAULTS) if default is not None]
+
+# How each fixed-size kind of field is laid out.
+_FIXED_FORMATS = {REAL: 'd', FLAG: '?', TIME: 'd'}
+_FIXED_BITS = [bit for bit, (name, kind, default) in enumerate(FIELDS) if kind in _FIXED_FORMATS]
+_VARIABLE_BITS = [bit for bit, (name, kind, default) in enumerate(FIELDS) if kind not in _FIXED_FORMATS]
+
+
+def _pack_string(value):
+    data = value.encode('utf-8')
+    return SHORT.pack(len(data)) + data
+
+def _unpack_string(data, offset):
+    length, = SHORT.unpack_from(data, offset)
+    offset += SHORT.size
+    return data[offset:offset+length].decode('utf-8'), offset + length
+
+def _timestamp(value):
+    '''Seconds since the epoch, from a datetime or its isoformat().'''
+    if isinstance(value, basestring):
+        iso = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+        value = datetime.datetime.strptime(value, iso)
+    return (value - EPOCH).total_seconds()
+
+def _isoformat(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds).isoformat()
+
+
+# Packers and unpackers compiled for each set of masks. Zones only
+# have a few different shapes of object, so these stay small.
+_packers = {}
+_unpackers = {}
+
+def _fixed_struct(mask, nulls):
+    '''The struct for the header and fixed-size fields of an object
+    with these masks, and the bits of those fields, in order.'''
+    fixed = [bit for bit in _FIXED_BITS if mask & (1 << bit)]
+    layout = OBJECT_HEADER.format + ('L' if nulls else '')
+    layout += ''.join(_FIXED_FORMATS[FIELDS[bit][1]] for bit in fixed)
+    return struct.Struct(layout), fixed
+
+def _compile_packer(changed, nulls):
+    '''Builds a function that packs an object whose fields that differ
+    from their defaults are the ones flagged in changed.'''
+    mask = sum(1 << bit for bit, flag in enumerate(changed) if flag)
+    fixed_struct, fixed = _fixed_struct(mask, nulls)
+    masks = (mask | NULLS, nulls) if nulls else (mask,)
+    times = [2 + len(masks) + index for index, bit in enumerate(fixed) if FIELDS[bit][1] == TIME]
+    variable = [(bit, FIELDS[bit][1]) for bit in _VARIABLE_BITS if changed[bit]]
+    nullable = [bit for bit in _NULLABLE if changed[bit]]
+
+    def pack(objid, change_seq, values):
+        for bit in nullable:
+            if values[bit] is None:
+                return _pack_with_nulls(objid, change_seq, values, changed)
+        fields = [objid, change_seq]
+        fields.extend(masks)
+        fields.extend([values[bit] for bit in fixed])
+        for index in times:
+            fields[index] = _timestamp(fields[index])
+        parts = [fixed_struct.pack(*fields)]
+        for bit, kind in variable:
+            if kind == STRING:
+                data = values[bit].encode('utf-8')
+                parts += [SHORT.pack(len(data)), data]
+            else:
+                value = values[bit]
+                parts.append(SHORT.pack(len(value)))
+                for item in value:
+                    data = item.encode('utf-8')
+                    parts += [SHORT.pack(len(data)), data]
+        return ''.join(parts)
+    return pack
+
+def pack_object(obj):
+    '''Pack one object (a model instance or a model_to_dict dict).'''
+    if isinstance(obj, dict):
+        values = map(obj.get, FIELD_NAMES)
+        objid, change_seq = obj.get('id'), obj.get('change_seq')
+    else:
+        values = _get_fields(obj)
+        objid, change_seq = obj.id, obj.change_seq
+
+    changed = tuple(map(operator.ne, values, _DEFAULTS))
+    return _get_packer(changed)(objid, change_seq or 0, values)
+
+def _get_packer(changed, nulls=0):
+    packer = _packers.get((changed, nulls))
+    if packer is None:
+        packer = _packers[changed, nulls] = _compile_packer(changed, nulls)
+    return packer
+
+def _pack_with_nulls(objid, change_seq, values, changed):
+    '''Pack an object some of whose fields are None though their
+    defaults aren't, by sending those in the null mask instead.'''
+    nulls = sum(1 << bit for bit in _NULLABLE if values[bit] is None)
+    changed = tuple(flag and values[bit] is not None for bit, flag in enumerate(changed))
+    return _get_packer(changed, nulls)(objid, change_seq, values)
+
+def _compile_unpacker(mask, nulls):
+    '''Builds a function that unpacks the rest of an object with these
+    masks, once its header has been read.'''
+    fixed_struct, fixed = _fixed_struct(mask, nulls)
+    fixed_names = [FIELD_NAMES[bit] for bit in fixed]
+    header_length = 4 if nulls else 3
+    times = [FIELD_NAMES[bit] for bit in fixed if FIELDS[bit][1] == TIME]
+    variable = [(FIELD_NAMES[bit], FIELDS[bit][1]) for bit in _VARIABLE_BITS if mask & (1 << bit)]
+    defaults = {}
+    default_lists = []
+    for bit, (name, kind, default) in enumerate(FIELDS):
+        if nulls & (1 << bit):
+            defaults[name] = None
+        elif not mask & (1 << bit):
+            defaults[name] = default
+            if kind == LIST:
+                default_lists.append(name)
+
+    def unpack(data, offset):
+        values = fixed_struct.unpack_from(data, offset)
+        offset += fixed_struct.size
+        obj = dict(defaults)
+        for name in default_lists:
+            obj[name] = []
+        obj['id'], obj['change_seq'] = values[:2]
+        obj.update(zip(fixed_names, values[header_length:]))
+        for name in times:
+            obj[name] = _isoformat(obj[name])
+        for name, kind in variable:
+            if kind == STRING:
+                obj[name], offset = _unpack_string(data, offset)
+            else:
+                count, = SHORT.unpack_from(data, offset)
+                offset += SHORT.size
+                items = []
+                for i in xrange(count):
+                    item, offset = _unpack_string(data, offset)
+                    items.append(item)
+                obj[name] = items
+        return obj, offset
+    return unpack
+
+def unpack_object(data, offset=0):
+    '''Unpack one object into a dict shaped like model_to_dict's.
+    Returns the dict and the offset just past it.'''
+    objid, change_seq, mask = OBJECT_HEADER.unpack_from(data, offset)
+    nulls = 0
+    if mask & NULLS:
+        nulls, = NULL_MASK.unpack_from(data, offset + OBJECT_HEADER.size)
+        mask &= ~NULLS
+
+    unpacker = _unpackers.get((mask, nulls))
+    if unpacker is None:
+        unpacker = _unpackers[mask, nulls] = _compile_unpacker(mask, nulls)
+    return unpacker(data, offset)
+
+
+def pack_objects(objects, seq=0, entered=(), left=()):
+    '''Pack an /objects response. objects may already be packed strings.'''
+    parts = [HEADER.pack(MAGIC, seq, len(objects), len(entered), len(left))]
+    parts.extend(ID.pack(objid) for objid in entered)
+    parts.extend(ID.pack(objid) for objid in left)
+    parts.extend(o if isinstance(o, str) else pack_object(o) for o in objects)
+    return ''.join(parts)
+
+def unpack_objects(data):
+    '''Unpack an /objects response into the same dict the JSON
+    version has: {'seq': ..., 'objects': [...], 'entered': [...], 'left': [...]}'''
+    try:
+        magic, seq, num_objects, num_entered, num_left = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise WireFormatError("Too short to be a packed response.")
+    if magic != MAGIC:
+        raise WireFormatError("Not a packed response: %r" % magic)
+    offset = HEADER.size
+
+    entered = list(struct.unpack_from('<%dI' % num_entered, data, offset))
+    offset += ID.size * num_entered
+    left = list(struct.unpack_from('<%dI' % num_left, data, offset))
+    offset += ID.size * num_left
+
+    objects = []
+    for i in xrange(num_objects):
+        obj, offset = unpack_object(data, offset)
+        objects.append(obj)
+
+    return {'seq': seq, 'objects': objects, 'entered': entered, 'left': left}
+
+
+def pack_message(message):
+    '''Pack one message (a model instance or a model_to_dict dict).'''
+    if isinstance(message, dict):
+        get = message.get
+    else:
+        get = lambda name: getattr(message, name)
+    return (MESSAGE.pack(get('id'), get('change_seq') or 0, get('loc_x'), get('loc_y'), get('loc_z') or 0,
+                         bool(get('player_generated')), _timestamp(get('sent')))
+            + _pack_string(get('message')) + _pack_string(get('sender')))
+
+def pack_messages(messages, seq=0):
+    '''Pack a /messages response.'''
+    return ''.join([MESSAGES_HEADER.pack(MESSAGES_MAGIC, seq, len(messages))] +
+                   [pack_message(m) for m in messages])
+
+def unpack_messages(data):
+    '''Unpack a /messages response into the same dict the JSON
+    version has: {'seq': ..., 'messages': [...]}'''
+    try:
+        magic, seq, count = MESSAGES_HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise WireFormatError("Too short to be a packed response.")
+    if magic != MESSAGES_MAGIC:
+        raise WireFormatError("Not a packed response: %r" % magic)
+    offset = MESSAGES_HEADER.size
+
+    messages = []
+    for i in xrange(count):
+        objid, change_seq, loc_x, loc_y, loc_z, player_generated, sent = MESSAGE.unpack_from(data, offset)
+        offset += MESSAGE.size
+        message, offset = _unpack_string(data, offset)
+        sender, offset = _unpack_string(data, offset)
+        messages.append({'id': objid, 'change_seq': change_seq, 'message': message, 'sender': sender,
+                         'loc_x': loc_x, 'loc_y': loc_y, 'loc_z': loc_z,
+                         'player_generated': player_generated, 'sent': _isoformat(sent)})
+    return {'seq': seq, 'messages': messages}
@@ -28,22 +28,23 @@ import time
 import logging
 
 import tornado
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.util import import_object
 
-import cachelper
-
 from baseserver import BaseServer, SimpleHandler, BaseHandler
 
-from settings import DATETIME_FORMAT
+from settings import DATETIME_FORMAT, INTEREST_RADIUS, CLIENT_UPDATE_FREQ, ZONE_FLUSH_INTERVAL, SIMULATION_STEP
 
 from playhouse.shortcuts import model_to_dict
 
 from tornado.options import define, options
 try:
-    from tornado.websocket import WebSocketHandler
+    from tornado.websocket import WebSocketHandler, WebSocketClosedError
 except(ImportError):
     print "Couldn't import WebSocketHandler."
     WebSocketHandler = BaseHandler
+    WebSocketClosedError = IOError
 
 define("port", default=1300, help="Run on the given port.", type=int)
 define("zonename", default='defaultzone', help="Specify what zone to load from disk.", type=str)
@@ -55,8 +56,10 @@ from peewee import *
 import datetime
 
 from elixir_models import Character, Message, Object, ComplexEncoder, ScriptedObject
+from elixir_models import SequencedModel, object_fragments, zone_state, message_buffer
+from wireformat import PACKED_CONTENT_TYPE, pack_object, pack_objects, pack_messages
 
-from games.objects.basescript import Script
+from scriptregistry import script_registry
 
 
 class CharacterController(object):
@@ -108,6 +111,7 @@ class CharacterController(object):
         charobj.states = list(set(charobj.states))
 
         charobj.save()
+        snapshots.invalidate()
 
         return charobj
 
@@ -120,39 +124,135 @@ class CharacterController(object):
 
     def set_movement(self, character, xmod, ymod, zmod, user=None):
         charobj = self.create_character(character, owner=user)
-
-#         try:
-#             charobj.loc
-#         except(AttributeError):
-#             # Character doesn't exist, create a new one.
-#             self.set_status(500)
-#             self.write('Character "%s" was not set to online, and didn\'t exist in the database.' % character)
-#             return
-
-        # Set the character's new position based on the x, y and z modifiers.
-        charobj.loc_x += xmod * charobj.speed
-        charobj.loc_y += ymod * charobj.speed
-        charobj.loc_z += zmod * charobj.speed
+        if not self.move_character(charobj, xmod, ymod, zmod):
+            return False
         charobj.set_modified()
+        snapshots.invalidate()
+        return charobj
+
+    def move_character(self, charobj, xmod, ymod, zmod):
+        '''Move charobj by the given modifiers times its speed, unless that
+        would run it into something. Doesn't save anything.
+        Returns whether it moved.'''
+        # Work out the character's new position based on the x, y and z modifiers.
+        loc_x = charobj.loc_x + xmod * charobj.speed
+        loc_y = charobj.loc_y + ymod * charobj.speed
+        loc_z = charobj.loc_z + zmod * charobj.speed
 
         # Do simple physics here.
-        # TODO: Split this into its own method.
-        def manhattan(x1, y1, x2, y2):
-            return abs(x1-x2) + abs(y1-y2)
+        # Only the grid cells around where we're going get looked at.
+        if Object.collides(loc_x, loc_y, 3, exclude=charobj.id):
+            # We collided against something, so don't touch the location.
+            return False
 
-        for o in Object.get_objects(physical=True):
-            if o.id == charobj.id:
+        # We didn't collide, hooray!
+        charobj.loc_x, charobj.loc_y, charobj.loc_z = loc_x, loc_y, loc_z
+        return True
+
+class MovementQueue(object):
+    '''Movement input from every client in the zone, applied in one batch
+    each simulation step instead of one request at a time.
+    Each character is looked up once per step no matter how many inputs
+    it sent, and marked modified once after all of them were applied.'''
+
+    def __init__(self):
+        self.pending = []
+        # The highest step sequence number queued for each character.
+        self.acked = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, character, xmod, ymod, zmod, user=None):
+        '''Queue a movement for the next step.
+        Returns a Future for set_movement's result.'''
+        future = Future()
+        self.pending.append((character, xmod, ymod, zmod, user, future))
+        return future
+
+    def push_steps(self, character, steps, user=None):
+        '''Queue a client's numbered batch of (seq, xmod, ymod, zmod) steps.
+        Steps at or below the last seq acknowledged for this character were
+        already queued by an earlier request, so a client resending a batch
+        it never heard back about doesn't move twice.
+        Returns a list of (seq, Future) for the steps that were queued.'''
+        pushed = []
+        for seq, xmod, ymod, zmod in sorted(steps):
+            if seq <= self.acked.get(character, 0):
                 continue
-            # Is the distance between that object and the character less than 3?
-            if manhattan(o.loc_x, o.loc_y, charobj.loc_x, charobj.loc_y) < 3:
-                # We collided against something, so return now and don't
-                # save the location changes into the database.
-                return False
+            pushed.append((seq, self.push(character, xmod, ymod, zmod, user=user)))
+            self.acked[character] = seq
+        return pushed
+
+    def forget(self, character):
+        '''Let a character's step numbering start over, like when it
+        goes offline.'''
+        self.acked.pop(character, None)
+
+    def step(self):
+        '''Apply everything queued since the last step, in the order it came in.
+        An input that fails gets its exception set on its Future, without
+        holding up the rest, and every Future is resolved either way.'''
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        controller = CharacterController()
+        characters = {}
+        results = []
+        try:
+            for character, xmod, ymod, zmod, user, future in pending:
+                try:
+                    if character not in characters:
+                        characters[character] = controller.create_character(character, owner=user)
+                    charobj = characters[character]
+                    moved = controller.move_character(charobj, xmod, ymod, zmod)
+                    results.append((future, charobj if moved else False, None))
+                except Exception as e:
+                    logging.exception("Moving %s failed." % character)
+                    results.append((future, None, e))
+
+            for charobj in characters.values():
+                charobj.set_modified()
+            snapshots.invalidate()
+        finally:
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+movement = MovementQueue()
+
+class InterestManager(object):
+    '''Keeps track of the region of the zone each connected character can see,
+    so clients are only sent the objects near them.'''
+
+    def __init__(self, radius=INTEREST_RADIUS):
+        self.radius = radius
+        self.regions = {}
+
+    def update(self, character):
+        '''Recompute which objects are inside character's interest region.
+        Returns a tuple of (visible, entered, left) sets of object ids,
+        or None if there is no such character in the zone.'''
+        charobj = CharacterController().get_character(character)
+        if not charobj:
+            return None
+
+        visible = set(Object.get_nearby_ids(charobj.loc_x, charobj.loc_y, self.radius))
+        visible.add(charobj.id)
+
+        previous = self.regions.get(character, set())
+        self.regions[character] = visible
+        return visible, visible - previous, previous - visible
+
+    def forget(self, character):
+        '''Stop tracking a character, like when they go offline.'''
+        self.regions.pop(character, None)
+
+interest = InterestManager()
 
-        # We didn't collide, hooray!
-        # So we'll save to the database and return it.
-        charobj.save()
-        return charobj
 
 class CharStatusHandler(BaseHandler):
     '''Manages if a character is active in the zone or not.'''
@@ -174,62 +274,243 @@ class CharStatusHandler(BaseHandler):
             if self.char_controller.set_char_status(character, status, user=user):
                 retval = True
 
+        if retval and status == "offline":
+            # Its step numbering starts over when it next comes online.
+            interest.forget(character)
+            movement.forget(character)
+
         self.write(json.dumps(retval))
 
 
 class MovementHandler(BaseHandler):
-    '''A stupid HTTP-based handler for handling character movement.'''
+    '''A stupid HTTP-based handler for handling character movement.
+    The movement is queued, and the response is sent once the next
+    simulation step has applied it.
+
+    Instead of x, y and z, a client can send a whole batch of steps as
+    steps=[{"seq": 1, "x": 1, "y": 0, "z": 0}, ...]. They are applied in
+    seq order, and the reply is
+        {"ack": 12, "blocked": [11], "object": {...}}
+    with the last seq acknowledged, the seqs that ran into something, and
+    the character as it stands afterwards.'''
     @tornado.web.authenticated
+    @gen.coroutine
     def post(self):
         character = self.get_argument('character', '')
         user = self.get_secure_cookie('user')
-        self.char_controller = CharacterController()
 #         if not self.char_controller.is_owner(user, character):
 #             self.set_status(403)
 #             self.write("User %s does not own Character %s." % (user, character))
 #             return False
 
-        xmod = int(self.get_argument('x', 0))
-        ymod = int(self.get_argument('y', 0))
-        zmod = int(self.get_argument('z', 0))
-        logging.info("Locmod is: %d, %d, %d" % (xmod, ymod, zmod))
+        steps = self.get_argument('steps', None)
+        if steps is not None:
+            retval = yield self.post_steps(character, steps, user)
+        else:
+            xmod = int(self.get_argument('x', 0))
+            ymod = int(self.get_argument('y', 0))
+            zmod = int(self.get_argument('z', 0))
+            logging.info("Locmod is: %d, %d, %d" % (xmod, ymod, zmod))
 
-        result = self.char_controller.set_movement(character, xmod, ymod, zmod, user=user)
+            result = yield movement.push(character, xmod, ymod, zmod, user=user)
 
-        logging.info("Tried to set movement, result was: %s" % result)
+            logging.info("Tried to set movement, result was: %s" % result)
 
-        if result is not False:
-            retval = result.json_dumps()
-        else:
-            retval = json.dumps(result, cls=ComplexEncoder)
+            if result is not False:
+                retval = result.json_dumps()
+            else:
+                retval = json.dumps(result, cls=ComplexEncoder)
 
         self.content_type = 'application/json'
         self.write(retval)
 
+    @gen.coroutine
+    def post_steps(self, character, steps, user):
+        try:
+            steps = [(int(step['seq']), int(step.get('x', 0)), int(step.get('y', 0)), int(step.get('z', 0)))
+                     for step in json.loads(steps)]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise tornado.web.HTTPError(400, "steps should be a list of {seq, x, y, z} objects.")
+
+        pushed = movement.push_steps(character, steps, user=user)
+        results = yield [future for seq, future in pushed]
+        logging.info("Applied %d of %d steps for %s." % (len(pushed), len(steps), character))
+
+        blocked = [seq for (seq, future), result in zip(pushed, results) if result is False]
+        charobj = CharacterController().get_character(character)
+        raise gen.Return(json.dumps({'ack': movement.acked.get(character, 0),
+                                     'blocked': blocked,
+                                     'object': charobj}, cls=ComplexEncoder))
+
+
+def wants_packed(request):
+    '''Did the client ask for the compact binary format?'''
+    return PACKED_CONTENT_TYPE in request.headers.get('Accept', '')
+
+def encode_object(obj, packed=False):
+    '''Encode one object, reusing its cached encoding if it hasn't
+    changed since it was last sent.'''
+    if isinstance(obj, SequencedModel):
+        return object_fragments.get(obj, packed)
+    return pack_object(obj) if packed else json.dumps(obj, cls=ComplexEncoder)
+
+def encode_objects(result, packed=False):
+    '''Encode a list of objects, or a dict with the objects and whatever
+    else goes with them, as JSON or in the packed wire format.
+    Responses are built by joining the objects' encoded fragments.'''
+    extra = result if isinstance(result, dict) else {}
+    objects = [encode_object(o, packed) for o in extra.get('objects', result)]
+
+    if packed:
+        return pack_objects(objects, seq=extra.get('seq', 0),
+                            entered=extra.get('entered', ()), left=extra.get('left', ()))
+
+    objects = '[%s]' % ', '.join(objects)
+    if not extra:
+        return objects
+    parts = ['"objects": ' + objects]
+    parts.extend('%s: %s' % (json.dumps(key), json.dumps(value, cls=ComplexEncoder))
+                 for key, value in extra.items() if key != 'objects')
+    return '{%s}' % ', '.join(parts)
+
+
+class SnapshotCache(object):
+    '''Encoded object responses for the zone as it stands at one change
+    sequence number. Any write to an object bumps the zone's change_seq,
+    so entries for an older seq are thrown away as soon as a newer one
+    is asked for, and everybody polling between two writes shares one
+    query and one encode.'''
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.seq = None
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, seq, key, build):
+        '''Gets the entry for key as of seq, calling build() to make
+        it if nobody has asked for it yet.'''
+        if seq != self.seq:
+            self.invalidate()
+            self.seq = seq
+
+        try:
+            value = self.entries[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            value = build()
+            # Every client polling with its own cursor gets its own key,
+            # so don't let a pile of stragglers grow this without bound.
+            if len(self.entries) < self.max_entries:
+                self.entries[key] = value
+        return value
+
+    def invalidate(self):
+        '''Drop everything, like after this process changes an object.'''
+        self.seq = None
+        self.entries = {}
+
+snapshots = SnapshotCache()
+
+
+class ObjectStream(object):
+    '''Pushes each tick's object changes to every subscribed WebSocket.
+    The changes are looked up once per tick, and encoded at most once per
+    wire format, no matter how many clients are listening, instead of every
+    client polling /objects.'''
+
+    def __init__(self):
+        self.subscribers = {}
+        self.seq = None
+
+    def snapshot(self, packed=False):
+        '''The whole zone as of now, encoded as a stream message.
+        Returns the change_seq it is as of, and the message.'''
+        seq = Object.max_change_seq()
+        return seq, snapshots.get(seq, ('snapshot', packed),
+                                  lambda: encode_objects({'seq': seq, 'objects': Object.get_objects(upto=seq)}, packed))
+
+    def subscribe(self, socket, packed=False):
+        '''Start pushing changes to socket, packed or as JSON.
+        Returns a snapshot of the zone to send it first.'''
+        # Start from the snapshot's own seq, so nothing written between
+        # taking it and now gets skipped by the next tick.
+        seq, snapshot = self.snapshot(packed=packed)
+        if self.seq is None:
+            self.seq = seq
+        self.subscribers[socket] = packed
+        return snapshot
+
+    def unsubscribe(self, socket):
+        self.subscribers.pop(socket, None)
+
+    def tick(self):
+        '''Push everything that changed since the last tick.'''
+        if not self.subscribers:
+            # Nobody is listening, so the next subscriber starts fresh.
+            self.seq = None
+            return
+
+        seq = Object.max_change_seq()
+        if seq == self.seq:
+            return
+
+        objects = Object.get_objects(after=self.seq, upto=seq)
+        messages = {}
+        for socket, packed in self.subscribers.items():
+            if packed not in messages:
+                messages[packed] = encode_objects({'seq': seq, 'objects': objects}, packed)
+            try:
+                socket.write_message(messages[packed], binary=packed)
+            except WebSocketClosedError:
+                self.unsubscribe(socket)
+        self.seq = seq
+
+stream = ObjectStream()
+
 
-# TODO: A char movement handler token handler, which gives the user a token to use.
 class WSMovementHandler(WebSocketHandler):
-    '''This is a sample movement handler, which really should be replaced with
-    something a bit more efficient and/or featureful.'''
+    '''A WebSocket channel into the zone for logged in users.
+    Clients send JSON commands like:
+        {"command": "mov", "char": "Groxnor", "x": 1, "y": 0, "z": 0}
+        {"command": "sub"}
+        {"command": "unsub"}
+    Subscribing gets a snapshot of the zone, and then every tick's changes
+    are pushed as {"seq": 123, "objects": [...]}. Subscribing with
+    {"command": "sub", "format": "packed"} gets them as binary messages
+    in the wireformat module's compact format instead.'''
 
     def open(self):
-        print "WebSocket opened"
+        self.user = self.get_secure_cookie('user')
+        if not self.user:
+            self.close(reason="Not logged in.")
+            return
 
-        self.receive_message(self.on_message)
+        logging.info("WebSocket opened for %s" % self.user)
 
+    @gen.coroutine
     def on_message(self, message):
-        print message
         m = json.loads(message)
-        user = self.get_secure_cookie('user')
-        command = m['command']
+        command = m.get('command')
         if command == "mov":
-            self.set_movement(m['char'], m['x'], m['y'], m['z'], user=user)
+            result = yield self.set_movement(m['char'], m.get('x', 0), m.get('y', 0), m.get('z', 0))
+            self.write_message(json.dumps({'command': command, 'result': result}, cls=ComplexEncoder))
+        elif command == "sub":
+            packed = m.get('format') == 'packed'
+            self.write_message(stream.subscribe(self, packed=packed), binary=packed)
+        elif command == "unsub":
+            stream.unsubscribe(self)
+        else:
+            self.write_message(json.dumps({'command': command, 'error': "Unknown command."}))
 
-        self.write_message("ok")
+    def on_close(self):
+        stream.unsubscribe(self)
 
     def set_movement(self, character, xmod, ymod, zmod):
-        pass
-        # Set the character's new position based on the x, y and z modifiers.
+        '''Queue a movement for the next simulation step.'''
+        return movement.push(character, int(xmod), int(ymod), int(zmod), user=self.user)
 
 class AdminHandler(BaseHandler):
 
@@ -252,7 +533,8 @@ class AdminHandler(BaseHandler):
             raise tornado.web.HTTPError(403)
 
 class DateLimitedObjectHandler(BaseHandler):
-    '''Gets a list of objects after a certain date.'''
+    '''Gets a list of objects changed after a given change sequence number,
+    or after a certain date for older clients.'''
     target_object = None
 
     def head(self):
@@ -264,16 +546,47 @@ class DateLimitedObjectHandler(BaseHandler):
 
     @tornado.web.authenticated
     def get(self):
-        since = datetime.datetime.strptime(self.get_argument('since', '2010-01-01 00:00:00:000000'), DATETIME_FORMAT)
-        if since.year == 2010:
-            since = None
-        logging.info("Fetching objects since %s" % str(since))
-
-        retval = json.dumps([o for o in self.get_objects(since)], cls=ComplexEncoder)
-        self.content_type = 'application/json'
+        character = self.get_argument('character', None)
+        after = self.get_argument('after', None)
+        packed = wants_packed(self.request)
+
+        if after is not None:
+            # Send exactly the changes after the client's cursor, up to a
+            # high-water mark the client should send back next time.
+            try:
+                after = int(after)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "after should be a change sequence number.")
+            seq = Object.max_change_seq()
+            logging.info("Fetching objects changed after %d up to %d" % (after, seq))
+
+            if character is None:
+                retval = snapshots.get(seq, (after, packed),
+                                       lambda: encode_objects({'objects': Object.get_objects(after=after, upto=seq),
+                                                               'seq': seq}, packed))
+            else:
+                result = self.get_interesting_objects(character, after=after, upto=seq)
+                result['seq'] = seq
+                retval = encode_objects(result, packed)
+        else:
+            since = datetime.datetime.strptime(self.get_argument('since', '2010-01-01 00:00:00:000000'), DATETIME_FORMAT)
+            if since.year == 2010:
+                since = None
+            logging.info("Fetching objects since %s" % str(since))
+
+            if character is not None:
+                retval = encode_objects(self.get_interesting_objects(character, since=since), packed)
+            elif since is None:
+                # A client's first full refresh.
+                seq = Object.max_change_seq()
+                retval = snapshots.get(seq, ('all', packed),
+                                       lambda: encode_objects(Object.get_objects(upto=seq), packed))
+            else:
+                retval = encode_objects(self.get_objects(since), packed)
+
+        self.set_header('Content-Type', PACKED_CONTENT_TYPE if packed else 'application/json')
         self.write(retval)
 
-    @cachelper.memoize(timeout=3) # Up to 3 seconds of lag if a client is super lazy about full refreshes.
     def get_objects(self, since=None):
         '''Gets a list of things from the database.
         Should not be called without an argument except when
@@ -281,10 +594,45 @@ class DateLimitedObjectHandler(BaseHandler):
 
         return Object.get_objects(since=since)
 
+    def get_interesting_objects(self, character, since=None, after=None, upto=None):
+        '''Gets only the objects inside character's interest region.
+        Objects that just came into view are sent in full regardless of
+        since or after, and the ids of objects that entered or left the
+        region are listed so clients can add or drop them.'''
+        region = interest.update(character)
+        if region is None:
+            raise tornado.web.HTTPError(404, "No character %s in this zone." % character)
+        visible, entered, left = region
+
+        objects = Object.get_objects(since=since, after=after, upto=upto, ids=visible - entered)
+        objects.extend(Object.get_objects(ids=entered))
+        return {'objects': objects,
+                'entered': sorted(entered),
+                'left': sorted(left)}
+
+
+class MessageHandler(BaseHandler):
+    '''MessageHandler returns the zone's messages after a given change
+    sequence number, as {"seq": 45, "messages": [...]}, straight from the
+    zone's in-memory message buffer. Send the seq back as after next time.
+    Like /objects, it is sent in the packed wire format to clients that
+    accept it.'''
 
-class MessageHandler(DateLimitedObjectHandler):
-    '''MessageHandler returns a list of messages.'''
-    target_object = Message
+    @tornado.web.authenticated
+    def get(self):
+        try:
+            after = int(self.get_argument('after', 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "after should be a message sequence number.")
+
+        seq = message_buffer.synced
+        messages = message_buffer.get_messages(after=after)
+        if wants_packed(self.request):
+            self.set_header('Content-Type', PACKED_CONTENT_TYPE)
+            self.write(pack_messages(messages, seq=seq))
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps({'seq': seq, 'messages': messages}, cls=ComplexEncoder))
 
 
 class ObjectsHandler(DateLimitedObjectHandler):
@@ -304,36 +652,26 @@ class ScriptedObjectHandler(BaseHandler):
     def activate_object(self, object_id, character):
         # Instantiate the scripted object and call its activate thing.
         retval = []
-        for o in [Object.get(id=object_id)]:
-            # TODO: Break this block into a method.
-            for script in o.scripts:
-                scriptclass = script.split('.')[-1]
-                module = __import__(script, globals(), locals(), [scriptclass], -1)
-                # For each entry in the script's dir()
-                for key in dir(module):
-                    C = getattr(module, key)
-                    try:
-                        if not issubclass(C, Script):
-                            # If it isn't a subclass of Script, skip it.
-                            continue
-                    except TypeError:
-                        # If C isn't a class at all, skip it.
-                        continue
-
-                    # Finally activate the script.
-                    script_val = C(o).activate(character)
-                    if script_val:
-                        # Only return it if the script actually returns something.
-                        # So clients should only react to activating scripts that
-                        # return something meaningful.
-                        retval.append(script_val)
-
+        for script in script_registry.instances(Object.get(id=object_id)):
+            script_val = script.activate(character)
+            if script_val:
+                # Only return it if the script actually returns something.
+                # So clients should only react to activating scripts that
+                # return something meaningful.
+                retval.append(script_val)
+
+        # Activating may well have changed the object.
+        snapshots.invalidate()
         return retval
 
 def main():
     import tornado
     from tornado.options import options, define
 
+    # BaseServer parses these too, but only once it's made, which is too
+    # late for them. Its parse is the final one that sets up logging.
+    options.parse_command_line(final=False)
+
     # Port
     port = options.port
     # Instance Type
@@ -351,6 +689,7 @@ def main():
     handlers.append((r"/admin", AdminHandler))
     handlers.append((r"/messages", MessageHandler))
     handlers.append((r"/activate/(.*)", ScriptedObjectHandler))
+    handlers.append((r"/stream", WSMovementHandler))
 
     server = BaseServer(handlers)
 
@@ -363,12 +702,28 @@ def main():
     # Initialize the zone
     zonescript = zonemodule.Zone(logger=logging.getLogger('simplemmo-zoneserver-'+zoneid))
 
+    # From here on the zone's objects live in memory, and get written
+    # out every ZONE_FLUSH_INTERVAL.
+    zone_state.load()
+    tornado.ioloop.PeriodicCallback(zone_state.flush, ZONE_FLUSH_INTERVAL).start()
+    # Same for the latest messages, which the ScriptServer mostly writes.
+    message_buffer.load()
+    tornado.ioloop.PeriodicCallback(message_buffer.flush, ZONE_FLUSH_INTERVAL).start()
+
+    # Apply everybody's queued movement at a fixed rate.
+    tornado.ioloop.PeriodicCallback(movement.step, SIMULATION_STEP).start()
+
     server.listen(port)
 
+    # Push object changes to WebSocket subscribers at the client update rate.
+    tornado.ioloop.PeriodicCallback(stream.tick, CLIENT_UPDATE_FREQ).start()
+
     logging.info("Starting up Zoneserver...")
     try:
         server.start()
     except KeyboardInterrupt:
+        zone_state.flush()
+        message_buffer.flush()
         logging.info("Exiting %s." % zoneid)
 
 if __name__ == "__main__":
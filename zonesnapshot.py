@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# ##### BEGIN AGPL LICENSE BLOCK #####
+# This file is part of SimpleMMO.
+#
+# Copyright (C) 2011, 2012  Charles Nelson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# ##### END AGPL LICENSE BLOCK #####
+
+'''ZoneSnapshot
+Compiles zones' starting objects into snapshot files (ZONE_SNAPSHOT_FILE),
+by running each zone's insert_objects once against an empty database.
+A new instance of the zone then copies its snapshot in instead of running
+the zone's code again.
+
+A snapshot records a hash of the zone's code, and is ignored once that
+changes. Rebuild a zone's snapshot whenever its code changes:
+    python zonesnapshot.py --zonename=GhibliHills
+Without --zonename, every zone in games/zones gets one.
+'''
+
+import os
+import logging
+
+from tornado.util import import_object
+
+import elixir_models
+from elixir_models import Object
+from settings import ZONE_SNAPSHOT_FILE
+
+ZONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'games', 'zones')
+
+
+def zone_names():
+    '''The name of every zone in games/zones.'''
+    return [name[:-len('.py')] for name in sorted(os.listdir(ZONES))
+            if name.endswith('.py') and name not in ('__init__.py', 'basezone.py')]
+
+def build(zonename, path=None):
+    '''Set up a new database at path (the zone's ZONE_SNAPSHOT_FILE by
+    default) with the zone's objects in it, replacing any snapshot that was
+    there. Returns how many objects it has.'''
+    if path is None:
+        path = ZONE_SNAPSHOT_FILE % zonename
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # The zone would copy the old snapshot instead of running its code.
+    if os.path.exists(path):
+        os.remove(path)
+    building = path + '.building'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(building + suffix):
+            os.remove(building + suffix)
+
+    elixir_models.setup(db_uri=building)
+    try:
+        zonemodule = import_object('games.zones.' + zonename)
+        zonemodule.Zone(logger=logging.getLogger('zonesnapshot.' + zonename))
+        count = Object.select().count()
+        # Zones only use the snapshot while their code is still the same.
+        elixir_models.mark_snapshot(zonemodule.Zone.code_version())
+        # Fold the WAL back in, so the snapshot is just the one file.
+        elixir_models.db.execute_sql('PRAGMA journal_mode = delete')
+    finally:
+        elixir_models.db.close()
+
+    os.rename(building, path)
+    return count
+
+def main():
+    from tornado.options import options, define, parse_command_line
+
+    define("zonename", default=[], multiple=True, help="Which zones to build snapshots of. Every zone if not given.", type=str)
+    parse_command_line()
+
+    for zonename in options.zonename or zone_names():
+        count = build(zonename)
+        logging.info("Built %s with %d objects." % (ZONE_SNAPSHOT_FILE % zonename, count))
+
+if __name__ == "__main__":
+    main()